@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+from flask import jsonify
 from flask_api import FlaskAPI
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
@@ -25,8 +26,6 @@ def create_app(config_name):
     dashboard.config.init_from(file="../dashboard_config.cfg")
     dashboard.bind(app)
     with app.app_context():
-        from .external.predict import initialize
-        initialize()
         db.init_app(app)
         mail.init_app(app)
         
@@ -41,4 +40,34 @@ def create_app(config_name):
 
         from .external import external_blueprint
         app.register_blueprint(external_blueprint, url_prefix="/api/v1")
+
+        from .utils import imaging
+        imaging.configure(app)
+
+        from .utils import auth_cache
+        auth_cache.configure(app)
+
+        from .utils import passwords
+        passwords.configure(app)
+        app.register_error_handler(passwords.PasswordHasherBusy, password_hasher_busy)
+
+        from . import maintenance
+        maintenance.start(app)
+
+        # keeps the progress counters in step with label writes
+        from . import progress
+        # and the labelling work queue with the images and annotations
+        from . import labelling
+
+        # the model itself is loaded on the first prediction, or by predict.warmup()
+        from .external import predict
+        predict.configure(app)
     return app
+
+
+def password_hasher_busy(e):
+    """Turns away logins while the password hasher is saturated"""
+    response = jsonify({"message": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
@@ -1,20 +1,29 @@
-import io
 import os
 import csv
 import json
 
-from PIL import Image as Img
-import pandas as pd
 from dotenv import load_dotenv
-from flask import Blueprint, request, jsonify, abort, url_for, stream_with_context
+from flask import Blueprint, request, jsonify, abort, url_for, stream_with_context, current_app
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
 from io import StringIO
+from urllib.parse import unquote, urlsplit
+from zlib import adler32
 from werkzeug.datastructures import Headers
 from werkzeug.wrappers import Response
 
 import application as app
+from application import db
 from application.decorators import permission_required
+from application.pagination import list_response, load_fields, paginate, requested_fields, serialize
+from application.stats import (dataset_annotation_counts, dataset_image_counts, dataset_item_counts,
+                               dataset_progress, item_image_statuses, item_is_labelled,
+                               user_labelled_item_counts)
+from application.utils.auth_cache import invalidate_principal, load_principal
+from application.utils.imaging import image_processor
+from application.utils.storage import ContentStore
+from application.utils.uploads import sniff_image_type
 from application.models import Image, Item, User, Assignment, Dataset, Project, Attributes, Annotation
 
 load_dotenv()
@@ -113,35 +122,41 @@ def datasets():
             return response
     else:
         # GET request
-        datasets = Dataset.get_all()
-        results = []
-
-        for dataset in datasets:
-            # Calculating labelling progress
-
-            labelled_images = Image.query.filter_by(dataset_id=dataset.id, labelled=True, has_box=True,
-                                                    folder_labelled=True).count()
-            all_images = Image.query.filter_by(dataset_id=dataset.id).count()
-
-            if labelled_images and all_images:
-                progress = (labelled_images / all_images) * 100
-            else:
-                progress = 0
-
-            obj = {
-                "id": dataset.id,
-                "name": dataset.name,
-                "project_id": dataset.project_id,
-                "classes": dataset.classes,
-                "classes2": dataset.classes2,
-                "progress": progress,
-                "date_created": dataset.date_created,
-                "date_modified": dataset.date_modified
-            }
-            results.append(obj)
-        response = jsonify(results)
-        response.status_code = 200
-        return response
+        fields = requested_fields(dataset_fields)
+        query = load_fields(Dataset.query, Dataset, fields, dataset_columns, always=["name"])
+        # unnamed datasets sort first instead of falling out of the cursor comparison
+        page = paginate(query, [db.func.coalesce(Dataset.name, ""), Dataset.id],
+                        values=lambda dataset: [dataset.name or "", dataset.id])
+        progress = dict()
+        if "progress" in fields:
+            # labelling progress of the whole page in one query
+            progress = dataset_progress([dataset.id for dataset in page.rows])
+        results = [serialize(dataset, fields, dataset_fields, progress) for dataset in page.rows]
+        return list_response(results, page)
+
+
+# fields of a dataset listing, serialized from the dataset and the progress of its page
+dataset_fields = {
+    "id": lambda dataset, progress: dataset.id,
+    "name": lambda dataset, progress: dataset.name,
+    "project_id": lambda dataset, progress: dataset.project_id,
+    "classes": lambda dataset, progress: dataset.classes,
+    "classes2": lambda dataset, progress: dataset.classes2,
+    "progress": lambda dataset, progress: progress.get(dataset.id, 0),
+    "target_annotations": lambda dataset, progress: dataset.target_annotations,
+    "date_created": lambda dataset, progress: dataset.date_created,
+    "date_modified": lambda dataset, progress: dataset.date_modified,
+}
+# columns each field is loaded from
+dataset_columns = {
+    "name": ["name"],
+    "project_id": ["project_id"],
+    "classes": ["classes"],
+    "classes2": ["classes2"],
+    "target_annotations": ["target_annotations"],
+    "date_created": ["date_created"],
+    "date_modified": ["date_modified"],
+}
 
 
 @admin_blueprint.route('/admin/datasets/<int:id>/', methods=['GET', 'PUT', 'DELETE'])
@@ -162,12 +177,19 @@ def dataset_manipulation(id, **kwargs):
         classes = request.data.getlist("classes")
         dataset.name = name
         dataset.classes = classes
+        if "target_annotations" in request.data:
+            # annotations wanted per image, the labelling queue follows the change
+            target = request.data.get("target_annotations")
+            if not str(target).isdigit() or int(target) < 1:
+                abort(400, "target_annotations must be a positive integer")
+            dataset.target_annotations = int(target)
         dataset.save()
         response = jsonify({
             "id": dataset.id,
             "name": dataset.name,
             "classes": dataset.classes,
             "project_id": dataset.project_id,
+            "target_annotations": dataset.target_annotations,
             "date_created": dataset.date_created,
             "date_modified": dataset.date_modified
         })
@@ -175,15 +197,8 @@ def dataset_manipulation(id, **kwargs):
         return response
     else:
         # GET by ID
-        labelled_items = Item.query.filter_by(dataset_id=dataset.id).count()
-        labelled_images = Image.query.filter_by(labelled=True, has_box=True).count()
-        all_images = Image.query.count()
-        all_items = Item.query.count()
-        if labelled_items and all_items:
-            progress = ((labelled_items + labelled_images) / (all_images + all_items)) * 100
-        else:
-            progress = 0
-        
+        progress = dataset_progress([dataset.id]).get(dataset.id, 0)
+
         response = jsonify({
             "id": dataset.id,
             "name": dataset.name,
@@ -191,6 +206,7 @@ def dataset_manipulation(id, **kwargs):
             "classes": dataset.classes,
             "classes2": dataset.classes2,
             "progress": progress,
+            "target_annotations": dataset.target_annotations,
             "date_created": dataset.date_created,
             "date_modified": dataset.date_modified
         })
@@ -253,7 +269,7 @@ def stream_csv(dataset_id):
             image_label = image.label
             cervical_area = image.cervical_area
             folder_label = Item.query.filter_by(id=image.item_id).first().label
-            image_name = image.image_URL.split('/')[-1]
+            image_name = image.name
             image_comment = Item.query.filter_by(id=image.item_id).first().comment
 
             w.writerow([image_name, folder_label, image_label, image_comment, cervical_area])
@@ -299,7 +315,7 @@ def object_detection_dataset():
                         image_label = image.label
                         cervical_area = image.cervical_area
                         folder_label = Item.query.filter_by(id=image.item_id).first().label
-                        image_name_values = image.image_URL.split('/')[-1].split("_")
+                        image_name_values = image.name.split("_")
                         image_name = user.username + "_" + image_name_values[-2] + "_" + image_name_values[-1]
                         image_comment = Item.query.filter_by(id=image.item_id).first().comment
 
@@ -323,6 +339,7 @@ def object_detection_dataset():
 
 @admin_blueprint.route("/admin/download/by_case", methods=["GET"])
 def ordered_by_case_dataset():
+    import pandas as pd
     try:
         cases = Item.query.all()
         case_ids = list(set([i.name for i in cases]))
@@ -437,32 +454,14 @@ def item(dataset_id):
     try:
         # GET request
         if request.method == "GET":
-            items = Item.get_all(dataset_id)
-            results = []
-
-            for item in items:
-                if item.labelled and Image.query.filter_by(item_id=item.id).count() == Image.query.filter_by(
-                        item_id=item.id,
-                        labelled=True,
-                        folder_labelled=True, has_box=True).count():
-                    labelled = True
-                else:
-                    labelled = False
-                images = Image.get_all(item.id)
-                image_URLs = [i.image_URL for i in images]
-                obj = {
-                    "dataset_id": dataset_id,
-                    "id": item.id,
-                    "name": item.name,
-                    "images_URLs": image_URLs,
-                    "label": item.label,
-                    "comment": item.comment,
-                    "labelled": labelled
-                }
-                results.append(obj)
-            response = jsonify(results)
-            response.status_code = 200
-            return response
+            fields = requested_fields(item_fields)
+            # image counts and urls of every item of the page in one query
+            query = item_image_statuses(dataset_id, urls="images_URLs" in fields)
+            query = load_fields(query, Item, fields, item_columns, always=["name"])
+            page = paginate(query, [db.func.coalesce(Item.name, ""), Item.id],
+                            values=lambda row: [row[0].name or "", row[0].id])
+            results = [serialize(row, fields, item_fields, dataset_id) for row in page.rows]
+            return list_response(results, page)
         else:
             #  POST Request
             name = str(request.data.get("name", ''))
@@ -487,6 +486,23 @@ def item(dataset_id):
         return response
 
 
+# fields of an item listing, serialized from (item, images, labelled images, image urls) rows
+item_fields = {
+    "dataset_id": lambda row, dataset_id: dataset_id,
+    "id": lambda row, dataset_id: row[0].id,
+    "name": lambda row, dataset_id: row[0].name,
+    "images_URLs": lambda row, dataset_id: row[3] or [],
+    "label": lambda row, dataset_id: row[0].label,
+    "comment": lambda row, dataset_id: row[0].comment,
+    "labelled": lambda row, dataset_id: item_is_labelled(*row[:3]),
+}
+item_columns = {
+    "label": ["label"],
+    "comment": ["comment"],
+    "labelled": ["labelled"],
+}
+
+
 @admin_blueprint.route("/admin/item/<int:id>/", methods=["GET", "DELETE"])
 @permission_required()
 def item_manipulation(id, **kwargs):
@@ -522,47 +538,54 @@ def item_manipulation(id, **kwargs):
 @permission_required()
 def user():
     # GET request
-    users = User.query.filter_by(is_admin="")
-    results = []
-
-    for user in users:
-        assignments = Assignment.query.filter_by(user_id=user.id)
-        dataset_count = assignments.count()
-        record_count = Image.query.filter_by(labelled_by=user.id).count()
-        datasets = list()
-        if user.firstname and user.lastname:
-            username = user.firstname + " "+user.lastname
-        else:
-            username = user.username
-        
-        if user.site:
-            site = user.site
-        else:
-            site ="Not specified"
-
-        for assignment in assignments:
-            dataset = Dataset.query.filter_by(id=assignment.dataset_id).first()
-            dataset = {
-                "id": dataset.id,
-                "name": dataset.name
-            }
-            datasets.append(dataset)
-        obj = {
-            "id": user.id,
-            "username": username,
-            "site": site,
-            "country": user.country,
-            "gender": user.gender,
-            "project_id": user.project_id,
-            "email": user.email,
-            "dataset_count": dataset_count,
-            "datasets": datasets,
-            "record_count": record_count
-        }
-        results.append(obj)
-    response = jsonify(results)
-    response.status_code = 200
-    return response
+    fields = requested_fields(user_fields)
+    query = load_fields(User.query.filter_by(is_admin=""), User, fields, user_columns)
+    page = paginate(query, [User.id])
+    user_ids = [user.id for user in page.rows]
+    # assigned datasets and labelled images of the whole page in two queries
+    datasets = {user_id: list() for user_id in user_ids}
+    if user_ids and ("datasets" in fields or "dataset_count" in fields):
+        assigned = db.session.query(Assignment.user_id, Dataset.id, Dataset.name).join(
+            Dataset, Dataset.id == Assignment.dataset_id
+        ).filter(Assignment.user_id.in_(user_ids)).order_by(Assignment.id)
+        for user_id, dataset_id, name in assigned:
+            datasets[user_id].append({"id": dataset_id, "name": name})
+    record_counts = dict()
+    if user_ids and "record_count" in fields:
+        record_counts = dict(db.session.query(Image.labelled_by, db.func.count(Image.id)).filter(
+            Image.labelled_by.in_(user_ids)
+        ).group_by(Image.labelled_by))
+    results = [serialize(user, fields, user_fields, (datasets, record_counts)) for user in page.rows]
+    return list_response(results, page)
+
+
+def user_display_name(user):
+    if user.firstname and user.lastname:
+        return user.firstname + " "+user.lastname
+    return user.username
+
+
+# fields of a user listing, serialized from the user and the (datasets, record counts) of its page
+user_fields = {
+    "id": lambda user, extra: user.id,
+    "username": lambda user, extra: user_display_name(user),
+    "site": lambda user, extra: user.site or "Not specified",
+    "country": lambda user, extra: user.country,
+    "gender": lambda user, extra: user.gender,
+    "project_id": lambda user, extra: user.project_id,
+    "email": lambda user, extra: user.email,
+    "dataset_count": lambda user, extra: len(extra[0][user.id]),
+    "datasets": lambda user, extra: extra[0][user.id],
+    "record_count": lambda user, extra: extra[1].get(user.id, 0),
+}
+user_columns = {
+    "username": ["firstname", "lastname", "username"],
+    "site": ["site"],
+    "country": ["country"],
+    "gender": ["gender"],
+    "project_id": ["project_id"],
+    "email": ["email"],
+}
 
 
 @admin_blueprint.route("/admin/users/datasets/<int:dataset_id>/", methods=["GET"])
@@ -637,6 +660,7 @@ def add_user_site(id):
         user.project_id = project_id
         
     user.save()
+    invalidate_principal(user.id)
     response = jsonify({
         "id": user.id,
         "name": user.username,
@@ -667,6 +691,7 @@ def manipulate_project_users(user_id, project_id):
         #add user to project
         user.project_id = project_id
         user.save()
+        invalidate_principal(user_id)
         # assign user the corresponding datasets
         for dataset in datasets:
             assignment = Assignment(dataset_id=dataset.id, user_id=user_id)
@@ -684,6 +709,7 @@ def manipulate_project_users(user_id, project_id):
         annotations = Annotation.query.filter_by(project_id=project_id, user_id=user_id).all()
         user.project_id = None
         user.save()
+        invalidate_principal(user_id)
         for annotation in annotations:
             annotation.delete()
         for dataset in datasets:
@@ -702,12 +728,14 @@ def manipulate_project_users(user_id, project_id):
 @admin_blueprint.route('/admin/<int:id>/home/', methods=["GET"])
 @permission_required()
 def admin_stats(id, **kwargs):
-    admin = User.query.filter_by(id=id).first()
+    admin = load_principal(id)
+    if not admin:
+        abort(404)
     users = User.query.filter_by(is_admin="").count()
     datasets = Dataset.count_all()
     response = jsonify({
         "id": admin.id,
-        "name": admin.username,
+        "name": admin.name,
         "users": users,
         "datasets": datasets
     })
@@ -720,9 +748,12 @@ def manipulate_project_uses(project_id):
     data_arr = list()
     # get all project datasets
     datasets = Dataset.query.filter_by(project_id=project_id).all()
+    # get all project users
+    users = User.query.filter_by(project_id=project_id).all()
+    image_counts = dataset_image_counts([dataset.id for dataset in datasets])
     for dataset in datasets:
-        # get all project users
-        users = User.query.filter_by(project_id=project_id).all()
+        annotation_counts = dataset_annotation_counts(dataset.id, [user.id for user in users])
+        all_images = image_counts.get(dataset.id, (0, 0))[1]
         user_arr = list()
         for user in users:
             user_id = user.id
@@ -730,8 +761,7 @@ def manipulate_project_uses(project_id):
             country = user.country
             street = user.street
             city  = user.city
-            images_labelled = Annotation.query.filter_by(user_id = user_id, dataset_id=dataset.id).count()
-            all_images = Image.query.filter_by(dataset_id=dataset.id).count()
+            images_labelled = annotation_counts.get(user_id, 0)
             user_arr.append({
                 "user_id": user_id,
                 "name": username,
@@ -799,36 +829,83 @@ def download_user_labels(dataset_id, user_id):
 
 allowed_extensions = set(['image/jpeg', 'image/png', 'jpeg'])
 uploads_dir = os.path.join(os.path.dirname(app.__file__), os.environ.get("UPLOAD_FOLDER"))
+# uploaded images are stored once per content, shared by every dataset
+content_store = ContentStore(os.path.join(uploads_dir, "objects"), "objects")
+
+
+bulk_insert_size = 200
 
 
 def allowed_file(filename):
     return filename in allowed_extensions
 
 
+def image_url_for(stored, variant="original", base_url=None):
+    """The absolute url of a stored image, on the host of the current request
+    or, outside of one, on base_url"""
+    ext = stored.ext if variant == "original" else ".jpg"
+    filename = content_store.relative_path(stored.digest, variant, ext)
+    if base_url is None:
+        return url_for(os.environ.get("UPLOAD_FOLDER"), filename=filename, _external=True)
+    parts = urlsplit(base_url)
+    adapter = current_app.url_map.bind(parts.netloc, script_name=parts.path or "/", url_scheme=parts.scheme)
+    return adapter.build(os.environ.get("UPLOAD_FOLDER"), {"filename": filename}, force_external=True)
+
+
+def static_file(url):
+    """Returns the ETag and size the static file handler serves the file at url with,
+    or (None, None) when it does not serve that url"""
+    path = urlsplit(url or "").path
+    prefix = current_app.static_url_path.rstrip("/") + "/"
+    if not path.startswith(prefix):
+        return None, None
+    filename = safe_join(current_app.static_folder, unquote(path[len(prefix):]))
+    try:
+        mtime, size = os.path.getmtime(filename), os.path.getsize(filename)
+    except (OSError, TypeError):
+        return None, None
+    # made like flask.send_file does, so that If-None-Match revalidates
+    return '"%s-%s-%s"' % (mtime, size, adler32(filename.encode("utf-8")) & 0xFFFFFFFF), size
+
+
+def save_uploads(uploads, dataset_id):
+    """Saves (stored image, image name, item id) uploads as Image rows in one transaction
+    and returns their id and url. Only the same content uploaded again under the same
+    name in the same folder reuses its row, differently named copies each get theirs."""
+    if not uploads:
+        return []
+    content_store.add_derivatives([stored for stored, _, _ in uploads], image_processor)
+    digests = set(stored.digest for stored, _, _ in uploads)
+    existing = {(image.content_hash, image.item_id, image.name): image for image in
+                Image.query.filter(Image.content_hash.in_(digests), Image.dataset_id == dataset_id)}
+    images = list()
+    for stored, image_name, item_id in uploads:
+        image = existing.get((stored.digest, item_id, image_name))
+        if image is None:
+            image = Image(name=image_name, image_URL=image_url_for(stored))
+            image.item_id = item_id
+            image.dataset_id = dataset_id
+            image.content_hash = stored.digest
+            image.byte_size = stored.size
+            db.session.add(image)
+            existing[(stored.digest, item_id, image_name)] = image
+        images.append(image)
+    db.session.flush()
+    saved = [{"id": image.id, "image": image.image_URL} for image in images]
+    db.session.commit()
+    return saved
+
+
 @admin_blueprint.route("/admin/item/<int:item_id>/", methods=["POST"])
 def upload_images(item_id):
     try:
         print(request.files.getlist("images"))
-        images_list = request.files.getlist("images")
+        images_list = [image for image in request.files.getlist("images")
+                       if image and allowed_file(image.content_type)]
         dataset_id = Item.query.filter_by(id=item_id).first().dataset_id
-        images = list()
-        for image in images_list:
-            print(image)
-            if image and allowed_file(image.content_type):
-                image_name = secure_filename(image.filename)
-                image = Img.open(io.BytesIO(image.stream.read()))
-                # image = image.resize((1024, 1024), Img.ANTIALIAS)
-                image.save(os.path.join(uploads_dir, image_name))
-                image_url = url_for(os.environ.get("UPLOAD_FOLDER"), filename=image_name, _external=True)
-                image_upload = Image(name=image_name, image_URL=image_url)
-                image_upload.item_id = item_id
-                image_upload.dataset_id = dataset_id
-                image_upload.save()
-                obj = {
-                    "id": image_upload.id,
-                    "image": image_url
-                }
-                images.append(obj)
+        uploads = [(content_store.put_stream(image.stream), secure_filename(image.filename), item_id)
+                   for image in images_list]
+        images = save_uploads(uploads, dataset_id)
         response = jsonify({
             "message": "Images were successfully added",
             "item_id": item_id,
@@ -837,6 +914,7 @@ def upload_images(item_id):
         response.status_code = 201
         return response
     except Exception as e:
+        db.session.rollback()
         response = jsonify({
             "message": str(e)
         })
@@ -851,43 +929,47 @@ def dataset_bulk_upload(dataset_id):
         # retrieve image and path
         images = request.files.getlist("images")
         paths = request.form.getlist("details")
+        # resolve every folder of the upload with one query
+        folder_names = [path.split("/")[1] for path in paths[:len(images)]]
+        folders = dict()
+        for folder in Item.query.filter(Item.name.in_(set(folder_names))).order_by(Item.id):
+            folders.setdefault(folder.name, folder)
+        new_folders = [Item(name=name, dataset_id=dataset_id) for name in set(folder_names) if name not in folders]
+        if new_folders:
+            # create new folders if not already existing
+            db.session.add_all(new_folders)
+            db.session.flush()
+            folders.update((folder.name, folder) for folder in new_folders)
+        folder_ids = {name: folder.id for name, folder in folders.items()}
+        db.session.commit()
+
         # initalize images list
         imgs = list()
+        pending = list()
         for i, image in enumerate(images):
-            # get folder name
-            folder_name = paths[i].split("/")[1]
-            print("Folder_name ", folder_name)
-            # Get folder
-            folder = Item.query.filter_by(name=folder_name).first()
-            print("Folder", folder)
-            if not folder:
-                # create new folder if not already existing
-                folder = Item(name=folder_name, dataset_id=dataset_id)
-                folder.save()
-                print(folder)
-            # Do this if image is of allowed type
-            if image and allowed_file(image.content_type):
-                image_name = folder_name + paths[i].split("/")[2]
-                # read image
-                image = Img.open(io.BytesIO(image.stream.read()))
-                image.save(os.path.join(uploads_dir, image_name))
-                image_url = url_for(os.environ.get("UPLOAD_FOLDER"), filename=image_name, _external=True)
-                image_upload = Image(name=image_name, image_URL=image_url)
-                image_upload.item_id = folder.id
-                image_upload.dataset_id = dataset_id
-                image_upload.save()
-                print("Uploaded ", image_name)
-                obj = {
-                    "id": image_upload.id,
-                    "image": image_url
-                }
-                imgs.append(obj)
+            if not image:
+                continue
+            # check the format from the header bytes instead of decoding the image
+            header = image.stream.read(16)
+            if not allowed_file(sniff_image_type(header)):
+                print("Skipped ", image.filename)
+                continue
+            folder_name = folder_names[i]
+            image_name = secure_filename(folder_name + paths[i].split("/")[2])
+            stored = content_store.put_stream(image.stream, header=header)
+            pending.append((stored, image_name, folder_ids[folder_name]))
+            if len(pending) >= bulk_insert_size:
+                imgs.extend(save_uploads(pending, dataset_id))
+                pending = list()
+        imgs.extend(save_uploads(pending, dataset_id))
+        print("Uploaded ", len(imgs), " images")
         response = jsonify({
             "message": "Successfully uploaded dataset",
             "images": imgs,
             "id": dataset_id
         })
     except Exception as e:
+        db.session.rollback()
         response = jsonify({
             "message": str(e)
         })
@@ -904,16 +986,12 @@ def dataset_image_upload_2():
 
         if image and allowed_file(image.content_type):
             image_name = secure_filename(image.filename)
-            image.save(os.path.join(uploads_dir, image_name))
-            image_url = url_for(os.environ.get("UPLOAD_FOLDER"), filename=image_name, _external=True)
-            image_upload = Image(name=image_name, image_URL=image_url)
-            image_upload.dataset_id = dataset_id
-            image_upload.save()
+            image_upload = save_uploads([(content_store.put_stream(image.stream), image_name, None)], dataset_id)[0]
         response = jsonify({
             "message": "Image was successfully added",
             "dataset_id": dataset_id,
-            "image": image_url,
-            "id": image_upload.id
+            "image": image_upload["image"],
+            "id": image_upload["id"]
         })
         response.status_code = 201
         return response
@@ -945,17 +1023,13 @@ def dataset_image_upload():
             print("Folder ", folder)
         if image and allowed_file(image.content_type):
             image_name = secure_filename(image.filename)
-            image.save(os.path.join(uploads_dir, image_name))
-            image_url = url_for(os.environ.get("UPLOAD_FOLDER"), filename=image_name, _external=True)
-            image_upload = Image(name=image_name, image_URL=image_url)
-            image_upload.dataset_id = dataset_id
-            image_upload.item_id = folder.id
-            image_upload.save()
+            image_upload = save_uploads([(content_store.put_stream(image.stream), image_name, folder.id)],
+                                        dataset_id)[0]
         response = jsonify({
             "message": "Image was successfully added",
             "dataset_id": dataset_id,
-            "image": image_url,
-            "id": image_upload.id
+            "image": image_upload["image"],
+            "id": image_upload["id"]
         })
 
         response.status_code = 201
@@ -971,6 +1045,8 @@ def dataset_image_upload():
 @admin_blueprint.route("/admin/images/<int:image_id>/", methods=["DELETE"])
 def delete_image(image_id):
     image = Image.query.filter_by(id=image_id).first()
+    # the stored file may be shared or about to be uploaded again,
+    # maintenance.collect_blobs removes it once no row points at it
     image.delete()
     response = jsonify({
         "Message": "Image {} successfully deleted".format(image_id)
@@ -983,15 +1059,22 @@ def dashboard_allsites_stats():
     try:
         sites = ["arua", "jinja", "mayuge", "mbarara", "uci", "gynecologist"]
         sites_stats = list()
+        # load every user, assignment and count up front instead of querying per user
+        site_users = User.query.filter(User.site.in_(sites)).all()
+        user_ids = [user.id for user in site_users]
+        user_datasets = dict()
+        for assignment in Assignment.query.filter(Assignment.user_id.in_(user_ids)):
+            user_datasets.setdefault(assignment.user_id, set()).add(assignment.dataset_id)
+        item_counts = dataset_item_counts()
+        labelled_counts = user_labelled_item_counts(user_ids)
         for i,site in enumerate(sites):
-            users = User.query.filter_by(site=site).all()
+            users = [user for user in site_users if user.site == site]
             labelled_cases=0
             un_labelled_cases=0
             for user in users:
-                user_assignments = Assignment.query.filter_by(user_id=user.id).all()
-                datasets = [i.dataset_id for i in user_assignments]
-                all = Item.query.filter(Item.dataset_id.in_(datasets)).count()
-                labelled = Item.query.filter_by(labelled_by=user.id, labelled=True).count()
+                datasets = user_datasets.get(user.id, set())
+                all = sum(item_counts.get(dataset_id, (0, 0))[1] for dataset_id in datasets)
+                labelled = labelled_counts.get(user.id, 0)
                 labelled_cases += labelled
                 un_labelled_cases += (all-labelled)
             sites_stats.append({
@@ -1011,20 +1094,20 @@ def dashboard_allsites_stats():
 def dashboard_onesite_stats(site):
     try:
         users = User.query.filter_by(site=site).all()
+        assignments = Assignment.query.filter(Assignment.user_id.in_([user.id for user in users])).all()
+        # case counts of every assigned dataset in one query
+        item_counts = dataset_item_counts(list(set(i.dataset_id for i in assignments)))
         site_stats = list()
         for user in users:
             id = user.id
             name = user.username
-            assignments = Assignment.query.filter_by(user_id=user.id).all()
-            datasets = [Dataset.query.filter_by(id=i.dataset_id).first() for i in assignments ]
+            dataset_ids = [i.dataset_id for i in assignments if i.user_id == user.id]
             dataset_stats = list()
             total_labelled = 0
             total_unlabelled = 0
             # Get assigned datasets stats.
-            for i, dataset in enumerate(datasets):
-                dataset_id = dataset.id
-                all_cases = Item.query.filter_by(dataset_id=dataset_id).count()
-                labelled_cases = Item.query.filter_by(labelled=True, dataset_id=dataset_id).count()
+            for dataset_id in dataset_ids:
+                labelled_cases, all_cases = item_counts.get(dataset_id, (0, 0))
                 total_labelled += labelled_cases
                 total_unlabelled += (all_cases - labelled_cases)
                 dataset_stats.append({
@@ -2,7 +2,7 @@ from flask import Blueprint, jsonify, redirect, render_template_string
 import os
 
 from application.utils.token import confirm_verification_token
-from application.utils.email import send_email
+from application.utils.email import queue_email
 from application.models import User
 
 import os
@@ -24,7 +24,6 @@ def verify_email(token):
 
         elif user and not user.is_verified:
             user.is_verified = True
-            user.save()
             # send email to admin
             html = render_template_string("<h2>New Project Signup</h2> <p>A new user, {{ email}} has registered for the project.</p>\
                 <p>Please login to the <a href='https://marconimlannotator.com/administrator'>system</a>\
@@ -32,8 +31,11 @@ def verify_email(token):
             subject  =  "New SignUp PRESCRIP PROJECT macronimlannotator"
             reciever1 = os.getenv("PROJECT_ADMIN")
             reciever2 = os.getenv("PROJECT_ADMIN2")
-            send_email(reciever1, subject, html)
-            send_email(reciever2, subject, html)
+            for reciever in (reciever1, reciever2):
+                if reciever:
+                    queue_email(reciever, subject, html)
+            # committed with the emails, so neither happens without the other
+            user.save()
             return redirect(os.getenv("FRONT_END_LOGIN"), code=302)
         else:
             return redirect("https://marconimlannotator.com/signup", code=302)
@@ -4,7 +4,10 @@ from flask.views import MethodView
 from flask import make_response, request, jsonify, url_for, render_template_string
 from application.models import Assignment, User, BlackListToken, Dataset
 from application.utils.token import generate_verification_token, confirm_verification_token
-from application.utils.email import send_email
+from application import db
+from application.utils.email import queue_email
+from application.utils.auth_cache import revoke_token
+from application.utils.passwords import PasswordHasherBusy
 
 class RegistrationView(MethodView):
     """This class registers a new user."""
@@ -47,10 +50,13 @@ class RegistrationView(MethodView):
                         {{ verification_email }}</a></p> <br> <p>Thanks!</p>", verification_email=verification_email
                 )
                 subject  =  "Marconi ML annotator email verification"
-                send_email(email, subject, html)
                 if "site" in post_data:
                     user.site = post_data["site"]
-                user.save()
+                # the user and their verification email are committed together,
+                # the outbox sender delivers it after the response
+                db.session.add(user)
+                queue_email(email, subject, html)
+                db.session.commit()
 
                 # datasets = list(Dataset.query.filter_by(project_id=int(post_data['project_id'])).all())
                 # print(f"datasets {datasets}")
@@ -63,6 +69,9 @@ class RegistrationView(MethodView):
                 }
                 # return a response notifying the user that they registered successfully
                 return make_response(jsonify(response)), 201
+            except PasswordHasherBusy:
+                # answered with a 503 and Retry-After
+                raise
             except Exception as e:
                 # An error occured, therefore return a string message containing the error
                 print(e)
@@ -113,6 +122,9 @@ class LoginView(MethodView):
                 }
                 return make_response(jsonify(response)), 401
 
+        except PasswordHasherBusy:
+            # answered with a 503 and Retry-After
+            raise
         except Exception as e:
             # Create a response containing an string error message
             response = {
@@ -136,6 +148,7 @@ class LogoutAPI(MethodView):
                 blacklist_token = BlackListToken(token=auth_token)
                 try:
                     blacklist_token.save()
+                    revoke_token(auth_token)
                     response = jsonify({
                         "status": "success",
                         "message": "Successfully logged out."
@@ -1,26 +1,34 @@
 from functools import wraps
-from flask import request, abort
-from application.models import User, BlackListToken
+from flask import request, abort, g
+from application.utils.auth_cache import InvalidToken, load_principal, verify_token
+
+def authenticate():
+    """Checks the bearer token of the request and loads the caller into g.principal"""
+    auth_headers = request.headers.get("Authorization", "").split(" ")
+    access_token = auth_headers[1] if len(auth_headers) > 1 else ""
+    if not access_token:
+        abort(401)
+    try:
+        # from memory for tokens seen before, see utils.auth_cache
+        user_id = verify_token(access_token)
+    except InvalidToken as e:
+        abort(401, str(e))
+    if user_id is None:
+        abort(401, "Token blacklisted")
+    if not str(user_id) == str(request.headers.get("user_id")):
+        abort(401, "Not authorized" + str(user_id) + "!= " + str(request.headers.get("user_id")))
+    # id, role, project and site of the caller, cached per worker
+    g.principal = load_principal(user_id)
+    if g.principal is None:
+        abort(401, "Unknown user")
 
 def permission_required():
     def _permission_required(f):
         @wraps(f)
         def __permission_required(*args, **kwargs):
-            auth_headers = request.headers.get("Authorization")
-            if not auth_headers:
-                abort(401)
-            access_token = auth_headers.split(" ")[1]
-            if access_token:
-                try:
-                    is_blacklisted = BlackListToken.check_blacklist(access_token)
-                    if is_blacklisted:
-                        abort(401, "Token blacklisted")
-                    user_id = User.decode_token(access_token)
-                    if not str(user_id) == str(request.headers.get("user_id")):
-                        abort(401, "Not authorized" + user_id + "!= "+request.headers.get("user_id"))
-                except Exception as e:
-                    abort(401, e)
-            if not (request.headers.get("is_admin") or request.headers.get("project_admin")):
+            authenticate()
+            # the role comes from the database, not from headers the client sets
+            if g.principal.role not in ("admin", "project_admin"):
                 abort(403)
             return f(*args, **kwargs)
         return __permission_required
@@ -30,20 +38,7 @@ def user_is_authenticated():
     def _user_is_authenticated(f):
         @wraps(f)
         def __user_is_authenticated(*args, **kwargs):
-            auth_headers = request.headers.get("Authorization")
-            if not auth_headers:
-                abort(401)
-            access_token = auth_headers.split(" ")[1]
-            if access_token:
-                try:
-                    is_blacklisted = BlackListToken.check_blacklist(access_token)
-                    if is_blacklisted:
-                        abort(401, "Token blacklisted")
-                    user_id = User.decode_token(access_token)
-                    if not str(user_id) == str(request.headers.get("user_id")):
-                        abort(401, "Not authorized" + user_id + "!= "+request.headers.get("user_id"))
-                except Exception as e:
-                    abort(401, e)
+            authenticate()
             return f(*args, **kwargs)
         return __user_is_authenticated
     return _user_is_authenticated
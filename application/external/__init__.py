@@ -1,62 +1,83 @@
-import os
-import requests
+import io
+import json
 from PIL import Image as Img
 import uuid
 
-from flask import request, Blueprint, jsonify, url_for
+from flask import request, Blueprint, jsonify, url_for, abort
 from werkzeug.utils import secure_filename
 
 from flask import current_app as app
-from application.models import Image, Item, Dataset
-from ..admin import allowed_file
+from application.decorators import permission_required
+from application.models import Image, Item, Dataset, IngestionJob
+from application.utils.imaging import image_processor
+from ..admin import allowed_file, content_store, image_url_for
 
-from .predict import predict_url
+from . import predict
+from .cache import PredictionCache
+from .fetch import Fetcher, FetchError
+from .jobs import get_worker
+from .predict import predict_batch
 
 external_blueprint = Blueprint("external", __name__)
 
-uploads_dir = app.config["EXTERNAL_UPLOADS"]
-resized_uploads_dir = os.path.join(app.config["EXTERNAL_UPLOADS"], "resized")
+fetcher = Fetcher(pool_size=app.config["FETCH_POOL_SIZE"],
+                  timeout=(app.config["FETCH_CONNECT_TIMEOUT"], app.config["FETCH_READ_TIMEOUT"]))
+prediction_cache = PredictionCache(max_entries=app.config["PREDICTION_CACHE_SIZE"],
+                                   ttl=app.config["PREDICTION_CACHE_TTL"],
+                                   redis_url=app.config["PREDICTION_CACHE_REDIS_URL"])
 
 
-def create_image(folder, picture, folder_name, folder_id, dataset_id, image_label, picture_key, pos_thres):
+picture_keys = ["picture1_before", "picture2_before", "picture3_after", "picture4_after"]
+
+
+def create_image(folder, data, stored, picture, folder_name, folder_id, dataset_id, image_label, picture_key,
+                 base_url=None):
+    """Decodes a downloaded study picture and saves the stored copy as an Image of a new study.
+    Returns the picture url and the decoded PIL image for prediction."""
     try:
-        image = Img.open(requests.get(picture, stream=True).raw)
+        image = Img.open(io.BytesIO(data))
     except Exception as e:
-        return f"Error downloading {picture_key}"
+        raise ValueError(f"Error decoding {picture_key}")
+    if not allowed_file(image.get_format_mimetype()):
+        raise TypeError(f"{picture_key} is not a supported image type")
+    if not folder:
+        print(image.get_format_mimetype(), "  image name ", image.filename)
+        image_name = secure_filename(folder_name + "-" + str(uuid.uuid4()) + ".jpg")
+        print("Image name ", image_name)
+        image_url = image_url_for(stored, "resized", base_url)
+        print("image_url: ", image_url)
+        image_upload = Image(name=image_name, image_URL=image_url)
+        print("Created image upload")
+        image_upload.item_id = folder_id
+        image_upload.dataset_id = dataset_id
+        image_upload.content_hash = stored.digest
+        image_upload.byte_size = stored.size
+        image_upload.label = image_label
+        image_upload.labelled = True
+        image_upload.save()
+        print("Concluded image upload")
     else:
-        if allowed_file(image.get_format_mimetype()):
-            prediction = predict_url(picture, pos_thres)["predictions"]
-            if not folder:
-                print(image.get_format_mimetype(), "  image name ", image.filename)
-                image_name = secure_filename(folder_name + "-" + str(uuid.uuid4()) + ".jpg")
-                print("Image name ", image_name)
-                image_resized = image.resize((512, 512), Img.ANTIALIAS)
-                # save original
-                image.save(os.path.join(uploads_dir, image_name))
-                print("saved image")
-                # save resized
-                image_resized.save(os.path.join(resized_uploads_dir, image_name))
-
-                image_url = url_for(os.environ.get("UPLOAD_FOLDER"), filename=f"external/resized/{image_name}",
-                                    _external=True)
-                print("image_url: ", image_url)
-                image_upload = Image(name=image_name, image_URL=image_url)
-                print("Created image upload")
-                image_upload.item_id = folder_id
-                image_upload.dataset_id = dataset_id
-                image_upload.label = image_label
-                image_upload.labelled = True
-                image_upload.save()
-                print("Concluded image upload")
-            else:
-                print("Folder exists")
-    return (picture, prediction)
-
-
-@external_blueprint.route("/upload", methods=["POST"])
-def upload_data():
+        print("Folder exists")
+    return (picture, image)
+
+
+def validate_study(payload):
+    """Checks that an upload payload has everything ingest_study needs"""
+    assert isinstance(payload, dict), "Expected a JSON object"
+    assert payload.get("study_id"), "No study id found"
+    assert "positive_threshold" in payload, "No positive_threshold found"
+    for picture_key in picture_keys:
+        picture = payload.get(picture_key)
+        assert isinstance(picture, dict) and picture.get("request_image_url"), \
+            f"No request_image_url found for {picture_key}"
+        assert "acetic_acid" in picture, f"No acetic_acid found for {picture_key}"
+
+
+def ingest_study(payload, base_url=None):
+    """Downloads, saves and predicts the pictures of a study.
+    Returns the response body and its status code. Image urls are made for
+    the host of the current request or, from the ingestion worker, base_url."""
     try:
-        payload = request.get_json()
         print("Payload ", payload["picture1_before"])
         #  check if dataset exists if not create it
         datasets = Dataset.query.filter_by(name="orchestra_data").all()
@@ -79,62 +100,61 @@ def upload_data():
             folder = Item(name=payload["study_id"], dataset_id=dataset.id)
             folder.save()
 
-        predicted_classes = list()
-        #  create image_1
-        try:
-            if int(payload["picture1_before"]["acetic_acid"]):
-                image1_label = "Stained with acetic acid"
-            else:
-                image1_label = "Not stained with acetic acid"
-            image1_url, pred1 = create_image(folder_exists, payload["picture1_before"]["request_image_url"], folder.name, folder.id,
-                                             dataset.id, image1_label, "picture1_before", payload["positive_threshold"])
-            predicted_classes.append(pred1["class"])
-        except ValueError:
-            return jsonify({
-                "Message": f"Could not download picture1_before: {payload['picture1_before']['request_image_url']}"
-            }), 400
-        #  create image_2
+        #  download all the study pictures at once
         try:
-            if int(payload["picture2_before"]["acetic_acid"]):
-                image2_label = "Stained with acetic acid"
-            else:
-                image2_label = "Not stained with acetic acid"
-            image2_url, pred2 = create_image(folder_exists, payload["picture2_before"]["request_image_url"], folder.name, folder.id,
-                                             dataset.id, image2_label, "picture2_before", payload["positive_threshold"])
-            predicted_classes.append(pred2["class"])
-        except ValueError:
-            return jsonify({
-                "Message": f"Could not download picture2_before: {payload['picture2_before']['request_image_url']}"
-            }), 400
-        #  create image_3
-        try:
-            if int(payload["picture3_after"]["acetic_acid"]):
-                image3_label = "Stained with acetic acid"
-            else:
-                image3_label = "Not stained with acetic acid"
-
-            image3_url, pred3 = create_image(folder_exists, payload["picture3_after"]["request_image_url"], folder.name, folder.id,
-                                             dataset.id, image3_label, "picture3_after", payload["positive_threshold"])
-            predicted_classes.append(pred3["class"])
-        except ValueError:
-            return jsonify({
-                "Message": f"Could not download picture3_after: {payload['picture3_after']['request_image_url']}"
-            }), 400
-
-        #  create image_4
-        try:
-            if int(payload["picture4_after"]["acetic_acid"]):
-                image4_label = "Stained with acetic acid"
-            else:
-                image4_label = "Not stained with acetic acid"
-
-            image4_url, pred4 = create_image(folder_exists, payload["picture4_after"]["request_image_url"], folder.name, folder.id,
-                                             dataset.id, image4_label, "picture4_after", payload["positive_threshold"])
-            predicted_classes.append(pred4["class"])
-        except ValueError:
-            return jsonify({
-                "Message": f"Could not download picture4_after: {payload['picture4_after']['request_image_url']}"
-            }), 400
+            downloads = fetcher.fetch_all([payload[picture_key]["request_image_url"] for picture_key in picture_keys])
+        except FetchError as e:
+            print(e)
+            return {
+                "Message": f"Could not download {picture_keys[e.index]}: {e.url}"
+            }, 400
+
+        #  store the pictures of a new study by content, resizing only pictures not seen before
+        if folder_exists:
+            stored_images = [None] * len(downloads)
+        else:
+            stored_images = [content_store.put_bytes(data) for data in downloads]
+            try:
+                content_store.add_derivatives(stored_images, image_processor)
+            except Exception as e:
+                # the stored pictures are left to maintenance.collect_blobs
+                print(e)
+                return {
+                    "Message": f"Could not decode the study pictures: {e}"
+                }, 400
+
+        #  save the study pictures
+        image_urls = list()
+        images = list()
+        for picture_key, data, stored in zip(picture_keys, downloads, stored_images):
+            picture = payload[picture_key]
+            try:
+                if int(picture["acetic_acid"]):
+                    image_label = "Stained with acetic acid"
+                else:
+                    image_label = "Not stained with acetic acid"
+                image_url, image = create_image(folder_exists, data, stored, picture["request_image_url"],
+                                                folder.name, folder.id, dataset.id, image_label, picture_key,
+                                                base_url)
+            except ValueError:
+                return {
+                    "Message": f"Could not download {picture_key}: {picture['request_image_url']}"
+                }, 400
+            image_urls.append(image_url)
+            images.append(image)
+
+        #  reuse cached predictions and predict the rest in one forward pass
+        cache_keys = [PredictionCache.key(data, predict.model_version, payload["positive_threshold"])
+                      for data in downloads]
+        predictions = [prediction_cache.get(key) for key in cache_keys]
+        cache_hits = [pred is not None for pred in predictions]
+        misses = [i for i, hit in enumerate(cache_hits) if not hit]
+        if misses:
+            results = predict_batch([images[i] for i in misses], payload["positive_threshold"])
+            for i, result in zip(misses, results):
+                predictions[i] = result["predictions"]
+                prediction_cache.set(cache_keys[i], predictions[i])
+        predicted_classes = [pred["class"] for pred in predictions]
 
         def most_frequent(List):
             return max(set(List), key=List.count)
@@ -143,44 +163,88 @@ def upload_data():
             predicted_class = "Not sure"
         else:
             predicted_class = str(most_frequent(predicted_classes))
-        response = jsonify({
-            "model_version": "2.0.0",
+        result = {
+            "model_version": predict.model_version,
             "positive_threshold": payload["positive_threshold"],
             "study_id": payload["study_id"],
             "via_result": predicted_class,
-            "picture1_before": {
-                "request_image_url": image1_url,
-                "pred_class": pred1["class"],
-                "negative_confidence": pred1["negative_confidence"],
-                "positive_confidence": pred1["positive_confidence"],
-            },
-            "picture2_before": {
-                "request_image_url": image2_url,
-                "pred_class": pred2["class"],
-                "negative_confidence": pred2["negative_confidence"],
-                "positive_confidence": pred2["positive_confidence"],
-            }, "picture3_after": {
-                "request_image_url": image3_url,
-                "pred_class": pred3["class"],
-                "negative_confidence": pred3["negative_confidence"],
-                "positive_confidence": pred3["positive_confidence"],
-            }, "picture4_after": {
-                "request_image_url": image4_url,
-                "pred_class": pred4["class"],
-                "negative_confidence": pred4["negative_confidence"],
-                "positive_confidence": pred4["positive_confidence"],
+            "cache_hit": all(cache_hits),
+        }
+        for picture_key, image_url, pred, hit in zip(picture_keys, image_urls, predictions, cache_hits):
+            result[picture_key] = {
+                "request_image_url": image_url,
+                "pred_class": pred["class"],
+                "negative_confidence": pred["negative_confidence"],
+                "positive_confidence": pred["positive_confidence"],
+                "cache_hit": hit,
             }
-        })
-        return response
+        return result, 200
     except Exception as msg:
-        response = jsonify({
-            "message": f"Exception error: {msg}"
-        })
         print(msg)
-        return response, 400
+        return {
+            "message": f"Exception error: {msg}"
+        }, 400
 
     except AssertionError as msg:
-        response = jsonify({
+        return {
             "message": f"Error: {msg}"
+        }, 400
+
+
+@external_blueprint.route("/upload", methods=["POST"])
+def upload_data():
+    payload = request.get_json()
+    if request.args.get("async") in ("1", "true"):
+        try:
+            validate_study(payload)
+        except AssertionError as msg:
+            response = jsonify({
+                "message": f"Error: {msg}"
+            })
+            response.status_code = 400
+            return response
+        job = IngestionJob(payload=json.dumps(payload), base_url=request.host_url)
+        job.save()
+        get_worker(app._get_current_object(), ingest_study).notify()
+        response = jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": url_for("external.ingestion_job", job_id=job.id, _external=True)
         })
-        return response, 400
+        response.status_code = 202
+        return response
+
+    result, status_code = ingest_study(payload)
+    response = jsonify(result)
+    response.status_code = status_code
+    return response
+
+
+@external_blueprint.route("/upload/jobs/<job_id>", methods=["GET"])
+def ingestion_job(job_id):
+    job = IngestionJob.query.filter_by(id=job_id).first()
+    if not job:
+        abort(404)
+    response = jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "status_code": job.status_code,
+        "attempts": job.attempts,
+        "result": json.loads(job.result) if job.result else None,
+        "date_created": job.date_created,
+        "date_modified": job.date_modified
+    })
+    response.status_code = 200
+    return response
+
+
+@external_blueprint.route("/predict/metrics", methods=["GET"])
+@permission_required()
+def inference_metrics():
+    if predict.scheduler is None:
+        response = jsonify({"loaded": False})
+        response.status_code = 200
+        return response
+    response = jsonify(dict(predict.scheduler.metrics(), loaded=True))
+    response.status_code = 200
+    return response
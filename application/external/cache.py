@@ -0,0 +1,53 @@
+import hashlib
+import json
+
+import redis
+
+from application.utils.lru import TTLCache
+
+
+class PredictionCache(TTLCache):
+    """Caches predictions by image content, model version and threshold.
+
+    Entries live in an in-process LRU with a TTL. When a Redis url is given,
+    predictions are also shared between workers through Redis; a Redis outage
+    only turns lookups into misses.
+    """
+
+    def __init__(self, max_entries=1024, ttl=86400, redis_url=None, redis_ttl=None, prefix="prediction:"):
+        super().__init__(max_entries, ttl)
+        self.redis_ttl = redis_ttl or ttl
+        self.prefix = prefix
+        self.redis = redis.StrictRedis.from_url(redis_url) if redis_url else None
+
+    @staticmethod
+    def key(data, model_version, positive_threshold):
+        """Builds the cache key for the image bytes in data"""
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{digest}:{model_version}:{positive_threshold}"
+
+    def get(self, key):
+        """Returns the cached prediction for key, or None"""
+        value = super().get(key)
+        if value is not None:
+            return value
+        if self.redis is not None:
+            try:
+                cached = self.redis.get(self.prefix + key)
+            except redis.RedisError as e:
+                print("Prediction cache unavailable: ", e)
+                return None
+            if cached is not None:
+                value = json.loads(cached)
+                self.add(key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        """Caches value under key in every tier"""
+        self.add(key, value)
+        if self.redis is not None:
+            try:
+                self.redis.set(self.prefix + key, json.dumps(value), ex=int(self.redis_ttl))
+            except redis.RedisError as e:
+                print("Prediction cache unavailable: ", e)
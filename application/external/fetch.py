@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class FetchError(ValueError):
+    """Raised when one of the study pictures cannot be downloaded"""
+
+    def __init__(self, url, index, reason):
+        super(FetchError, self).__init__(f"Could not download {url}: {reason}")
+        self.url = url
+        self.index = index
+
+
+class Fetcher(object):
+    """Downloads study pictures concurrently over a pooled keep-alive session."""
+
+    def __init__(self, pool_size=16, timeout=(5, 30)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="fetch")
+
+    def fetch(self, url):
+        """Returns the body of url as bytes"""
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def fetch_all(self, urls):
+        """Downloads all urls at the same time and returns their bodies in order"""
+        futures = [self.executor.submit(self.fetch, url) for url in urls]
+        results = list()
+        for index, (url, future) in enumerate(zip(urls, futures)):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                raise FetchError(url, index, e)
+        return results
@@ -0,0 +1,73 @@
+import json
+import threading
+
+from application import db
+from application.models import IngestionJob
+from application.utils.background import BackgroundWorker, per_process
+
+
+class IngestionWorker(BackgroundWorker):
+    """Runs queued study ingestions outside the request that submitted them.
+
+    Jobs are claimed from the ingestion_jobs table with SKIP LOCKED, so any
+    number of these workers, in the web processes or in separate
+    ``manage.py ingest_worker`` processes, can share the queue. A running
+    job is touched every stale_after / 3 seconds, and one left by a worker
+    that stopped is picked up again, at most max_attempts times in all.
+    """
+
+    name = "ingestion-worker"
+
+    def __init__(self, app, ingest, threads=1, poll_interval=1.0, stale_after=600, max_attempts=3):
+        super().__init__(app, threads, poll_interval)
+        self.ingest = ingest
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+
+    def run_once(self):
+        """Processes one queued job, returns False when the queue is empty"""
+        with self.app.app_context():
+            job = IngestionJob.claim(self.stale_after, self.max_attempts)
+            if job is None:
+                return False
+            print(f"Running ingestion job {job.id}")
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job.id, done), daemon=True)
+            heartbeat.start()
+            try:
+                # urls are made for the host the study was submitted to
+                result, status_code = self.ingest(json.loads(job.payload), job.base_url)
+            except Exception as e:
+                print(e)
+                db.session.rollback()
+                result, status_code = {"message": f"Exception error: {e}"}, 500
+            finally:
+                done.set()
+                heartbeat.join()
+            job.result = json.dumps(result)
+            job.status_code = status_code
+            job.status = "done" if status_code < 400 else "failed"
+            db.session.commit()
+        return True
+
+    def _heartbeat(self, job_id, done):
+        """Keeps a running job from looking abandoned until done is set"""
+        while not done.wait(self.stale_after / 3):
+            try:
+                with self.app.app_context():
+                    IngestionJob.heartbeat(job_id)
+            except Exception as e:
+                print("Ingestion heartbeat error: ", e)
+
+
+@per_process
+def get_worker(app, ingest):
+    """Returns this process's in-process ingestion worker"""
+    return IngestionWorker(
+        app,
+        ingest,
+        threads=app.config.get("INGESTION_WORKER_THREADS", 1),
+        poll_interval=app.config.get("INGESTION_POLL_INTERVAL", 1.0),
+        stale_after=app.config.get("INGESTION_JOB_TIMEOUT", 600),
+        max_attempts=app.config.get("INGESTION_MAX_ATTEMPTS", 3),
+    )
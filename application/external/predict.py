@@ -1,12 +1,14 @@
 from urllib.request import urlopen
 from datetime import datetime
-import tensorflow as tf
 from PIL import Image
 import os
+import threading
 import numpy as np
 import sys
 
-import mscviplib
+from werkzeug.utils import import_string
+
+from .scheduler import InferenceScheduler
 
 
 filename = os.path.join(os.getcwd(),"application", "external","saved_model", "saved_model.pb")
@@ -14,35 +16,112 @@ labels_filename = os.path.join(os.getcwd(),"application", "external", "labels.tx
 
 network_input_size = 1024
 
+model_version = "2.0.0"
+
 output_layer = "model_output:0"
 input_node = "data:0"
 
-graph_def = tf.compat.v1.GraphDef()
 labels = []
+runtime = None
+scheduler = None
 
+# how the model gets loaded, set from the app config by configure()
+settings = {
+    "runtime_factory": "application.external.predict:ModelRuntime",
+    "max_batch_size": 8,
+    "max_wait_ms": 5,
+}
+_load_lock = threading.Lock()
 
-def initialize():
-    print("Loading model...", end=""),
-    with open(filename, "rb") as f:
-        graph_def.ParseFromString(f.read())
-        tf.import_graph_def(graph_def, name="")
 
-    # Retrieving 'network_input_size' from shape of 'input_node'
-    with tf.compat.v1.Session() as sess:
-        input_tensor_shape = sess.graph.get_tensor_by_name(input_node).shape.as_list()
+class ModelRuntime(object):
+    """Keeps the imported graph and a long-lived session for inference.
+
+    The graph is imported and finalized once, and the input/output tensors are
+    resolved up front, so each prediction only pays for ``sess.run``.
+    ``Session.run`` is thread-safe, so a single runtime is shared by all the
+    request threads of a worker.
+    """
+
+    def __init__(self, model_filename, labels_filename):
+        import tensorflow as tf
+
+        graph_def = tf.compat.v1.GraphDef()
+        with open(model_filename, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.input_tensor = self.graph.get_tensor_by_name(input_node)
+        self.output_tensor = self.graph.get_tensor_by_name(output_layer)
+        self.graph.finalize()
+
+        # Retrieving 'network_input_size' from shape of 'input_node'
+        input_tensor_shape = self.input_tensor.shape.as_list()
+        assert len(input_tensor_shape) == 4
+        assert input_tensor_shape[1] == input_tensor_shape[2]
+        self.network_input_size = input_tensor_shape[1]
+
+        with open(labels_filename, "rt") as lf:
+            self.labels = [l.strip() for l in lf.readlines()]
+
+        self.session = tf.compat.v1.Session(graph=self.graph)
 
-    assert len(input_tensor_shape) == 4
-    assert input_tensor_shape[1] == input_tensor_shape[2]
+    def run(self, batch):
+        """Runs a forward pass over a batch of preprocessed images"""
+        return self.session.run(self.output_tensor, {self.input_tensor: batch})
 
-    global network_input_size
-    network_input_size = input_tensor_shape[1]
+    def close(self):
+        self.session.close()
 
+
+def configure(app):
+    """Reads the model settings from the app config without loading the model.
+    MODEL_RUNTIME_FACTORY may be a callable or an import string, and is called
+    with the model and labels filenames to build the runtime."""
+    settings["runtime_factory"] = app.config.get("MODEL_RUNTIME_FACTORY", settings["runtime_factory"])
+    settings["max_batch_size"] = app.config.get("INFERENCE_MAX_BATCH_SIZE", settings["max_batch_size"])
+    settings["max_wait_ms"] = app.config.get("INFERENCE_MAX_WAIT_MS", settings["max_wait_ms"])
+
+
+def initialize():
+    print("Loading model...", end=""),
+    global runtime, scheduler, network_input_size, labels
+    if runtime is not None:
+        runtime.close()
+    factory = settings["runtime_factory"]
+    if isinstance(factory, str):
+        factory = import_string(factory)
+    runtime = factory(filename, labels_filename)
+    network_input_size = runtime.network_input_size
     print("Success!")
     print("Loading labels...", end="")
-    with open(labels_filename, "rt") as lf:
-        global labels
-        labels = [l.strip() for l in lf.readlines()]
+    labels = runtime.labels
     print(len(labels), "found. Success!")
+    # published last, get_scheduler() treats a scheduler as a fully loaded model
+    scheduler = InferenceScheduler(
+        runtime.run,
+        max_batch_size=settings["max_batch_size"],
+        max_wait_ms=settings["max_wait_ms"],
+    )
+
+
+def get_scheduler():
+    """Returns the inference scheduler, loading the model on first use"""
+    if scheduler is None:
+        with _load_lock:
+            if scheduler is None:
+                initialize()
+    return scheduler
+
+
+def warmup():
+    """Loads the model in the background so the first prediction does not pay for it.
+    Safe to call from a uWSGI worker after fork."""
+    thread = threading.Thread(target=get_scheduler, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
 
 
 def log_msg(msg):
@@ -82,14 +161,12 @@ def update_orientation(image):
     return image
 
 
-def predict_image(image, positive_thres):
+def preprocess_image(image):
     """
-    calls model's image prediction
+    prepares a PIL image for the network
     image: input PIL image
-    returns prediction response as a dictionary. To get predictions, use result['predictions'][i]['tagName'] and result['predictions'][i]['probability']
+    returns a [network_input_size, network_input_size, 3] tensor
     """
-    log_msg("Predicting image")
-    # try:
     if image.mode != "RGB":
         log_msg("Converting to RGB")
         image = image.convert("RGB")
@@ -99,6 +176,7 @@ def predict_image(image, positive_thres):
 
     # Update orientation based on EXIF tags
     image = update_orientation(image)
+    import mscviplib
     metadata = mscviplib.GetImageMetadata(image)
     cropped_image = mscviplib.PreprocessForInferenceAsTensor(
         metadata,
@@ -110,62 +188,33 @@ def predict_image(image, positive_thres):
         (),
         (),
     )
-    cropped_image = np.moveaxis(cropped_image, 0, -1)
-
-    tf.compat.v1.reset_default_graph()
-    tf.import_graph_def(graph_def, name="")
-
-    with tf.compat.v1.Session() as sess:
-        prob_tensor = sess.graph.get_tensor_by_name(output_layer)
-        (predictions,) = sess.run(prob_tensor, {input_node: [cropped_image]})
-
-        result = []
-        for p, label in zip(predictions, labels):
-            truncated_probablity = np.float64(round(p, 8))
-            if truncated_probablity > 1e-8:
-                result.append(
-                    {
-                        "tagName": label,
-                        "probability": truncated_probablity
-                    }
-                )
-        log_msg(f"Resulting arrary: {str(result)}")
-        if len(result) == 1:
-            if "Negative" in result[0]["tagName"]:
-                predicted_name = "Negative"
-                neg_prob = round(result[0]["probability"], 4)
-                pos_prob = 1 - neg_prob
-            else:
-                predicted_name = "Positive"
-                pos_prob = round(result[0]["probability"], 4)
-                neg_prob = 1 - pos_prob
-
-            response = {
-                "id": "",
-                "project": "",
-                "iteration": "",
-                "created": datetime.utcnow().isoformat(),
-                "predictions": {
-                    "class": predicted_name,
-                    "negative_confidence": neg_prob,
-                    "positive_confidence": pos_prob
-                },
-            }
-            log_msg("Results: " + str(response))
-            return response
-
-           
-        if result[0]["probability"] > result[1]["probability"]:
-            # predicted_dict = result[0]
+    return np.moveaxis(cropped_image, 0, -1)
+
+
+def format_prediction(predictions):
+    """
+    turns the network output for one image into the prediction response
+    """
+    result = []
+    for p, label in zip(predictions, labels):
+        truncated_probablity = np.float64(round(p, 8))
+        if truncated_probablity > 1e-8:
+            result.append(
+                {
+                    "tagName": label,
+                    "probability": truncated_probablity
+                }
+            )
+    log_msg(f"Resulting arrary: {str(result)}")
+    if len(result) == 1:
+        if "Negative" in result[0]["tagName"]:
             predicted_name = "Negative"
+            neg_prob = round(result[0]["probability"], 4)
+            pos_prob = 1 - neg_prob
         else:
-            # predicted_dict = result[1]
-            #
-            # if positive_thres > result[1]["probability"]:
-            #     predicted_name = "Negative"
-            # else:
             predicted_name = "Positive"
-
+            pos_prob = round(result[0]["probability"], 4)
+            neg_prob = 1 - pos_prob
 
         response = {
             "id": "",
@@ -174,18 +223,63 @@ def predict_image(image, positive_thres):
             "created": datetime.utcnow().isoformat(),
             "predictions": {
                 "class": predicted_name,
-                "negative_confidence": round(result[0]["probability"], 4),
-                "positive_confidence": round(result[1]["probability"], 4)
+                "negative_confidence": neg_prob,
+                "positive_confidence": pos_prob
             },
         }
-
         log_msg("Results: " + str(response))
         return response
 
-    # except Exception as e:
-        # print("Error :", e)
-        # log_msg("Exception: " +str(e))
-        # return "Error: Could not preprocess image for prediction. " + str(e)
+    if result[0]["probability"] > result[1]["probability"]:
+        # predicted_dict = result[0]
+        predicted_name = "Negative"
+    else:
+        # predicted_dict = result[1]
+        #
+        # if positive_thres > result[1]["probability"]:
+        #     predicted_name = "Negative"
+        # else:
+        predicted_name = "Positive"
+
+    response = {
+        "id": "",
+        "project": "",
+        "iteration": "",
+        "created": datetime.utcnow().isoformat(),
+        "predictions": {
+            "class": predicted_name,
+            "negative_confidence": round(result[0]["probability"], 4),
+            "positive_confidence": round(result[1]["probability"], 4)
+        },
+    }
+
+    log_msg("Results: " + str(response))
+    return response
+
+
+def predict_image(image, positive_thres):
+    """
+    calls model's image prediction
+    image: input PIL image
+    returns prediction response as a dictionary. To get predictions, use result['predictions'][i]['tagName'] and result['predictions'][i]['probability']
+    """
+    log_msg("Predicting image")
+    get_scheduler()
+    cropped_image = preprocess_image(image)
+    predictions = scheduler.submit(cropped_image).result()
+    return format_prediction(predictions)
+
+
+def predict_batch(images, positive_thres):
+    """
+    predicts several images together, in a single forward pass when they fit in one scheduler batch
+    images: list of input PIL images
+    returns a list of prediction responses in the same order as images
+    """
+    log_msg(f"Predicting batch of {len(images)} images")
+    get_scheduler()
+    futures = scheduler.submit_many([preprocess_image(image) for image in images])
+    return [format_prediction(future.result()) for future in futures]
 
 
 def predict_url(imageUrl, pos_thres):
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+import numpy as np
+
+
+class InferenceScheduler(object):
+    """Gathers preprocessed images from concurrent request threads into batches.
+
+    Callers submit tensors and block on the returned futures. A single worker
+    thread takes whatever is queued, waits up to ``max_wait_ms`` for more to
+    arrive, and runs at most ``max_batch_size`` images through ``run_batch`` in
+    one forward pass. Every caller then gets its own row of the output.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5, samples=1000):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._batch_sizes = dict()
+        self._waits = deque(maxlen=samples)
+        self._batches = 0
+        self._images = 0
+
+    def submit(self, tensor):
+        """Queues one preprocessed image and returns a future of its output"""
+        return self.submit_many([tensor])[0]
+
+    def submit_many(self, tensors):
+        """Queues several images together so they land in the same batch when they fit"""
+        self._ensure_started()
+        futures = list()
+        enqueued = time.perf_counter()
+        with self._lock:
+            for tensor in tensors:
+                future = Future()
+                self._queue.put((tensor, future, enqueued))
+                futures.append(future)
+        return futures
+
+    def metrics(self):
+        """Returns queue depth, batch-size histogram and queue wait times"""
+        with self._lock:
+            waits = np.array(self._waits) * 1000
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": self._batches,
+                "images": self._images,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "wait_ms": {
+                    "samples": len(waits),
+                    "mean": float(waits.mean()) if len(waits) else 0.0,
+                    "p50": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                    "p99": float(np.percentile(waits, 99)) if len(waits) else 0.0,
+                    "max": float(waits.max()) if len(waits) else 0.0,
+                },
+            }
+
+    def _ensure_started(self):
+        # started lazily so the thread is created in the process that serves requests
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name="inference-scheduler", daemon=True)
+                    self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            with self._lock:
+                self._batches += 1
+                self._images += len(batch)
+                self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+                self._waits.extend(started - enqueued for _, _, enqueued in batch)
+            try:
+                outputs = self.run_batch(np.stack([tensor for tensor, _, _ in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), output in zip(batch, outputs):
+                    future.set_result(output)
@@ -0,0 +1,276 @@
+import datetime
+import random
+
+from flask import current_app, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from application import db
+from application.models import Annotation, Dataset, Image, LabelTask
+from application.progress import _id
+from application.stats import dataset_image_counts, user_annotation_counts
+
+# random ids tried per call of next_unlabelled_images before it walks the index
+max_probes = 2000
+
+
+def queue_size():
+    """Returns ?count=, bounded by the LABELLING_QUEUE_SIZE and MAX_PAGE_SIZE settings"""
+    count = request.args.get("count", type=int) or current_app.config.get("LABELLING_QUEUE_SIZE", 20)
+    return min(max(count, 1), current_app.config.get("MAX_PAGE_SIZE", 1000))
+
+
+def unlabelled_images(dataset_id, user_id):
+    """Query of the images of a dataset the user has not annotated, as an anti-join"""
+    annotated = db.exists().where(db.and_(Annotation.image_id == Image.id, Annotation.user_id == user_id))
+    return Image.query.filter(Image.dataset_id == dataset_id, ~annotated)
+
+
+def next_unlabelled_images(dataset_id, user_id, count):
+    """Returns up to count images of a dataset the user has not annotated yet, in random order.
+
+    Instead of ordering the whole dataset by random() this probes random ids
+    between the dataset's smallest and largest, both read off the
+    (dataset_id, id) index, and keeps the ones that are unlabelled images of
+    the dataset. Every unlabelled image is as likely to be hit, however the
+    ids around it are spread. The number of probes comes from the progress
+    counters, so that they are expected to hit about three times count images.
+
+    Probes are capped at max_probes, so once the user has labelled nearly all
+    of a large dataset the rest is made up by walking the index from a random
+    id, wrapping around to the start when it runs out. That walk favours the
+    images right after long runs of labelled or missing ids, but it also finds
+    every remaining image. The cost depends on count and on how much of the
+    dataset the user has labelled, not on the size of the dataset.
+    """
+    low, high = db.session.query(db.func.min(Image.id), db.func.max(Image.id)).filter(
+        Image.dataset_id == dataset_id
+    ).one()
+    if low is None:
+        return []
+    span = high - low + 1
+    images = dataset_image_counts([dataset_id]).get(dataset_id, (0, span))[1]
+    unlabelled = images - user_annotation_counts(user_id, [dataset_id]).get(dataset_id, 0)
+    picked = dict()
+    if unlabelled > 0:
+        # each probe hits an unlabelled image with a chance of unlabelled / span
+        probes = min(span, int(3 * count * span / unlabelled) + 1, max_probes)
+        ids = set(random.randint(low, high) for _ in range(probes))
+        hits = unlabelled_images(dataset_id, user_id).filter(Image.id.in_(ids)).all()
+        for image in random.sample(hits, min(count, len(hits))):
+            picked[image.id] = image
+    if len(picked) < count:
+        start = random.randint(low, high)
+        query = unlabelled_images(dataset_id, user_id).order_by(Image.id)
+        if picked:
+            query = query.filter(~Image.id.in_(list(picked)))
+        rest = query.filter(Image.id >= start).limit(count - len(picked)).all()
+        if len(picked) + len(rest) < count:
+            rest += query.filter(Image.id < start).limit(count - len(picked) - len(rest)).all()
+        picked.update((image.id, image) for image in rest)
+    images = list(picked.values())
+    random.shuffle(images)
+    return images
+
+
+def labelled_images(dataset_id, user_id):
+    """Query of (annotation id, image id, image url, annotations) for the images the user annotated"""
+    return db.session.query(
+        Annotation.id.label("annotation_id"), Image.id, Image.image_URL, Annotation.annotations
+    ).join(Image, Image.id == Annotation.image_id).filter(
+        Annotation.user_id == user_id, Annotation.dataset_id == dataset_id
+    )
+
+
+# Work queue
+#
+# An image has one label_tasks row for every annotation it still needs to reach
+# the target_annotations of its dataset. Annotators claim tasks with
+# SELECT ... FOR UPDATE SKIP LOCKED, so concurrent claims pass over each
+# other's rows instead of waiting on them, and hold them under a lease until
+# they label the image, renew or release the lease, or let it expire.
+
+sync_tasks_sql = """
+WITH needed AS (
+    SELECT images.id AS image_id, images.dataset_id,
+           greatest(datasets.target_annotations
+                    - (SELECT count(DISTINCT annotation.user_id) FROM annotation
+                       WHERE annotation.image_id = images.id), 0) AS needed
+    FROM images JOIN datasets ON datasets.id = images.dataset_id
+    {where}
+), surplus AS (
+    DELETE FROM label_tasks WHERE id IN (
+        SELECT id FROM (
+            SELECT label_tasks.id, needed.needed,
+                   row_number() OVER (PARTITION BY label_tasks.image_id
+                                      ORDER BY label_tasks.leased_by IS NOT NULL DESC, label_tasks.id) AS n
+            FROM label_tasks JOIN needed ON needed.image_id = label_tasks.image_id
+        ) tasks WHERE n > needed)
+    RETURNING image_id
+)
+INSERT INTO label_tasks (dataset_id, image_id)
+SELECT needed.dataset_id, needed.image_id
+FROM needed CROSS JOIN LATERAL generate_series(
+    1, needed.needed - (SELECT count(*) FROM label_tasks WHERE label_tasks.image_id = needed.image_id))
+"""
+
+new_tasks_sql = """
+INSERT INTO label_tasks (dataset_id, image_id)
+SELECT datasets.id, :image_id FROM datasets CROSS JOIN generate_series(1, datasets.target_annotations)
+WHERE datasets.id = :dataset_id
+"""
+
+# the task of the image the user holds, or else any task nobody holds
+complete_task_sql = """
+DELETE FROM label_tasks WHERE id = (
+    SELECT id FROM label_tasks
+    WHERE image_id = :image_id
+      AND (leased_by = :user_id OR leased_by IS NULL OR lease_expires_at <= current_timestamp)
+    ORDER BY leased_by IS NOT DISTINCT FROM :user_id DESC, id
+    LIMIT 1 FOR UPDATE)
+"""
+
+
+def sync_tasks(connection, dataset_ids=None, image_ids=None):
+    """Adds or removes the tasks of the given datasets or images, or of every image,
+    so that each image has one per annotation it still needs. Leased tasks are kept."""
+    if dataset_ids is None and image_ids is None:
+        connection.execute(text(sync_tasks_sql.format(where="")))
+    elif dataset_ids:
+        connection.execute(text(sync_tasks_sql.format(where="WHERE images.dataset_id = ANY(:ids)")),
+                           {"ids": sorted(dataset_ids)})
+    elif image_ids:
+        connection.execute(text(sync_tasks_sql.format(where="WHERE images.id = ANY(:ids)")),
+                           {"ids": sorted(image_ids)})
+
+
+def complete_task(connection, image_id, user_id):
+    """Removes the task a new annotation of the user fulfils"""
+    connection.execute(text(complete_task_sql), {"image_id": image_id, "user_id": user_id})
+
+
+def lease_duration():
+    return datetime.timedelta(seconds=current_app.config.get("LABEL_LEASE_SECONDS", 600))
+
+
+def claim_tasks(dataset_id, user_id, count, attempts=3):
+    """Leases up to count images of a dataset to the user, at most one task of an image.
+
+    Tasks are read from the (dataset_id, id) index starting at a random id,
+    like next_unlabelled_images, so that annotators asking at the same time
+    start on different parts of the dataset rather than all skipping over the
+    rows locked at its start. Returns (image_id, lease_expires_at) rows of the
+    leased tasks, committed.
+
+    SKIP LOCKED also passes over the uncommitted lease of a concurrent claim
+    by the same user, so two claims could lease two tasks of one image. The
+    unique (image_id, leased_by) index turns that into an IntegrityError, and
+    the claim is retried once the other one has committed.
+    """
+    for attempt in range(attempts):
+        try:
+            return _claim_tasks(dataset_id, user_id, count)
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+def _claim_tasks(dataset_id, user_id, count):
+    low, high = db.session.query(db.func.min(LabelTask.id), db.func.max(LabelTask.id)).filter(
+        LabelTask.dataset_id == dataset_id
+    ).one()
+    if low is None:
+        return []
+    target = db.session.query(Dataset.target_annotations).filter(Dataset.id == dataset_id).scalar()
+    now = db.func.current_timestamp()
+    # the user's expired leases are given up, so that leasing another task of
+    # one of those images does not collide with them on the unique index
+    LabelTask.query.filter(
+        LabelTask.dataset_id == dataset_id, LabelTask.leased_by == user_id, LabelTask.lease_expires_at <= now
+    ).update({LabelTask.leased_by: None, LabelTask.lease_expires_at: None}, synchronize_session=False)
+    held = aliased(LabelTask)
+    query = db.session.query(LabelTask.id, LabelTask.image_id).filter(
+        LabelTask.dataset_id == dataset_id,
+        db.or_(LabelTask.leased_by.is_(None), LabelTask.lease_expires_at <= now),
+        ~db.exists().where(db.and_(Annotation.image_id == LabelTask.image_id, Annotation.user_id == user_id)),
+        ~db.exists().where(db.and_(held.image_id == LabelTask.image_id, held.leased_by == user_id,
+                                   held.lease_expires_at > now)),
+    ).order_by(LabelTask.id).with_for_update(skip_locked=True, of=LabelTask)
+    # the tasks of an image sit next to each other, enough rows are read to
+    # find count images when each of them still needs every annotation
+    start = random.randint(low, high)
+    limit = count * max(target, 1)
+    tasks = query.filter(LabelTask.id >= start).limit(limit).all()
+    if len(tasks) < limit:
+        tasks += query.filter(LabelTask.id < start).limit(limit - len(tasks)).all()
+    claimed, images = list(), set()
+    for task_id, image_id in tasks:
+        if image_id not in images and len(claimed) < count:
+            images.add(image_id)
+            claimed.append(task_id)
+    if not claimed:
+        db.session.commit()
+        return []
+    leased = db.session.execute(
+        LabelTask.__table__.update()
+        .where(LabelTask.id.in_(claimed))
+        .values(leased_by=user_id, lease_expires_at=now + lease_duration())
+        .returning(LabelTask.image_id, LabelTask.lease_expires_at)
+    ).fetchall()
+    db.session.commit()
+    return leased
+
+
+def renew_tasks(dataset_id, user_id, image_ids=None):
+    """Extends the user's unexpired leases in a dataset, or those of some of its images.
+    Returns how many were renewed."""
+    now = db.func.current_timestamp()
+    query = LabelTask.query.filter(
+        LabelTask.dataset_id == dataset_id, LabelTask.leased_by == user_id, LabelTask.lease_expires_at > now
+    )
+    if image_ids is not None:
+        query = query.filter(LabelTask.image_id.in_(image_ids))
+    renewed = query.update({LabelTask.lease_expires_at: now + lease_duration()}, synchronize_session=False)
+    db.session.commit()
+    return renewed
+
+
+def release_tasks(dataset_id, user_id, image_ids=None):
+    """Gives up the user's leases in a dataset, or those of some of its images"""
+    query = LabelTask.query.filter(LabelTask.dataset_id == dataset_id, LabelTask.leased_by == user_id)
+    if image_ids is not None:
+        query = query.filter(LabelTask.image_id.in_(image_ids))
+    released = query.update({LabelTask.leased_by: None, LabelTask.lease_expires_at: None},
+                            synchronize_session=False)
+    db.session.commit()
+    return released
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def update_tasks(session, flush_context):
+    """Adds the tasks of new images, completes a task for each new annotation and
+    gives back the task of deleted ones, in the transaction of the flush"""
+    connection = session.connection()
+    new_images, completed, resync_images, resync_datasets = list(), list(), set(), set()
+    for obj in session.new:
+        if isinstance(obj, Image) and _id(obj.dataset_id) is not None:
+            new_images.append({"image_id": obj.id, "dataset_id": _id(obj.dataset_id)})
+        elif isinstance(obj, Annotation) and obj.user_id is not None and obj.image_id is not None:
+            completed.append({"image_id": _id(obj.image_id), "user_id": _id(obj.user_id)})
+    for obj in session.deleted:
+        if isinstance(obj, Annotation) and obj.image_id is not None:
+            resync_images.add(_id(obj.image_id))
+    for obj in session.dirty:
+        if isinstance(obj, Dataset) and inspect(obj).attrs.target_annotations.history.has_changes():
+            resync_datasets.add(obj.id)
+    if new_images:
+        connection.execute(text(new_tasks_sql), new_images)
+    for params in completed:
+        complete_task(connection, **params)
+    if resync_images:
+        sync_tasks(connection, image_ids=resync_images)
+    if resync_datasets:
+        sync_tasks(connection, dataset_ids=resync_datasets)
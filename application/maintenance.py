@@ -0,0 +1,64 @@
+import time
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from application.models import BlackListToken, Image
+
+scheduler = None
+
+
+def prune_blacklist(app):
+    """Deletes the blacklist entries of tokens that have expired"""
+    with app.app_context():
+        pruned = BlackListToken.prune()
+        if pruned:
+            print(f"Pruned {pruned} expired blacklisted tokens")
+
+
+def collect_blobs(app, grace=None, batch_size=500):
+    """Deletes the stored images that no Image row points at and that were not
+    written for BLOB_GC_GRACE seconds, returns how many were deleted"""
+    from application.admin import content_store
+
+    grace = app.config.get("BLOB_GC_GRACE", 86400) if grace is None else grace
+    removed = 0
+    with app.app_context():
+        digests = list()
+        for digest, _ in content_store.digests(older_than=time.time() - grace):
+            digests.append(digest)
+            if len(digests) >= batch_size:
+                removed += _remove_unreferenced(content_store, digests)
+                digests = list()
+        removed += _remove_unreferenced(content_store, digests)
+    if removed:
+        print(f"Removed {removed} unreferenced stored images")
+    return removed
+
+
+def _remove_unreferenced(content_store, digests):
+    if not digests:
+        return 0
+    referenced = set(digest for digest, in Image.query.with_entities(Image.content_hash)
+                     .filter(Image.content_hash.in_(digests)).distinct())
+    unreferenced = [digest for digest in digests if digest not in referenced]
+    for digest in unreferenced:
+        content_store.remove(digest)
+    return len(unreferenced)
+
+
+def start(app):
+    """Schedules the housekeeping jobs in this process, every BLACKLIST_PRUNE_INTERVAL
+    seconds for the blacklist pruning and every BLOB_GC_INTERVAL seconds for the
+    stored image collection; 0 turns a job off"""
+    global scheduler
+    jobs = [(prune_blacklist, app.config.get("BLACKLIST_PRUNE_INTERVAL", 3600)),
+            (collect_blobs, app.config.get("BLOB_GC_INTERVAL", 0))]
+    jobs = [(job, interval) for job, interval in jobs if interval]
+    if not jobs or scheduler is not None:
+        return
+    scheduler = BackgroundScheduler(daemon=True)
+    for job, interval in jobs:
+        # every worker runs them, the jitter spreads them out and both are idempotent
+        scheduler.add_job(job, "interval", args=[app], seconds=interval, jitter=interval // 10,
+                          id=job.__name__, coalesce=True, max_instances=1)
+    scheduler.start()
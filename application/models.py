@@ -1,9 +1,16 @@
 from application import db
 # from flask_user import UserMixin
-from flask_bcrypt import Bcrypt
+from application.utils.passwords import password_hasher
 import jwt
 from flask import current_app
 from datetime import datetime, timedelta
+from sqlalchemy.dialects.postgresql import insert
+import hashlib
+import json
+import uuid
+
+# how long an access token from User.generate_token is valid
+TOKEN_LIFETIME = timedelta(minutes=300)
 
 class Project(db.Model):
     """Represents projects' table"""
@@ -71,6 +78,8 @@ class Dataset(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey(Project.id, ondelete="CASCADE"), default=0)
     classes = db.Column(db.ARRAY(db.String))
     classes2 = db.Column(db.ARRAY(db.String))
+    # how many users should annotate each image, see application.labelling
+    target_annotations = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
     date_modified = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
 
@@ -123,15 +132,20 @@ class User(db.Model):
     project_admin = db.Column(db.String, default="")
     site = db.Column(db.String, default="Not specified")
 
+    __table_args__ = (
+        db.Index("ix_users_site", "site"),
+        db.Index("ix_users_project_id", "project_id"),
+    )
+
     def __init__(self, email, password, is_admin):
         """Initialize the user with an email, username and a password"""
         self.email = email
-        self.password = Bcrypt().generate_password_hash(password).decode()
+        self.password = password_hasher.hash(password)
         self.is_admin = is_admin
 
     def password_is_valid(self, password):
         """Checks password against it's hash"""
-        return Bcrypt().check_password_hash(self.password, password)
+        return password_hasher.check(self.password, password)
 
     def save(self):
         """Save a user to the database"""
@@ -152,7 +166,7 @@ class User(db.Model):
         try:
             # set up a payload with an expiration time
             payload = {
-                'exp': datetime.utcnow() + timedelta(minutes=300),
+                'exp': datetime.utcnow() + TOKEN_LIFETIME,
                 'iat': datetime.utcnow(),
                 'sub': user_id
             }
@@ -195,6 +209,15 @@ class Item(db.Model):
     labelled = db.Column(db.Boolean)
     labelled_by = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"))
 
+    __table_args__ = (
+        # dataset listings and folder lookups by name within a dataset
+        db.Index("ix_data_items_dataset_id_name", "dataset_id", "name"),
+        # bulk uploads and external studies resolve folders by name only
+        db.Index("ix_data_items_name", "name"),
+        db.Index("ix_data_items_labelled_by", "labelled_by"),
+        db.Index("ix_data_items_dataset_id_labelled", "dataset_id", postgresql_where=db.text("labelled")),
+    )
+
     def __init__(self, dataset_id, name):
         """Initialize with dataset_id, label, comment, labelled_status"""
         self.dataset_id = dataset_id
@@ -238,6 +261,21 @@ class Image(db.Model):
     labelled = db.Column(db.Boolean)
     labelled_by = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"))
     dataset_id = db.Column(db.Integer, db.ForeignKey(Dataset.id, ondelete="CASCADE"))
+    # sha256 of the stored file, shared by every row with the same content
+    content_hash = db.Column(db.String(64), index=True)
+    byte_size = db.Column(db.BigInteger)
+
+    __table_args__ = (
+        # also serves the smallest and largest id of a dataset and walks in id order
+        db.Index("ix_images_dataset_id_id", "dataset_id", "id"),
+        db.Index("ix_images_item_id", "item_id"),
+        db.Index("ix_images_labelled_by_dataset_id", "labelled_by", "dataset_id"),
+        # labelled, has_box and folder_labelled are all set once an image is fully labelled
+        db.Index("ix_images_dataset_id_complete", "dataset_id",
+                 postgresql_where=db.text("labelled AND has_box AND folder_labelled")),
+        db.Index("ix_images_item_id_complete", "item_id",
+                 postgresql_where=db.text("labelled AND has_box AND folder_labelled")),
+    )
 
     def __init__(self, image_URL, name):
         """Initialize image with data item ID and image URL"""
@@ -272,6 +310,11 @@ class Assignment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"))
     dataset_id = db.Column(db.Integer, db.ForeignKey(Dataset.id, ondelete="CASCADE"))
 
+    __table_args__ = (
+        db.Index("ix_assignments_user_id_dataset_id", "user_id", "dataset_id"),
+        db.Index("ix_assignments_dataset_id", "dataset_id"),
+    )
+
     def __init__(self, user_id, dataset_id):
         """Initialises an assignment with user_id and dataset_id"""
         self.user_id = user_id
@@ -294,34 +337,61 @@ class Assignment(db.Model):
 
 
 class BlackListToken(db.Model):
-    """Model stores blacklisted tokens"""
+    """Model stores blacklisted tokens by their SHA-256, until they expire"""
 
     __tablename__ = "blacklist_tokens"
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(500), unique=True, nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
     blacklisted_on = db.Column(db.DateTime, nullable=False)
+    # after this the token is rejected anyway and the row can go
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
 
     def __init__(self, token):
-        self.token = token
+        self.token_hash = BlackListToken.hash(token)
         self.blacklisted_on = datetime.now()
+        self.expires_at = BlackListToken.expiry(token)
 
     def __repr__(self):
-        return f"id: token: {self.token}"
+        return f"id: token hash: {self.token_hash}"
 
     def save(self):
         """Saves an assignment"""
         db.session.add(self)
         db.session.commit()
 
+    @staticmethod
+    def hash(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).hexdigest()
+
+    @staticmethod
+    def expiry(token):
+        """The exp of a token as a naive UTC datetime, or the longest a token lasts when it has none"""
+        try:
+            payload = jwt.decode(token, options={"verify_signature": False, "verify_exp": False},
+                                 algorithms=["HS256"])
+            return datetime.utcfromtimestamp(payload["exp"])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            return datetime.utcnow() + TOKEN_LIFETIME
+
     @staticmethod
     def check_blacklist(auth_token):
-        res = BlackListToken.query.filter_by(token=str(auth_token)).first()
+        res = BlackListToken.query.filter_by(token_hash=BlackListToken.hash(auth_token)).first()
         if res:
             return True
         else:
             return False
 
+    @staticmethod
+    def prune():
+        """Deletes the entries of tokens that have expired, returns how many"""
+        pruned = BlackListToken.query.filter(BlackListToken.expires_at <= datetime.utcnow()).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return pruned
+
 class Annotation(db.Model):
     """Represents the annotatons' table"""
     id  = db.Column(db.Integer, primary_key=True)
@@ -331,6 +401,13 @@ class Annotation(db.Model):
     image_id = db.Column(db.Integer, db.ForeignKey(Image.id, ondelete="CASCADE"))
     user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"))
 
+    __table_args__ = (
+        db.Index("ix_annotation_user_id_dataset_id", "user_id", "dataset_id"),
+        db.Index("ix_annotation_user_id_project_id", "user_id", "project_id"),
+        # one annotation of an image per user, also serves the lookups by image
+        db.Index("uq_annotation_image_id_user_id_dataset_id", "image_id", "user_id", "dataset_id", unique=True),
+    )
+
     def __init__(self, annotations, project_id, dataset_id, image_id, user_id):
         self.annotations = annotations
         self.project_id = project_id
@@ -343,7 +420,208 @@ class Annotation(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @staticmethod
+    def upsert(rows):
+        """Inserts the annotations in rows, dicts of the annotation columns, or updates
+        the user's annotation of an image where there is one, in one statement.
+        Returns (id, image_id, inserted) rows, the caller commits."""
+        from application import labelling, progress
+
+        # the same image twice in one statement is an error, the last one wins
+        rows = list({(row["image_id"], row["user_id"], row["dataset_id"]): row for row in rows}.values())
+        if not rows:
+            return []
+        stmt = insert(Annotation.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["image_id", "user_id", "dataset_id"],
+            set_={"annotations": stmt.excluded.annotations},
+        ).returning(Annotation.id, Annotation.image_id, Annotation.user_id, Annotation.dataset_id,
+                    # xmax is only set on rows that existed before
+                    db.literal_column("xmax = 0").label("inserted"))
+        connection = db.session.connection()
+        results = connection.execute(stmt).fetchall()
+        # the session listeners do not see Core statements
+        inserted = [row for row in results if row.inserted]
+        progress.count_annotations(connection, [(row.user_id, row.dataset_id) for row in inserted])
+        for row in inserted:
+            labelling.complete_task(connection, row.image_id, row.user_id)
+        return [(row.id, row.image_id, row.inserted) for row in results]
+
     def delete(self):
         """Deletes an assigment record"""
         db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+class LabelTask(db.Model):
+    """One annotation an image still needs, leased to a user while they work on it.
+    An image has as many tasks as annotations it is missing, see application.labelling."""
+
+    __tablename__ = "label_tasks"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    dataset_id = db.Column(db.Integer, db.ForeignKey(Dataset.id, ondelete="CASCADE"), nullable=False)
+    image_id = db.Column(db.Integer, db.ForeignKey(Image.id, ondelete="CASCADE"), nullable=False)
+    leased_by = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="SET NULL"))
+    lease_expires_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_label_tasks_dataset_id_id", "dataset_id", "id"),
+        db.Index("ix_label_tasks_image_id", "image_id"),
+        db.Index("ix_label_tasks_leased_by", "leased_by", postgresql_where=db.text("leased_by IS NOT NULL")),
+        # a user holds at most one task of an image, even across concurrent claims
+        db.Index("uq_label_tasks_image_id_leased_by", "image_id", "leased_by", unique=True,
+                 postgresql_where=db.text("leased_by IS NOT NULL")),
+    )
+
+    def __repr__(self):
+        return f"<Label task: {self.image_id} leased by {self.leased_by}>"
+
+
+class DatasetProgress(db.Model):
+    """Image and folder counts of a dataset, kept up to date by application.progress"""
+
+    __tablename__ = "dataset_progress"
+
+    dataset_id = db.Column(db.Integer, db.ForeignKey(Dataset.id, ondelete="CASCADE"), primary_key=True)
+    images = db.Column(db.Integer, nullable=False, default=0)
+    labelled_images = db.Column(db.Integer, nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    labelled_items = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<Dataset progress: {self.dataset_id} {self.labelled_images}/{self.images}>"
+
+
+class UserDatasetProgress(db.Model):
+    """Annotations and labelled folders of a user in a dataset, kept up to date by application.progress"""
+
+    __tablename__ = "user_dataset_progress"
+
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id, ondelete="CASCADE"), primary_key=True)
+    dataset_id = db.Column(db.Integer, db.ForeignKey(Dataset.id, ondelete="CASCADE"), primary_key=True)
+    annotations = db.Column(db.Integer, nullable=False, default=0)
+    labelled_items = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<User dataset progress: {self.user_id} {self.dataset_id}>"
+
+
+class IngestionJob(db.Model):
+    """Represents a queued external study ingestion"""
+
+    __tablename__ = "ingestion_jobs"
+
+    id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default="queued")  # queued, running, done or failed
+    payload = db.Column(db.Text, nullable=False)
+    base_url = db.Column(db.String(255))
+    result = db.Column(db.Text)
+    status_code = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, default=0)
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+    date_modified = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index("ix_ingestion_jobs_status_date_created", "status", "date_created"),
+    )
+
+    def __init__(self, payload, base_url):
+        self.id = str(uuid.uuid4())
+        self.payload = payload
+        self.base_url = base_url
+        self.status = "queued"
+        self.attempts = 0
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+
+    @staticmethod
+    def claim(stale_after, max_attempts):
+        """Locks the oldest queued job, or a running job whose worker stopped
+        updating it for stale_after seconds, and marks it running. A stale job
+        that was already started max_attempts times is marked failed instead."""
+        stale = db.func.current_timestamp() - timedelta(seconds=stale_after)
+        abandoned = db.and_(IngestionJob.status == "running", IngestionJob.date_modified < stale)
+        IngestionJob.query.filter(abandoned, IngestionJob.attempts >= max_attempts).update(
+            {IngestionJob.status: "failed", IngestionJob.status_code: 500,
+             IngestionJob.result: json.dumps({"message": f"The ingestion stopped unfinished {max_attempts} times"})},
+            synchronize_session=False)
+        job = IngestionJob.query.filter(
+            db.or_(IngestionJob.status == "queued", abandoned)
+        ).order_by(IngestionJob.date_created).with_for_update(skip_locked=True).first()
+        if job:
+            job.status = "running"
+            job.attempts += 1
+        db.session.commit()
+        return job
+
+    @staticmethod
+    def heartbeat(job_id):
+        """Tells the other workers a running job is still being worked on, on its own connection
+        so the ingestion's transaction is left alone"""
+        with db.engine.begin() as connection:
+            connection.execute(IngestionJob.__table__.update()
+                               .where(IngestionJob.__table__.c.id == job_id)
+                               .where(IngestionJob.__table__.c.status == "running")
+                               .values(date_modified=db.func.current_timestamp()))
+
+    def __repr__(self):
+        return f"<Ingestion job: {self.id} {self.status}>"
+
+
+class OutboxEmail(db.Model):
+    """Represents an email waiting to be sent by the outbox sender, see utils.email"""
+
+    __tablename__ = "outbox_emails"
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255))
+    html = db.Column(db.Text)
+    sender = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    sent_at = db.Column(db.DateTime)
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+    date_modified = db.Column(db.DateTime, default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index("ix_outbox_emails_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    def __init__(self, recipient, subject, html, sender):
+        self.recipient = recipient
+        self.subject = subject
+        self.html = html
+        self.sender = sender
+        self.status = "pending"
+        self.attempts = 0
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+
+    @staticmethod
+    def claim(limit, stale_after):
+        """Marks up to limit due emails as sending and returns their (id, recipient,
+        subject, html, sender, attempts). Emails whose sender stopped for stale_after
+        seconds while sending them are due again."""
+        now = db.func.current_timestamp()
+        stale = now - timedelta(seconds=stale_after)
+        emails = OutboxEmail.query.filter(
+            db.or_(db.and_(OutboxEmail.status == "pending", OutboxEmail.next_attempt_at <= now),
+                   db.and_(OutboxEmail.status == "sending", OutboxEmail.date_modified < stale))
+        ).order_by(OutboxEmail.id).limit(limit).with_for_update(skip_locked=True).all()
+        claimed = list()
+        for email in emails:
+            email.status = "sending"
+            email.attempts += 1
+            claimed.append((email.id, email.recipient, email.subject, email.html, email.sender, email.attempts))
+        db.session.commit()
+        return claimed
+
+    def __repr__(self):
+        return f"<Outbox email: {self.id} to {self.recipient} {self.status}>"
@@ -0,0 +1,106 @@
+import base64
+import json
+
+from flask import abort, current_app, jsonify, request, url_for
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Load
+
+
+class Page(object):
+    """A page of rows and the cursor of the page after it, None on the last page"""
+
+    def __init__(self, rows, next_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+
+    def next_url(self):
+        if not self.next_cursor:
+            return None
+        args = request.args.to_dict()
+        args["cursor"] = self.next_cursor
+        return url_for(request.endpoint, _external=True, **dict(request.view_args, **args))
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, TypeError):
+        abort(400, "Invalid cursor")
+    if not isinstance(values, list):
+        abort(400, "Invalid cursor")
+    return values
+
+
+def page_size():
+    """Returns ?limit=, bounded by the PAGE_SIZE and MAX_PAGE_SIZE settings"""
+    limit = request.args.get("limit", type=int) or current_app.config.get("PAGE_SIZE", 100)
+    return min(max(limit, 1), current_app.config.get("MAX_PAGE_SIZE", 1000))
+
+
+def paginate(query, keys, values=None, limit=None):
+    """Returns the page of query ordered by the keys columns after the ?cursor= row.
+
+    Keyset paging filters on ``(keys) > (cursor values)`` instead of using an
+    offset, so every page costs the same index range scan. values(row)
+    returns the key values of a row, by default the attributes named like
+    the keys. A NULL key never compares greater than the cursor, so nullable
+    columns are paged by ``coalesce(column, '')`` with values to match.
+    """
+    limit = limit or page_size()
+    cursor = request.args.get("cursor")
+    if cursor:
+        after = decode_cursor(cursor)
+        if len(after) != len(keys):
+            abort(400, "Invalid cursor")
+        if len(keys) == 1:
+            query = query.filter(keys[0] > after[0])
+        else:
+            query = query.filter(tuple_(*keys) > tuple_(*after))
+    rows = query.order_by(None).order_by(*keys).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(values(last) if values else [getattr(last, key.key) for key in keys])
+    return Page(rows, next_cursor)
+
+
+def requested_fields(available):
+    """Returns the fields listed in ?fields=, or all of the available ones"""
+    fields = request.args.get("fields")
+    if not fields:
+        return list(available)
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        abort(400, "Unknown fields: " + ", ".join(unknown))
+    return fields
+
+
+def load_fields(query, model, fields, columns, always=()):
+    """Loads only the columns of model the requested fields need, plus the always
+    ones such as paging keys. columns maps a field to the columns it is made from."""
+    names = set(always)
+    for field in fields:
+        names.update(columns.get(field, ()))
+    return query.options(Load(model).load_only(*(names or ["id"])))
+
+
+def serialize(row, fields, serializers, extra=None):
+    """Returns the requested fields of a row. Serializers are called with the row
+    and extra, which holds whatever the view loaded for the whole page."""
+    return {field: serializers[field](row, extra) for field in fields}
+
+
+def list_response(results, page):
+    """A JSON list response with the next page in the Link and X-Next-Cursor headers"""
+    response = jsonify(results)
+    response.status_code = 200
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+        response.headers["Link"] = f'<{page.next_url()}>; rel="next"'
+    return response
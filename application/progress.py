@@ -0,0 +1,230 @@
+from collections import Counter
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import and_, case, event, func, inspect, or_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from application.models import Annotation, DatasetProgress, Image, Item, User, UserDatasetProgress
+
+# columns whose writes move the counters, their previous value is needed to know by how much
+tracked = {
+    Image: ["dataset_id", "labelled", "has_box", "folder_labelled"],
+    Item: ["dataset_id", "labelled", "labelled_by"],
+    Annotation: ["user_id", "dataset_id"],
+}
+
+rebuild_dataset_progress_sql = """
+INSERT INTO dataset_progress (dataset_id, images, labelled_images, items, labelled_items)
+SELECT datasets.id, coalesce(images.total, 0), coalesce(images.labelled, 0),
+       coalesce(items.total, 0), coalesce(items.labelled, 0)
+FROM datasets
+LEFT JOIN (SELECT dataset_id, count(*) AS total,
+                  count(*) FILTER (WHERE labelled AND has_box AND folder_labelled) AS labelled
+           FROM images GROUP BY dataset_id) images ON images.dataset_id = datasets.id
+LEFT JOIN (SELECT dataset_id, count(*) AS total, count(*) FILTER (WHERE labelled) AS labelled
+           FROM data_items GROUP BY dataset_id) items ON items.dataset_id = datasets.id
+"""
+
+rebuild_user_dataset_progress_sql = """
+INSERT INTO user_dataset_progress (user_id, dataset_id, annotations, labelled_items)
+SELECT user_id, dataset_id, sum(annotations), sum(labelled_items)
+FROM (SELECT user_id, dataset_id, count(*) AS annotations, 0 AS labelled_items
+      FROM annotation WHERE user_id IS NOT NULL AND dataset_id IS NOT NULL
+      GROUP BY user_id, dataset_id
+      UNION ALL
+      SELECT labelled_by, dataset_id, 0, count(*)
+      FROM data_items WHERE labelled AND labelled_by IS NOT NULL AND dataset_id IS NOT NULL
+      GROUP BY labelled_by, dataset_id) counts
+GROUP BY user_id, dataset_id
+"""
+
+
+def rebuild(connection):
+    """Recomputes every counter from the label tables"""
+    connection.execute("DELETE FROM user_dataset_progress")
+    connection.execute("DELETE FROM dataset_progress")
+    connection.execute(rebuild_dataset_progress_sql)
+    connection.execute(rebuild_user_dataset_progress_sql)
+
+
+def _id(value):
+    """Ids arrive as strings from request data"""
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def _values(obj, attrs):
+    """Returns the committed and the pending values of attrs"""
+    state = inspect(obj)
+    old, new = dict(), dict()
+    for attr in attrs:
+        history = state.attrs[attr].history
+        new[attr] = getattr(obj, attr)
+        if history.deleted:
+            old[attr] = history.deleted[0]
+        elif history.added:
+            # the attribute was None before
+            old[attr] = None
+        else:
+            old[attr] = new[attr]
+    return old, new
+
+
+def _counts(obj, values):
+    """Returns the (table, key, counts) an object with the given values contributes"""
+    if isinstance(obj, Image):
+        dataset_id = _id(values["dataset_id"])
+        if dataset_id is None:
+            return []
+        labelled = bool(values["labelled"] and values["has_box"] and values["folder_labelled"])
+        return [("datasets", dataset_id, {"images": 1, "labelled_images": int(labelled)})]
+    if isinstance(obj, Item):
+        dataset_id = _id(values["dataset_id"])
+        if dataset_id is None:
+            return []
+        labelled = bool(values["labelled"])
+        counts = [("datasets", dataset_id, {"items": 1, "labelled_items": int(labelled)})]
+        user_id = _id(values["labelled_by"])
+        if labelled and user_id is not None:
+            counts.append(("users", (user_id, dataset_id), {"labelled_items": 1}))
+        return counts
+    user_id, dataset_id = _id(values["user_id"]), _id(values["dataset_id"])
+    if user_id is None or dataset_id is None:
+        return []
+    return [("users", (user_id, dataset_id), {"annotations": 1})]
+
+
+def _add(deltas, counts, sign):
+    for table, key, values in counts:
+        delta = deltas[table].setdefault(key, Counter())
+        for column, value in values.items():
+            delta[column] += sign * value
+
+
+def _deleted_ids(deleted, model):
+    return set(obj.id for obj in deleted if isinstance(obj, model) and obj.id is not None)
+
+
+def _not_in(column, ids):
+    return [~column.in_(ids)] if ids else []
+
+
+def _cascaded_counts(session, deleted):
+    """Returns the (table, key, counts) of the rows the database deletes along with
+    the deleted images, folders and users through ON DELETE CASCADE, which the
+    session never loads. One grouped query per table, over the deleted ids."""
+    image_ids, item_ids, user_ids = (_deleted_ids(deleted, model) for model in (Image, Item, User))
+    if not (image_ids or item_ids or user_ids):
+        return []
+    # a deleted folder takes its images, a deleted user the folders and images they labelled
+    items = list()
+    if item_ids:
+        items.append(Item.id.in_(item_ids))
+    if user_ids:
+        items.append(Item.labelled_by.in_(user_ids))
+    images = [Image.item_id.in_(select([Item.id]).where(or_(*items)))] if items else []
+    if image_ids:
+        images.append(Image.id.in_(image_ids))
+    if user_ids:
+        images.append(Image.labelled_by.in_(user_ids))
+    images = or_(*images)
+    labelled = and_(Image.labelled, Image.has_box, Image.folder_labelled)
+
+    # the deleted rows themselves are counted from their loaded values
+    counts = list()
+    with session.no_autoflush:
+        if user_ids:
+            rows = session.query(Item.dataset_id, Item.labelled, func.count()) \
+                .filter(Item.labelled_by.in_(user_ids), Item.dataset_id.isnot(None), *_not_in(Item.id, item_ids)) \
+                .group_by(Item.dataset_id, Item.labelled)
+            for dataset_id, item_labelled, count in rows:
+                counts.append(("datasets", dataset_id, {"items": count, "labelled_items": count * bool(item_labelled)}))
+        rows = session.query(Image.dataset_id, func.count(), func.sum(case([(labelled, 1)], else_=0))) \
+            .filter(images, Image.dataset_id.isnot(None), *_not_in(Image.id, image_ids)) \
+            .group_by(Image.dataset_id)
+        for dataset_id, count, labelled_count in rows:
+            counts.append(("datasets", dataset_id, {"images": count, "labelled_images": int(labelled_count or 0)}))
+        # the annotations of deleted users go with their counters, only those of others are counted
+        rows = session.query(Annotation.user_id, Annotation.dataset_id, func.count()) \
+            .filter(Annotation.image_id.in_(select([Image.id]).where(images)), Annotation.user_id.isnot(None),
+                    Annotation.dataset_id.isnot(None), *_not_in(Annotation.user_id, user_ids)) \
+            .filter(*_not_in(Annotation.id, _deleted_ids(deleted, Annotation))) \
+            .group_by(Annotation.user_id, Annotation.dataset_id)
+        for user_id, dataset_id, count in rows:
+            counts.append(("users", (user_id, dataset_id), {"annotations": count}))
+    return counts
+
+
+@event.listens_for(SignallingSession, "before_flush")
+def collect_progress(session, flush_context, instances):
+    """Works out how the pending label writes move the counters"""
+    deltas = session.info.setdefault("progress", {"datasets": dict(), "users": dict()})
+    for obj in session.new:
+        if type(obj) in tracked:
+            _add(deltas, _counts(obj, _values(obj, tracked[type(obj)])[1]), 1)
+    for obj in session.dirty:
+        if type(obj) in tracked and session.is_modified(obj):
+            old, new = _values(obj, tracked[type(obj)])
+            _add(deltas, _counts(obj, old), -1)
+            _add(deltas, _counts(obj, new), 1)
+    deleted = list(session.deleted)
+    for obj in deleted:
+        if type(obj) in tracked:
+            _add(deltas, _counts(obj, _values(obj, tracked[type(obj)])[0]), -1)
+    _add(deltas, _cascaded_counts(session, deleted), -1)
+    # the counters of deleted users go with them
+    user_ids = _deleted_ids(deleted, User)
+    for key in [key for key in deltas["users"] if key[0] in user_ids]:
+        del deltas["users"][key]
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def apply_progress(session, flush_context):
+    """Applies the counter changes in the transaction of the flush that caused them"""
+    deltas = session.info.pop("progress", None)
+    if not deltas:
+        return
+    connection = session.connection()
+    for table, key_columns, model in (("datasets", ["dataset_id"], DatasetProgress),
+                                      ("users", ["user_id", "dataset_id"], UserDatasetProgress)):
+        for key, delta in sorted(deltas[table].items()):
+            key = key if isinstance(key, tuple) else (key,)
+            _increment(connection, model, dict(zip(key_columns, key)), delta)
+
+
+def _increment(connection, model, key, delta):
+    """Adds delta to the counters of the row with the given key, creating it if needed"""
+    delta = {column: value for column, value in delta.items() if value}
+    if not delta:
+        return
+    stmt = insert(model.__table__).values(**dict(key, **delta))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(key),
+        set_={column: model.__table__.c[column] + stmt.excluded[column] for column in delta},
+    )
+    connection.execute(stmt)
+
+
+def count_annotations(connection, annotations):
+    """Counts annotations written with Core statements, which the session listeners
+    do not see, given as (user_id, dataset_id) pairs"""
+    for (user_id, dataset_id), count in sorted(Counter(annotations).items()):
+        if user_id is not None and dataset_id is not None:
+            _increment(connection, UserDatasetProgress, {"user_id": user_id, "dataset_id": dataset_id},
+                       {"annotations": count})
+
+
+@event.listens_for(SignallingSession, "after_rollback")
+def discard_progress(session):
+    session.info.pop("progress", None)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# load the previous value of tracked columns when they are assigned on expired objects
+for model, attrs in tracked.items():
+    for attr in attrs:
+        event.listen(getattr(model, attr), "set", _keep_old_value, active_history=True)
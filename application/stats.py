@@ -0,0 +1,92 @@
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from application import db
+from application.models import DatasetProgress, Image, Item, UserDatasetProgress
+
+
+def labelling_progress(labelled, total):
+    """Returns labelled out of total as a percentage"""
+    if labelled and total:
+        return (labelled / total) * 100
+    return 0
+
+
+def _dataset_counters(dataset_ids):
+    query = DatasetProgress.query
+    if dataset_ids is not None:
+        if not dataset_ids:
+            return []
+        query = query.filter(DatasetProgress.dataset_id.in_(dataset_ids))
+    return query.all()
+
+
+def dataset_image_counts(dataset_ids=None):
+    """Returns {dataset_id: (labelled images, all images)} for the given datasets, or all of them.
+    An image is labelled once labelled, has_box and folder_labelled are set."""
+    return {counter.dataset_id: (counter.labelled_images, counter.images)
+            for counter in _dataset_counters(dataset_ids)}
+
+
+def dataset_progress(dataset_ids=None):
+    """Returns {dataset_id: progress percentage} from dataset_image_counts"""
+    return {dataset_id: labelling_progress(labelled_images, all_images)
+            for dataset_id, (labelled_images, all_images) in dataset_image_counts(dataset_ids).items()}
+
+
+def dataset_item_counts(dataset_ids=None):
+    """Returns {dataset_id: (labelled items, all items)}"""
+    return {counter.dataset_id: (counter.labelled_items, counter.items)
+            for counter in _dataset_counters(dataset_ids)}
+
+
+def user_annotation_counts(user_id, dataset_ids):
+    """Returns {dataset_id: number of annotations by the user}"""
+    if not dataset_ids:
+        return {}
+    query = db.session.query(UserDatasetProgress.dataset_id, UserDatasetProgress.annotations).filter(
+        UserDatasetProgress.user_id == user_id, UserDatasetProgress.dataset_id.in_(dataset_ids)
+    )
+    return dict(query.all())
+
+
+def dataset_annotation_counts(dataset_id, user_ids):
+    """Returns {user_id: number of annotations by the user in the dataset}"""
+    if not user_ids:
+        return {}
+    query = db.session.query(UserDatasetProgress.user_id, UserDatasetProgress.annotations).filter(
+        UserDatasetProgress.dataset_id == dataset_id, UserDatasetProgress.user_id.in_(user_ids)
+    )
+    return dict(query.all())
+
+
+def user_labelled_item_counts(user_ids):
+    """Returns {user_id: number of items labelled by the user}"""
+    if not user_ids:
+        return {}
+    query = db.session.query(UserDatasetProgress.user_id, db.func.sum(UserDatasetProgress.labelled_items)).filter(
+        UserDatasetProgress.user_id.in_(user_ids)
+    ).group_by(UserDatasetProgress.user_id)
+    return {user_id: int(labelled_items) for user_id, labelled_items in query}
+
+
+def item_image_statuses(dataset_id, urls=True):
+    """Returns a query of (item, images, fully labelled images, image urls) for every item of a dataset.
+    The urls are only aggregated when asked for."""
+    labelled = db.and_(Image.labelled, Image.has_box, Image.folder_labelled)
+    if urls:
+        image_urls = db.func.array_agg(aggregate_order_by(Image.image_URL, Image.id)).filter(Image.id.isnot(None))
+    else:
+        image_urls = db.null()
+    return db.session.query(
+        Item,
+        db.func.count(Image.id),
+        db.func.count(Image.id).filter(labelled),
+        image_urls,
+    ).outerjoin(Image, Image.item_id == Item.id).filter(
+        Item.dataset_id == dataset_id
+    ).group_by(Item.id)
+
+
+def item_is_labelled(item, images, labelled_images):
+    """A folder counts as labelled once it is and so are all of its images"""
+    return bool(item.labelled and images == labelled_images)
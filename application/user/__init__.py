@@ -1,16 +1,37 @@
-from flask import Blueprint, request, jsonify, abort
+from flask import Blueprint, request, jsonify, abort, g
 import random
 import json
+from application import db
+from application.admin import content_store, image_url_for, static_file
 from application.decorators import user_is_authenticated
+from application.labelling import (
+    claim_tasks,
+    labelled_images,
+    lease_duration,
+    next_unlabelled_images,
+    queue_size,
+    release_tasks,
+    renew_tasks,
+)
+from application.pagination import load_fields, paginate, requested_fields, serialize
+from application.stats import (
+    dataset_image_counts,
+    item_image_statuses,
+    item_is_labelled,
+    labelling_progress,
+    user_annotation_counts,
+)
 from application.models import (
     Image,
     Item,
-    User,
     Assignment,
     Dataset,
     Project,
     Annotation,
+    Attributes,
 )
+from application.utils.auth_cache import load_principal
+from application.utils.storage import StoredImage
 
 user_blueprint = Blueprint("user", __name__)
 
@@ -20,7 +41,8 @@ user_blueprint = Blueprint("user", __name__)
 def get_user_stats(user_id, **kwargs):
     datasets = Assignment.query.filter_by(user_id=user_id).count()
     items = Item.query.filter_by(labelled_by=user_id)
-    user = User.query.filter_by(id=user_id).first()
+    # cached per worker, the decorator has just loaded the caller's
+    user = load_principal(user_id)
     if not user:
         abort(404)
     images_count = 0
@@ -30,7 +52,7 @@ def get_user_stats(user_id, **kwargs):
     response = jsonify(
         {
             "id": user_id,
-            "name": user.username,
+            "name": user.name,
             "datasets": datasets,
             "images": images_count,
         }
@@ -42,35 +64,30 @@ def get_user_stats(user_id, **kwargs):
 @user_blueprint.route("/user/<int:user_id>/datasets/", methods=["GET"])
 @user_is_authenticated()
 def get_user_datasets(user_id, *kwargs):
-    assignments = Assignment.query.filter_by(user_id=user_id)
+    assignments = (
+        db.session.query(Dataset, Project.type)
+        .join(Assignment, Assignment.dataset_id == Dataset.id)
+        .outerjoin(Project, Project.id == Dataset.project_id)
+        .filter(Assignment.user_id == user_id)
+        .order_by(Assignment.id)
+        .all()
+    )
+    dataset_ids = [dataset.id for dataset, _ in assignments]
+    # progress of every assigned dataset in two grouped queries
+    image_counts = dataset_image_counts(dataset_ids)
+    annotation_counts = user_annotation_counts(user_id, dataset_ids)
     datasets = []
-    for assignment in assignments:
-        dataset = Dataset.query.filter_by(id=assignment.dataset_id).first()
-        project_type = Project.query.filter_by(id=dataset.project_id).first().type
-
-        labelled_images = Image.query.filter_by(
-            dataset_id=assignment.dataset_id,
-            labelled=True,
-            has_box=True,
-            folder_labelled=True,
-        ).count()
-        all_images = Image.query.filter_by(dataset_id=assignment.dataset_id).count()
+    for dataset, project_type in assignments:
+        labelled_images, all_images = image_counts.get(dataset.id, (0, 0))
 
         if project_type == "label":
-            all_images = Image.query.filter_by(dataset_id=assignment.dataset_id).count()
-            labelled_images = Annotation.query.filter_by(
-                user_id=user_id, dataset_id=assignment.dataset_id
-            ).count()
+            labelled_images = annotation_counts.get(dataset.id, 0)
 
-        if labelled_images and all_images:
-            progress = (labelled_images / all_images) * 100
-        else:
-            progress = 0
         dataset = {
             "id": dataset.id,
             "name": dataset.name,
             "classes": dataset.classes,
-            "progress": progress,
+            "progress": labelling_progress(labelled_images, all_images),
             "project_type": project_type,
         }
         datasets.append(dataset)
@@ -161,36 +178,47 @@ def get_dataset_items(dataset_id):
     dataset = Dataset.query.filter_by(id=dataset_id).first()
     if not dataset:
         abort(404)
-    items = Item.query.filter_by(dataset_id=dataset_id).order_by(Item.name)
-    if not items:
-        abort(404)
-    data_items = list()
-
-    for item in items:
-        if (
-            item.labelled
-            and Image.query.filter_by(item_id=item.id).count()
-            == Image.query.filter_by(
-                item_id=item.id, labelled=True, folder_labelled=True, has_box=True
-            ).count()
-        ):
-            labelled = True
-        else:
-            labelled = False
-        obj = {
-            "id": item.id,
-            "name": item.name,
-            "label": item.label,
-            "comment": item.comment,
-            "labelled": labelled,
-            "labelled_by": item.labelled_by,
+    fields = requested_fields(item_fields)
+    # image counts of every item of the page in one query
+    query = load_fields(
+        item_image_statuses(dataset_id, urls=False), Item, fields, item_columns, always=["name"]
+    )
+    page = paginate(
+        query,
+        [db.func.coalesce(Item.name, ""), Item.id],
+        values=lambda row: [row[0].name or "", row[0].id],
+    )
+    data_items = [serialize(row, fields, item_fields) for row in page.rows]
+    response = jsonify(
+        {
+            "id": dataset.id,
+            "name": dataset.name,
+            "items": data_items,
+            "next_cursor": page.next_cursor,
+            "next": page.next_url(),
         }
-        data_items.append(obj)
-    response = jsonify({"id": dataset.id, "name": dataset.name, "items": data_items})
+    )
     response.status_code = 200
     return response
 
 
+# fields of an item listing, serialized from (item, images, labelled images, image urls) rows
+item_fields = {
+    "id": lambda row, extra: row[0].id,
+    "name": lambda row, extra: row[0].name,
+    "label": lambda row, extra: row[0].label,
+    "comment": lambda row, extra: row[0].comment,
+    "labelled": lambda row, extra: item_is_labelled(*row[:3]),
+    "labelled_by": lambda row, extra: row[0].labelled_by,
+}
+item_columns = {
+    "label": ["label"],
+    "comment": ["comment"],
+    "labelled": ["labelled"],
+    "labelled_by": ["labelled_by"],
+}
+
+
 @user_blueprint.route("/user/images/<int:image_id>/", methods=["GET", "PUT"])
 @user_is_authenticated()
 def manipulate_images(image_id):
@@ -261,88 +289,165 @@ def add_bounding_box(image_id):
 @user_blueprint.route("/user/images/<int:dataset_id>/random", methods=["GET"])
 @user_is_authenticated()
 def get_random_unlabelled_image(dataset_id):
-    user_id = request.headers.get("user_id")
-    # all images in dataset
-    all_images = Image.query.filter_by(dataset_id=dataset_id).all()
-    # this user's annotation record
-    labelled_images = Annotation.query.filter_by(
-        user_id=user_id, dataset_id=dataset_id
-    ).all()
-
-    # progress = f"{len(labelled_images)} labeled out of {len(all_images)}"
-    # if len(labelled_images) >= len(all_images):
-    # progress = "done"
-    # labelled image ids array
-    labelled_image_ids = [i.image_id for i in labelled_images]
-    unlabelled_images = list()
-    # unlabelled_images = list()
-    # filter out unlabelled images
-    for image in all_images:
-
-        if image.id in labelled_image_ids:
-            continue
-        unlabelled_images.append(image)
-    labelled_images = [Image.query.filter_by(id=i).first() for i in labelled_image_ids]
-    random.shuffle(labelled_images)
-    random.shuffle(unlabelled_images)
-    # Shuffle images
-    final_images = unlabelled_images + labelled_images
+    user_id = g.principal.id
+    dataset = Dataset.query.filter_by(id=dataset_id).first()
+    if not dataset:
+        abort(404)
+    # a random sample of the images this user has not labelled yet
+    unlabelled_images = next_unlabelled_images(dataset_id, user_id, queue_size())
+    # and a page of the ones they did, with their annotations
+    page = paginate(
+        labelled_images(dataset_id, user_id),
+        [Annotation.id],
+        values=lambda row: [row.annotation_id],
+    )
+    labelled = list(page.rows)
+    random.shuffle(labelled)
 
     images = list()
     labels = list()
 
     for image in unlabelled_images:
         images.append({"id": image.id, "image": image.image_URL})
-        annotation = Annotation.query.filter_by(image_id=image.id).first()
-        labels.append(
-            {
-                "id": image.id,
-                "annotations": {
-                    # "option1": {"question": "Is SCJ fully visible?", "answer": ""},
-                    "option1": {
-                        "question": "Is the quality of the picture good enough to make a diagnosis?",
-                        "answer": "",
-                    },
-                    # "option3": {"question": "Is SCJ fully visible?", "answer": ""},
-                    "option2": {
-                        "question": "What is the VIA assessment?",
-                        "answer": "",
-                    },
-                    "option3": {
-                        "question": " What is the lesion location? (None if not applicable).",
-                        "answer": "",
-                    },
-                    "option4": {
-                        "question": "What is the size of lesion (propotion of cervix area involved)?",
-                        "answer": "",
-                    },
-                },
-            }
-        )
-
-    for image in labelled_images:
+        labels.append({"id": image.id, "annotations": empty_annotations})
 
+    for image in labelled:
         images.append({"id": image.id, "image": image.image_URL})
-        annotation = Annotation.query.filter_by(image_id=image.id).first()
-        labels.append(
-            {"id": image.id, "annotations": json.loads(annotation.annotations)}
-        )
+        labels.append({"id": image.id, "annotations": json.loads(image.annotations)})
 
-    project_id = Dataset.query.filter_by(id=image.dataset_id).first().project_id
     response = jsonify(
         {
             "images": images,
-            "dataset_id": image.dataset_id,
-            "project_id": project_id,
+            "dataset_id": dataset.id,
+            "project_id": dataset.project_id,
             "labels": labels,
-            "labelled": len(labelled_images),
-            "all_images": len(all_images),
+            "labelled": user_annotation_counts(user_id, [dataset.id]).get(dataset.id, 0),
+            "all_images": dataset_image_counts([dataset.id]).get(dataset.id, (0, 0))[1],
+            "next_cursor": page.next_cursor,
+            "next": page.next_url(),
+        }
+    )
+    response.status_code = 200
+    return response
+
+
+@user_blueprint.route("/user/datasets/<int:dataset_id>/leases", methods=["POST", "PUT", "DELETE"])
+@user_is_authenticated()
+def dataset_leases(dataset_id):
+    """POST leases ?count= images of the dataset to the user, PUT renews their leases
+    and DELETE releases them, both optionally limited to the image_ids of the body"""
+    user_id = g.principal.id
+    dataset = Dataset.query.filter_by(id=dataset_id).first()
+    if not dataset:
+        abort(404)
+    image_ids = None
+    if request.method != "POST" and request.data and "image_ids" in request.data:
+        image_ids = [int(image_id) for image_id in request.data.get("image_ids")]
+
+    if request.method == "POST":
+        tasks = claim_tasks(dataset_id, user_id, queue_size())
+        urls = dict()
+        if tasks:
+            urls = dict(db.session.query(Image.id, Image.image_URL).filter(
+                Image.id.in_([task.image_id for task in tasks])).all())
+        response = jsonify(
+            {
+                "dataset_id": dataset.id,
+                "project_id": dataset.project_id,
+                "lease_seconds": int(lease_duration().total_seconds()),
+                "images": [
+                    {"id": task.image_id, "image": urls.get(task.image_id),
+                     "lease_expires_at": task.lease_expires_at}
+                    for task in tasks
+                ],
+            }
+        )
+        response.status_code = 201
+        return response
+    elif request.method == "PUT":
+        renewed = renew_tasks(dataset_id, user_id, image_ids)
+        response = jsonify({"dataset_id": dataset.id, "renewed": renewed,
+                            "lease_seconds": int(lease_duration().total_seconds())})
+    else:
+        released = release_tasks(dataset_id, user_id, image_ids)
+        response = jsonify({"dataset_id": dataset.id, "released": released})
+    response.status_code = 200
+    return response
+
+
+@user_blueprint.route("/user/datasets/<int:dataset_id>/next", methods=["GET"])
+@user_is_authenticated()
+def get_next_bundle(dataset_id):
+    """Leases the next ?count= images of the dataset to the user and returns them with
+    everything needed to label them offline: the resized image url, its size and
+    ETag, the dataset classes and the project's questions"""
+    user_id = g.principal.id
+    dataset = Dataset.query.filter_by(id=dataset_id).first()
+    if not dataset:
+        abort(404)
+    tasks = claim_tasks(dataset_id, user_id, queue_size())
+    images = dict()
+    if tasks:
+        images = {image.id: image for image in Image.query.filter(
+            Image.id.in_([task.image_id for task in tasks]))}
+    attributes = Attributes.query.filter_by(project_id=dataset.project_id).order_by(Attributes.id).all()
+    response = jsonify(
+        {
+            "dataset_id": dataset.id,
+            "project_id": dataset.project_id,
+            "classes": dataset.classes,
+            "classes2": dataset.classes2,
+            "attributes": [
+                {"name": attribute.name, "description": attribute.description, "type": attribute.type,
+                 "values": attribute.values}
+                for attribute in attributes
+            ],
+            "template": empty_annotations,
+            "lease_seconds": int(lease_duration().total_seconds()),
+            "images": [
+                dict(bundle_image(images[task.image_id]), lease_expires_at=task.lease_expires_at)
+                for task in tasks if task.image_id in images
+            ],
         }
     )
     response.status_code = 200
     return response
 
 
+def bundle_image(image):
+    """The resized copy of a content addressed image, or the original of images stored
+    before content addressing or without one, with the ETag the file is served with"""
+    url = image.image_URL
+    if image.content_hash and content_store.exists(image.content_hash, "resized"):
+        url = image_url_for(StoredImage(image.content_hash, image.byte_size, "", False), "resized")
+    etag, byte_size = static_file(url)
+    return {"id": image.id, "name": image.name, "image": url, "byte_size": byte_size or image.byte_size,
+            "etag": etag}
+
+
+# the questions of an image this user has not labelled yet
+empty_annotations = {
+    # "option1": {"question": "Is SCJ fully visible?", "answer": ""},
+    "option1": {
+        "question": "Is the quality of the picture good enough to make a diagnosis?",
+        "answer": "",
+    },
+    # "option3": {"question": "Is SCJ fully visible?", "answer": ""},
+    "option2": {
+        "question": "What is the VIA assessment?",
+        "answer": "",
+    },
+    "option3": {
+        "question": " What is the lesion location? (None if not applicable).",
+        "answer": "",
+    },
+    "option4": {
+        "question": "What is the size of lesion (propotion of cervix area involved)?",
+        "answer": "",
+    },
+}
+
+
 @user_blueprint.route("/user/label/<int:image_id>", methods=["POST"])
 @user_is_authenticated()
 def label_image(image_id):
@@ -350,36 +455,131 @@ def label_image(image_id):
     dataset_id = int(request.data.get("dataset_id"))
     project_id = int(request.data.get("project_id"))
     annotations = request.data.get("annotations", "")
-    user_id = request.headers.get("user_id")
-    image_id = image_id
-    annotation = Annotation.query.filter_by(
-        image_id=image_id, user_id=user_id, dataset_id=dataset_id
-    ).first()
-    if annotation:
-        annotation.annotations = annotations
-    else:
-        annotation = Annotation(
-            dataset_id=dataset_id,
-            project_id=project_id,
-            user_id=user_id,
-            image_id=image_id,
-            annotations=annotations,
-        )
-    annotation.save()
-    labelled = Annotation.query.filter_by(
-        user_id=user_id, dataset_id=dataset_id
-    ).count()
-    all_images = Image.query.filter_by(dataset_id=dataset_id).count()
+    user_id = g.principal.id
+    # a double submit updates the first one instead of adding a second annotation
+    Annotation.upsert([{
+        "dataset_id": dataset_id,
+        "project_id": project_id,
+        "user_id": user_id,
+        "image_id": image_id,
+        "annotations": annotations,
+    }])
+    db.session.commit()
+    labelled = user_annotation_counts(user_id, [dataset_id]).get(dataset_id, 0)
+    all_images = dataset_image_counts([dataset_id]).get(dataset_id, (0, 0))[1]
     response = jsonify(
         {
-            "dataset_id": annotation.dataset_id,
-            "project_id": annotation.project_id,
-            "user_id": annotation.user_id,
-            "image_id": annotation.image_id,
-            "annotations": annotation.annotations,
+            "dataset_id": dataset_id,
+            "project_id": project_id,
+            "user_id": user_id,
+            "image_id": image_id,
+            "annotations": annotations,
             "labelled": labelled,
             "all_images": all_images,
         }
     )
     response.status_code = 201
     return response
+
+
+def batch_id(value):
+    """An id of a batch entry as an int, None when it is missing or not a whole number"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value) if int(value) == float(value) else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+@user_blueprint.route("/user/label/batch", methods=["POST"])
+@user_is_authenticated()
+def label_batch():
+    """Saves a session's worth of labelling in one transaction: the "annotations",
+    image "labels" and "bounding_boxes" lists of the body, each entry naming its
+    image_id. Returns the user's progress in the datasets involved."""
+    user_id = g.principal.id
+    annotations = request.data.get("annotations") or []
+    labels = request.data.get("labels") or []
+    bounding_boxes = request.data.get("bounding_boxes") or []
+    entries = list()
+    for name, values in (("annotations", annotations), ("labels", labels), ("bounding_boxes", bounding_boxes)):
+        if not isinstance(values, list):
+            abort(400, f"{name} must be a list")
+        entries.extend((name, i, entry) for i, entry in enumerate(values))
+    for name, i, entry in entries:
+        if not isinstance(entry, dict) or batch_id(entry.get("image_id")) is None:
+            abort(400, f"{name}[{i}] needs an image_id")
+        for key in ("dataset_id", "project_id"):
+            if entry.get(key) not in (None, "") and batch_id(entry[key]) is None:
+                abort(400, f"{name}[{i}] has an invalid {key}")
+
+    # every image, dataset and project of the batch in one query each
+    image_ids = set(batch_id(entry["image_id"]) for _, _, entry in entries)
+    images = {image.id: image for image in Image.query.filter(Image.id.in_(image_ids))} if image_ids else {}
+    missing = image_ids - set(images)
+    if missing:
+        abort(400, "Unknown images: " + ", ".join(str(image_id) for image_id in sorted(missing)))
+    dataset_ids = set(batch_id(entry.get("dataset_id")) for entry in annotations) - {None}
+    project_ids = set(batch_id(entry.get("project_id")) for entry in annotations) - {None}
+    known_datasets = set(dataset_id for dataset_id, in db.session.query(Dataset.id).filter(
+        Dataset.id.in_(dataset_ids))) if dataset_ids else set()
+    known_projects = set(project_id for project_id, in db.session.query(Project.id).filter(
+        Project.id.in_(project_ids))) if project_ids else set()
+
+    dataset_ids = set()
+    rows = list()
+    for i, entry in enumerate(annotations):
+        image = images[batch_id(entry["image_id"])]
+        dataset_id = batch_id(entry.get("dataset_id")) or image.dataset_id
+        project_id = batch_id(entry.get("project_id"))
+        if dataset_id is None:
+            abort(400, f"annotations[{i}] needs a dataset_id, its image has none")
+        if entry.get("dataset_id") not in (None, "") and dataset_id not in known_datasets:
+            abort(400, f"annotations[{i}] has an unknown dataset_id")
+        if project_id is not None and project_id not in known_projects:
+            abort(400, f"annotations[{i}] has an unknown project_id")
+        rows.append({
+            "dataset_id": dataset_id,
+            "project_id": project_id,
+            "user_id": int(user_id),
+            "image_id": image.id,
+            "annotations": entry.get("annotations", ""),
+        })
+        dataset_ids.add(dataset_id)
+    # all of the annotations in one INSERT ... ON CONFLICT DO UPDATE
+    Annotation.upsert(rows)
+    for entry in labels:
+        image = images[batch_id(entry["image_id"])]
+        image.label = entry.get("label", "")
+        image.labelled_by = entry.get("labeller") or user_id
+        image.labelled = True
+        dataset_ids.add(image.dataset_id)
+    for entry in bounding_boxes:
+        image = images[batch_id(entry["image_id"])]
+        image.cervical_area = entry.get("bounding_box", "")
+        image.has_box = bool(image.cervical_area)
+        dataset_ids.add(image.dataset_id)
+    db.session.commit()
+
+    dataset_ids = sorted(dataset_id for dataset_id in dataset_ids if dataset_id is not None)
+    annotation_counts = user_annotation_counts(user_id, dataset_ids)
+    image_counts = dataset_image_counts(dataset_ids)
+    response = jsonify(
+        {
+            "annotations": len(annotations),
+            "labels": len(labels),
+            "bounding_boxes": len(bounding_boxes),
+            "datasets": [
+                {
+                    "dataset_id": dataset_id,
+                    "labelled": annotation_counts.get(dataset_id, 0),
+                    "labelled_images": image_counts.get(dataset_id, (0, 0))[0],
+                    "all_images": image_counts.get(dataset_id, (0, 0))[1],
+                }
+                for dataset_id in dataset_ids
+            ],
+        }
+    )
+    response.status_code = 201
+    return response
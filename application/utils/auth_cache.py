@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import jwt
+import redis
+from flask import current_app
+
+from application.models import BlackListToken, User
+from application.utils.lru import TTLCache
+
+
+class InvalidToken(Exception):
+    """Raised by verify_token for a token that is malformed, forged or expired"""
+
+
+def token_hash(token):
+    """The SHA-256 of a token, which is what the caches and the blacklist table keep"""
+    return BlackListToken.hash(token)
+
+
+class VerifiedTokens(TTLCache):
+    """LRU of tokens whose signature was verified, each kept until its exp claim.
+
+    A hit replaces the JWT decode and HMAC check of every request after the
+    first one made with a token.
+    """
+
+    def __init__(self, max_entries=10000):
+        # exp claims are unix timestamps
+        super().__init__(max_entries, clock=time.time)
+
+
+class TokenBlacklist(object):
+    """The hashes of logged out tokens that have not expired, held in memory.
+
+    The unexpired rows of the blacklist table are read in full on the first
+    check and again at most every poll_interval seconds. Logouts in
+    this worker are seen at once, those of other workers after the next poll,
+    or straight away when they are published on Redis. Expired tokens are
+    dropped at each poll, like the pruning job drops their rows.
+    """
+
+    def __init__(self, poll_interval=5, redis_url=None, channel="auth:blacklist"):
+        self.poll_interval = poll_interval
+        self.channel = channel
+        self.redis = redis.StrictRedis.from_url(redis_url) if redis_url else None
+        # token hash -> utc timestamp of its expiry
+        self._hashes = dict()
+        self._next_poll = 0
+        self._lock = threading.Lock()
+        self._subscriber = None
+
+    def __contains__(self, digest):
+        self.refresh()
+        return digest in self._hashes
+
+    def add(self, digest, expires_at):
+        self._hashes[digest] = expires_at
+
+    def refresh(self, force=False):
+        """Reloads the unexpired rows of the blacklist table when a poll is due.
+
+        Rows are read in full rather than after the last id seen: logouts can
+        commit out of id order, and the table only holds unexpired tokens.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return
+        with self._lock:
+            if not force and now < self._next_poll:
+                return
+            rows = BlackListToken.query.with_entities(BlackListToken.token_hash, BlackListToken.expires_at) \
+                .filter(BlackListToken.expires_at > datetime.utcnow()).all()
+            current = time.time()
+            # revocations seen here or on Redis that the poll may not see committed yet
+            hashes = {digest: expires_at for digest, expires_at in self._hashes.items() if expires_at > current}
+            for digest, expires_at in rows:
+                hashes[digest] = expires_at.replace(tzinfo=timezone.utc).timestamp()
+            self._hashes = hashes
+            self._next_poll = now + self.poll_interval
+
+    def publish(self, digest, expires_at):
+        """Tells the other workers about a logout"""
+        if self.redis is None:
+            return
+        try:
+            self.redis.publish(self.channel, f"{digest} {expires_at}")
+        except redis.RedisError as e:
+            print("Token blacklist channel unavailable: ", e)
+
+    def subscribe(self):
+        """Starts the thread that adds the logouts published by other workers"""
+        if self.redis is None or self._subscriber is not None:
+            return
+        self._subscriber = threading.Thread(target=self._listen, name="token-blacklist", daemon=True)
+        self._subscriber.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    data = message["data"]
+                    digest, expires_at = (data.decode() if isinstance(data, bytes) else data).split()
+                    self._hashes[digest] = float(expires_at)
+            except redis.RedisError as e:
+                print("Token blacklist channel unavailable: ", e)
+                # logouts published meanwhile are picked up by the next poll
+                self._next_poll = 0
+                time.sleep(self.poll_interval)
+
+
+# who made a request, as the decorators put it on flask.g
+Principal = namedtuple("Principal", ["id", "role", "project_id", "site", "name"])
+
+
+class PrincipalCache(TTLCache):
+    """LRU of the principals of recent users, each kept for ttl seconds.
+
+    Saves the user lookup of every authenticated request. Admin edits of a
+    user invalidate its entry in the worker that served them, the other
+    workers see the change once the entry's ttl is up.
+    """
+
+    def __init__(self, max_entries=10000, ttl=30):
+        super().__init__(max_entries, ttl)
+
+    def add(self, principal):
+        super().add(principal.id, principal)
+
+
+verified_tokens = VerifiedTokens()
+blacklist = TokenBlacklist()
+principals = PrincipalCache()
+
+
+def configure(app):
+    """Sizes the token caches from AUTH_TOKEN_CACHE_SIZE, AUTH_BLACKLIST_POLL_INTERVAL
+    and AUTH_BLACKLIST_REDIS_URL, and the principal cache from AUTH_PRINCIPAL_TTL"""
+    global blacklist
+    verified_tokens.max_entries = app.config.get("AUTH_TOKEN_CACHE_SIZE", 10000)
+    verified_tokens.clear()
+    principals.max_entries = app.config.get("AUTH_TOKEN_CACHE_SIZE", 10000)
+    principals.ttl = app.config.get("AUTH_PRINCIPAL_TTL", 30)
+    principals.clear()
+    blacklist = TokenBlacklist(app.config.get("AUTH_BLACKLIST_POLL_INTERVAL", 5),
+                               app.config.get("AUTH_BLACKLIST_REDIS_URL"))
+    blacklist.subscribe()
+
+
+def verify_token(token):
+    """Returns the subject of a token that is valid and not blacklisted.
+
+    Raises InvalidToken for an invalid or expired token and returns None for
+    a blacklisted one. Neither the database nor the JWT code is touched for a
+    token seen before, until the next blacklist poll.
+    """
+    digest = token_hash(token)
+    if digest in blacklist:
+        verified_tokens.discard(digest)
+        return None
+    subject = verified_tokens.get(digest)
+    if subject is not None:
+        return subject
+    try:
+        payload = jwt.decode(token, current_app.config.get("SECRET"), algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise InvalidToken("Expired token. Please login to get a new token")
+    except jwt.InvalidTokenError:
+        raise InvalidToken("Invalid token. Please register or login")
+    verified_tokens.add(digest, payload["sub"], payload.get("exp", 0))
+    return payload["sub"]
+
+
+def revoke_token(token):
+    """Drops a logged out token from the caches of every worker"""
+    digest = token_hash(token)
+    expires_at = BlackListToken.expiry(token).replace(tzinfo=timezone.utc).timestamp()
+    blacklist.add(digest, expires_at)
+    verified_tokens.discard(digest)
+    blacklist.publish(digest, expires_at)
+
+
+def load_principal(user_id):
+    """Returns the principal of a user, from the cache when it is fresh, or None
+    for a user that does not exist"""
+    user_id = int(user_id)
+    principal = principals.get(user_id)
+    if principal is not None:
+        return principal
+    row = User.query.with_entities(
+        User.id, User.is_admin, User.project_admin, User.project_id, User.site, User.username
+    ).filter_by(id=user_id).first()
+    if row is None:
+        return None
+    _, is_admin, project_admin, project_id, site, name = row
+    role = "admin" if is_admin else "project_admin" if project_admin else "user"
+    principal = Principal(user_id, role, project_id, site, name)
+    principals.add(principal)
+    return principal
+
+
+def invalidate_principal(user_id):
+    """Drops a user's cached principal after the user was changed"""
+    principals.discard(int(user_id))
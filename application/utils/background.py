@@ -0,0 +1,76 @@
+import functools
+import threading
+
+
+class BackgroundWorker(object):
+    """Runs ``run_once`` on a few daemon threads of the process.
+
+    Each thread calls ``run_once`` while it reports work done, then sleeps
+    for poll_interval seconds or until ``notify`` is called. Subclasses set
+    ``name`` and implement ``run_once``; ``idle`` runs before each sleep.
+    """
+
+    name = "background-worker"
+
+    def __init__(self, app, threads=1, poll_interval=1.0):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._threads = list()
+        self._lock = threading.Lock()
+
+    def run_once(self):
+        """Does one unit of work, returns False when there was none"""
+        raise NotImplementedError
+
+    def idle(self):
+        """Called when there is no work left, before waiting for more"""
+
+    def run_forever(self):
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                print(f"{self.name} error: ", e)
+            self.idle()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def start(self):
+        """Starts the threads once per process"""
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.threads:
+                thread = threading.Thread(target=self.run_forever, name=self.name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        """Wakes the threads after work was queued"""
+        if self.threads:
+            self.start()
+        self._wake.set()
+
+
+def per_process(factory):
+    """Makes factory build its object on the first call and return it after,
+    until ``reset()`` is called on the returned function"""
+    instance = list()
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get(*args, **kwargs):
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory(*args, **kwargs))
+        return instance[0]
+
+    def reset():
+        with lock:
+            instance.clear()
+
+    get.reset = reset
+    return get
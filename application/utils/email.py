@@ -1,13 +1,137 @@
-from flask_mail import Message, Mail 
+from flask_mail import Message, Mail
 from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from datetime import timedelta
 import os
+import threading
+
+from application.utils.background import BackgroundWorker, per_process
 mail = Mail()
 
-def send_email(to, subject, template):
-    msg = Message(
-        subject, 
-        recipients=[to],
+def queue_email(to, subject, template):
+    """Adds an email to the outbox in the caller's transaction, the outbox sender
+    is woken when it commits"""
+    from application import db
+    from application.models import OutboxEmail
+
+    email = OutboxEmail(
+        recipient=to,
+        subject=subject,
         html=template,
-        sender=os.getenv("MAIL_USERNAME")
+        sender=os.getenv("MAIL_USERNAME") or current_app.config.get("MAIL_DEFAULT_SENDER"),
+    )
+    db.session.add(email)
+    db.session.info["outbox_app"] = current_app._get_current_object()
+    return email
+
+
+def send_email(to, subject, template):
+    """Queues an email in the outbox, the outbox sender delivers it"""
+    email = queue_email(to, subject, template)
+    email.save()
+    return email
+
+
+@event.listens_for(SignallingSession, "after_commit")
+def wake_sender(session):
+    app = session.info.pop("outbox_app", None)
+    if app is not None:
+        get_sender(app).notify()
+
+
+@event.listens_for(SignallingSession, "after_rollback")
+def discard_wake(session):
+    session.info.pop("outbox_app", None)
+
+
+class OutboxSender(BackgroundWorker):
+    """Delivers the emails queued in the outbox_emails table.
+
+    Due emails are claimed in batches with SKIP LOCKED, so the in-process
+    threads of every web worker and any ``manage.py email_worker`` can share
+    the outbox, and go out over one SMTP connection that stays open while
+    there is more to send. A failed email is retried after backoff seconds,
+    doubled with each attempt, until max_attempts.
+    """
+
+    name = "outbox-sender"
+
+    def __init__(self, app, threads=1, batch_size=20, poll_interval=5.0, max_attempts=8, backoff=30,
+                 stale_after=300):
+        super().__init__(app, threads, poll_interval)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self._connection = None
+        self._send_lock = threading.Lock()
+
+    def run_once(self):
+        """Sends one batch of due emails, returns False when none are due"""
+        from application import db
+        from application.models import OutboxEmail
+
+        with self.app.app_context(), self._send_lock:
+            emails = OutboxEmail.claim(self.batch_size, self.stale_after)
+            if not emails:
+                return False
+            sent, failed = list(), list()
+            for email_id, recipient, subject, html, sender, attempts in emails:
+                try:
+                    message = Message(subject, recipients=[recipient], html=html, sender=sender)
+                    self._connect().send(message)
+                    sent.append(email_id)
+                except Exception as e:
+                    print(f"Sending email {email_id} failed: ", e)
+                    failed.append((email_id, attempts, str(e)))
+                    # the next email gets a fresh connection
+                    self.close()
+            if sent:
+                OutboxEmail.query.filter(OutboxEmail.id.in_(sent)).update(
+                    {OutboxEmail.status: "sent", OutboxEmail.sent_at: db.func.current_timestamp(),
+                     OutboxEmail.last_error: None},
+                    synchronize_session=False)
+            for email_id, attempts, error in failed:
+                if attempts >= self.max_attempts:
+                    changes = {OutboxEmail.status: "failed"}
+                else:
+                    delay = timedelta(seconds=self.backoff * 2 ** (attempts - 1))
+                    changes = {OutboxEmail.status: "pending",
+                               OutboxEmail.next_attempt_at: db.func.current_timestamp() + delay}
+                changes[OutboxEmail.last_error] = error
+                OutboxEmail.query.filter_by(id=email_id).update(changes, synchronize_session=False)
+            db.session.commit()
+        return True
+
+    def idle(self):
+        # nothing due, the mail server need not keep an idle connection
+        self.close()
+
+    def close(self):
+        """Closes the SMTP connection"""
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception as e:
+                print("Closing the SMTP connection failed: ", e)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = mail.connect().__enter__()
+        return self._connection
+
+
+@per_process
+def get_sender(app):
+    """Returns this process's outbox sender"""
+    return OutboxSender(
+        app,
+        threads=app.config.get("OUTBOX_SENDER_THREADS", 1),
+        batch_size=app.config.get("OUTBOX_BATCH_SIZE", 20),
+        poll_interval=app.config.get("OUTBOX_POLL_INTERVAL", 5.0),
+        max_attempts=app.config.get("OUTBOX_MAX_ATTEMPTS", 8),
+        backoff=app.config.get("OUTBOX_RETRY_BACKOFF", 30),
+        stale_after=app.config.get("OUTBOX_SEND_TIMEOUT", 300),
     )
-    mail.send(msg)
\ No newline at end of file
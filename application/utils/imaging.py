@@ -0,0 +1,101 @@
+import io
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+
+RESIZED_SIZE = (512, 512)
+THUMBNAIL_SIZE = (128, 128)
+
+# original holds the uploaded bytes untouched, resized and thumbnail are JPEG encoded
+ProcessedImage = namedtuple("ProcessedImage", ["mimetype", "original", "resized", "thumbnail"])
+
+
+def _encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def process_image(data):
+    """Decodes image bytes once and returns the original with its resized copy and thumbnail"""
+    from PIL import Image as Img
+
+    image = Img.open(io.BytesIO(data))
+    mimetype = image.get_format_mimetype()
+    image = image.convert("RGB")
+    resized = image.resize(RESIZED_SIZE, Img.LANCZOS)
+    thumbnail = resized.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Img.LANCZOS)
+    return ProcessedImage(mimetype, data, _encode(resized), _encode(thumbnail))
+
+
+def process_file(path):
+    """Like process_image for an image already on disk, without sending its bytes back"""
+    with open(path, "rb") as f:
+        processed = process_image(f.read())
+    return processed._replace(original=None)
+
+
+class ImageProcessor(object):
+    """Decodes, resizes and thumbnails images on a pool of worker processes.
+
+    Decoding and resampling hold the GIL, so doing them on request threads
+    keeps a worker on a single core. With ``workers=0`` images are processed
+    inline, which is what the tests use.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, workers):
+        self.close()
+        self.workers = workers
+
+    def process(self, data):
+        return self.process_many([data])[0]
+
+    def process_many(self, datas):
+        """Processes several images in parallel, results are in the same order"""
+        return self._map(process_image, datas)
+
+    def process_files(self, paths):
+        return self._map(process_file, paths)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+    def _map(self, fn, args):
+        args = list(args)
+        if not args:
+            return []
+        pool = self._get_pool()
+        if pool is None:
+            return [fn(arg) for arg in args]
+        return pool.map(fn, args)
+
+    def _get_pool(self):
+        if not self.workers:
+            return None
+        # a pool is only usable in the process that created it, uWSGI workers get their own
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = multiprocessing.Pool(self.workers)
+                    self._pid = os.getpid()
+        return self._pool
+
+
+image_processor = ImageProcessor()
+
+
+def configure(app):
+    """Sizes the shared image processor from IMAGE_WORKERS"""
+    image_processor.configure(app.config.get("IMAGE_WORKERS", 0))
+
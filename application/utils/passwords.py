@@ -0,0 +1,104 @@
+import math
+import threading
+import time
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised instead of queueing a hash when the hasher already has all it can take"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many logins, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class PasswordHasher(object):
+    """Bounds how many request threads of a process run bcrypt at once.
+
+    bcrypt releases the GIL, so a burst of logins can hold every request
+    thread of every process while labelling requests queue behind them. Here
+    at most ``workers`` hashes run at once and at most ``max_pending`` more
+    wait up to ``max_wait`` seconds for their turn; beyond that callers get
+    PasswordHasherBusy, with an estimate of when to retry. The waiting time
+    bounds how long a login holds a request thread it is not hashing on.
+    """
+
+    def __init__(self, workers=1, max_pending=1, rounds=12, max_wait=0.5):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.max_wait = max_wait
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._running = threading.BoundedSemaphore(workers)
+        self._in_flight = 0
+        # moving average of the seconds a hash takes, for Retry-After
+        self._duration = 0.25
+        self._lock = threading.Lock()
+
+    def configure(self, workers, max_pending, rounds, max_wait=0.5):
+        with self._lock:
+            self.workers = workers
+            self.max_pending = max_pending
+            self.rounds = rounds
+            self.max_wait = max_wait
+            self._slots = threading.BoundedSemaphore(workers + max_pending)
+            self._running = threading.BoundedSemaphore(workers)
+
+    def hash(self, password):
+        """Returns the bcrypt hash of a password, as a string"""
+        return self._run(lambda: bcrypt.hashpw(_bytes(password), bcrypt.gensalt(self.rounds)).decode())
+
+    def check(self, pw_hash, password):
+        """Checks a password against its bcrypt hash"""
+        return self._run(lambda: bcrypt.checkpw(_bytes(password), _bytes(pw_hash)))
+
+    def retry_after(self):
+        """Seconds until the queue in front of a new hash has likely drained"""
+        with self._lock:
+            return max(1, math.ceil(self._in_flight * self._duration / max(self.workers, 1)))
+
+    def _run(self, fn):
+        with self._lock:
+            slots, running = self._slots, self._running
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy(self.retry_after())
+        try:
+            with self._lock:
+                self._in_flight += 1
+            if not running.acquire(timeout=self.max_wait):
+                raise PasswordHasherBusy(self.retry_after())
+            # hashed on the caller's thread, which has to wait for the result anyway
+            try:
+                return self._timed(fn)
+            finally:
+                running.release()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            slots.release()
+
+    def _timed(self, fn):
+        start = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._duration = 0.8 * self._duration + 0.2 * elapsed
+
+
+def _bytes(value):
+    return value.encode() if isinstance(value, str) else value
+
+
+password_hasher = PasswordHasher()
+
+
+def configure(app):
+    """Sizes the password hasher from PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE,
+    PASSWORD_HASH_MAX_WAIT and BCRYPT_LOG_ROUNDS"""
+    password_hasher.configure(app.config.get("PASSWORD_HASH_WORKERS", 1),
+                              app.config.get("PASSWORD_HASH_QUEUE", 1),
+                              app.config.get("BCRYPT_LOG_ROUNDS", 12),
+                              app.config.get("PASSWORD_HASH_MAX_WAIT", 0.5))
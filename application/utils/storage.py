@@ -0,0 +1,139 @@
+import hashlib
+import os
+import uuid
+from collections import namedtuple
+
+from application.utils.uploads import CHUNK_SIZE, sniff_image_type
+
+extensions = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+}
+
+# created is False when identical content was already stored
+StoredImage = namedtuple("StoredImage", ["digest", "size", "ext", "created"])
+
+
+class ContentStore(object):
+    """Stores files under the SHA-256 of their content.
+
+    Originals live at ``original/ab/cd/<digest><ext>`` below the root and
+    derived versions (resized copies, thumbnails) under their own variant
+    directory with the same digest, so identical uploads share one file no
+    matter their name or dataset. Image rows hold the digest and are the
+    reference count: blobs no row points at, left by deleted images or failed
+    uploads, are removed by the garbage collection of application.maintenance
+    once they have not been written for a grace period. Storing content that
+    is already there touches its blob, so a blob an upload is about to
+    reference again is not collected.
+    """
+
+    def __init__(self, root, url_prefix):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def relative_path(self, digest, variant="original", ext=".jpg"):
+        return "/".join([self.url_prefix, variant, digest[:2], digest[2:4], digest + ext])
+
+    def path(self, digest, variant="original", ext=".jpg"):
+        return os.path.join(self.root, variant, digest[:2], digest[2:4], digest + ext)
+
+    def exists(self, digest, variant="original", ext=".jpg"):
+        return os.path.exists(self.path(digest, variant, ext))
+
+    def put_bytes(self, data, ext=None):
+        """Stores data unless identical content is already stored, returns a StoredImage"""
+        ext = ext or extensions.get(sniff_image_type(data[:16]), "")
+        digest = hashlib.sha256(data).hexdigest()
+        if self.exists(digest, ext=ext):
+            self._touch(self.path(digest, ext=ext))
+            return StoredImage(digest, len(data), ext, False)
+        partial = self._partial_path()
+        with open(partial, "wb") as f:
+            f.write(data)
+        return StoredImage(digest, len(data), ext, self._commit(partial, self.path(digest, ext=ext)))
+
+    def put_stream(self, stream, header=b"", ext=None, chunk_size=CHUNK_SIZE):
+        """Like put_bytes for a file-like object, hashing it while it is copied in chunks.
+        header holds bytes already read from the stream to sniff its type."""
+        header = header or stream.read(16)
+        ext = ext or extensions.get(sniff_image_type(header), "")
+        sha = hashlib.sha256()
+        size = 0
+        partial = self._partial_path()
+        with open(partial, "wb") as f:
+            chunk = header
+            while chunk:
+                sha.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+                chunk = stream.read(chunk_size)
+        digest = sha.hexdigest()
+        return StoredImage(digest, size, ext, self._commit(partial, self.path(digest, ext=ext)))
+
+    def put_variant(self, digest, variant, data, ext=".jpg"):
+        """Stores a derived version of the original with the given digest"""
+        partial = self._partial_path()
+        with open(partial, "wb") as f:
+            f.write(data)
+        self._commit(partial, self.path(digest, variant, ext))
+
+    def add_derivatives(self, stored_images, processor):
+        """Makes the resized copy and thumbnail of stored originals that do not have them yet.
+        The processor reads the originals from disk, so only new content is decoded."""
+        missing = dict()
+        for stored in stored_images:
+            if stored.digest not in missing and not self.exists(stored.digest, "resized"):
+                missing[stored.digest] = stored
+        missing = list(missing.values())
+        paths = [self.path(stored.digest, ext=stored.ext) for stored in missing]
+        for stored, processed in zip(missing, processor.process_files(paths)):
+            self.put_variant(stored.digest, "resized", processed.resized)
+            self.put_variant(stored.digest, "thumbnails", processed.thumbnail)
+
+    def remove(self, digest):
+        """Deletes a blob and its derived versions"""
+        paths = [self.path(digest, ext=ext) for ext in set(extensions.values()) | {""}]
+        paths += [self.path(digest, variant) for variant in ("resized", "thumbnails")]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def digests(self, older_than=None):
+        """Yields the digest and extension of every stored original, or with older_than
+        of those last written before that timestamp"""
+        for directory, _, files in os.walk(os.path.join(self.root, "original")):
+            for name in files:
+                if older_than is not None:
+                    try:
+                        if os.path.getmtime(os.path.join(directory, name)) >= older_than:
+                            continue
+                    except OSError:
+                        continue
+                digest, ext = os.path.splitext(name)
+                yield digest, ext
+
+    def _partial_path(self):
+        tmp = os.path.join(self.root, "tmp")
+        os.makedirs(tmp, exist_ok=True)
+        return os.path.join(tmp, uuid.uuid4().hex + ".part")
+
+    def _commit(self, partial, path):
+        """Links the finished temporary file into place. Returns False when
+        identical content got there first, in which case it is reused."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(partial, path)
+            created = True
+        except FileExistsError:
+            created = False
+            self._touch(path)
+        os.remove(partial)
+        return created
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
@@ -0,0 +1,16 @@
+CHUNK_SIZE = 64 * 1024
+
+# leading bytes of the image formats we accept
+image_signatures = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+]
+
+
+def sniff_image_type(header):
+    """Returns the mimetype of an image from its first bytes, or None"""
+    for signature, mimetype in image_signatures:
+        if header.startswith(signature):
+            return mimetype
+    return None
+
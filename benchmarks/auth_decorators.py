@@ -0,0 +1,89 @@
+"""Per-request overhead of the authentication decorators.
+
+Compares the old check (a blacklist query followed by a full JWT decode) against ``user_is_authenticated`` with the in-memory token
+caches, for the same token presented again and again like a labelling
+session does. The blacklist table gets --blacklisted rows first so the old
+query is not answered from an empty table.
+
+Run from the repository root against the database of the chosen config:
+
+    python benchmarks/auth_decorators.py --requests 5000 --blacklisted 10000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+
+from application import create_app, db  # noqa: E402
+
+
+def legacy_check(access_token):
+    """What the decorators did before the token caches"""
+    from application.models import BlackListToken, User
+
+    if BlackListToken.check_blacklist(access_token):
+        return None
+    return User.decode_token(access_token)
+
+
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print("{:<8} mean {:>8.1f} us   p50 {:>8.1f} us   p99 {:>8.1f} us".format(
+        name, statistics.mean(samples) * 1e6, samples[len(samples) // 2] * 1e6,
+        samples[int(len(samples) * 0.99)] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--blacklisted", type=int, default=10000)
+    parser.add_argument("--config", default=os.getenv("APP_SETTINGS", "testing"))
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    from application.decorators import user_is_authenticated
+    from application.models import BlackListToken, User
+
+    with app.app_context():
+        db.create_all()
+        user = User(email="benchmark@test.com", password="benchmark", is_admin="")
+        user.save()
+        token = user.generate_token(user.id)
+        if isinstance(token, bytes):
+            token = token.decode()
+        user_id = user.id
+        db.session.bulk_save_objects([BlackListToken(token=f"revoked-{i}") for i in range(args.blacklisted)])
+        db.session.commit()
+
+    view = user_is_authenticated()(lambda: None)
+    headers = {"Authorization": f"Bearer {token}", "user_id": str(user_id)}
+    try:
+        with app.test_request_context("/", headers=headers):
+            # warm both paths, which also fills the caches the first time
+            legacy_check(token)
+            view()
+            report("before", measure(lambda: legacy_check(token), args.requests))
+            report("after", measure(view, args.requests))
+    finally:
+        # only the rows made here are removed
+        with app.app_context():
+            revoked = [BlackListToken.hash(f"revoked-{i}") for i in range(args.blacklisted)]
+            BlackListToken.query.filter(BlackListToken.token_hash.in_(revoked)).delete(synchronize_session=False)
+            User.query.filter_by(id=user_id).delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Labelling latency while a whole site logs in at once.
+
+Requests are served like app.ini deploys the API: --processes worker
+processes with --threads request threads each, all taking the next request
+from one shared queue as uWSGI's workers do from its socket. A few clients
+keep requesting the user's datasets, like annotators in the middle of a
+session, while --logins clients post to /auth/login/ as fast as they are
+answered. Reports the labelling latency without logins, then during the
+storm with bcrypt unbounded on every request thread as before, then with
+the password hasher sized from the config, along with how many logins were
+served or turned away.
+
+Run from the repository root against the database of the chosen config:
+
+    python benchmarks/login_storm.py --processes 8 --threads 2 --logins 32 --seconds 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.getcwd())
+
+from application import create_app, db  # noqa: E402
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)] * 1000 if samples else 0.0
+
+
+def serve(args, headers, path, bounded, requests, responses):
+    """One worker process, answering requests on args.threads threads"""
+    from application.utils import passwords
+
+    app = create_app(args.config)
+    app.config["BCRYPT_LOG_ROUNDS"] = args.rounds
+    if bounded:
+        passwords.configure(app)
+    else:
+        # as many hashes at once as there are request threads, like bcrypt on the request threads
+        passwords.password_hasher.configure(args.threads, 0, args.rounds)
+    body = json.dumps({"email": "storm@test.com", "password": "storm1234"})
+
+    def handle():
+        client = app.test_client()
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            client_id, kind = request
+            if kind == "login":
+                res = client.post("/api/v1/auth/login/", data=body, content_type="application/json")
+            else:
+                res = client.get(path, headers=headers)
+            responses.put((client_id, res.status_code))
+
+    threads = [threading.Thread(target=handle) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run(args, headers, path, logins, bounded):
+    """Returns the labelling latencies and the login status codes of one run"""
+    requests, responses = multiprocessing.Queue(), multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=serve, args=(args, headers, path, bounded, requests, responses))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    kinds = ["label"] * args.labellers + ["login"] * logins
+    inboxes = [queue.Queue() for _ in kinds]
+
+    def route():
+        while True:
+            response = responses.get()
+            if response is None:
+                return
+            client_id, status = response
+            inboxes[client_id].put(status)
+
+    stop = threading.Event()
+    latencies = list()
+    statuses = Counter()
+
+    def client(client_id, kind):
+        while not stop.is_set():
+            start = time.perf_counter()
+            requests.put((client_id, kind))
+            status = inboxes[client_id].get()
+            if kind == "login":
+                statuses[status] += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    router = threading.Thread(target=route)
+    router.start()
+    # let every worker load the app before timing anything
+    time.sleep(2)
+    clients = [threading.Thread(target=client, args=(client_id, kind)) for client_id, kind in enumerate(kinds)]
+    for thread in clients:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in clients:
+        thread.join()
+    for _ in range(args.processes * args.threads):
+        requests.put(None)
+    for worker in workers:
+        worker.join()
+    responses.put(None)
+    router.join()
+    return latencies, statuses
+
+
+def report(name, latencies, statuses):
+    print("{:<10} labelling p50 {:>8.1f} ms   p99 {:>8.1f} ms   logins {}".format(
+        name, percentile(latencies, 50), percentile(latencies, 99), dict(statuses) or "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--labellers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--config", default=os.getenv("APP_SETTINGS", "testing"))
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    app.config["BCRYPT_LOG_ROUNDS"] = args.rounds
+    from application.models import User
+    from application.utils import passwords
+
+    passwords.configure(app)
+    with app.app_context():
+        db.create_all()
+        user = User(email="storm@test.com", password="storm1234", is_admin="")
+        user.save()
+        token = user.generate_token(user.id)
+        if isinstance(token, bytes):
+            token = token.decode()
+        user_id = user.id
+    headers = {"Authorization": f"Bearer {token}", "user_id": str(user_id)}
+    path = f"/api/v1/user/{user_id}/datasets/"
+
+    try:
+        report("idle", *run(args, headers, path, 0, True))
+        report("before", *run(args, headers, path, args.logins, False))
+        report("after", *run(args, headers, path, args.logins, True))
+    finally:
+        # only the rows made here are removed
+        with app.app_context():
+            User.query.filter_by(id=user_id).delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Per-image inference latency of the external prediction model.
+
+Compares the old behaviour of ``predict_image`` (reset the default graph,
+re-import ``graph_def`` and open a fresh session for every image) against the
+persistent ``ModelRuntime`` that is built once in ``initialize()``.
+
+Run from the repository root:
+
+    python benchmarks/predict_latency.py path/to/image.jpg --runs 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+sys.path.insert(0, os.getcwd())
+
+from application import create_app  # noqa: E402
+
+
+def percentile(samples, pct):
+    return float(np.percentile(np.array(samples) * 1000, pct))
+
+
+def legacy_run(predict, graph_def, cropped_image):
+    """The per-call graph import that predict_image used to do"""
+    tf.compat.v1.reset_default_graph()
+    tf.import_graph_def(graph_def, name="")
+    with tf.compat.v1.Session() as sess:
+        prob_tensor = sess.graph.get_tensor_by_name(predict.output_layer)
+        (predictions,) = sess.run(prob_tensor, {predict.input_node: [cropped_image]})
+    return predictions
+
+
+def measure(fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples):
+    print("{:<10} p50 {:>9.2f} ms   p99 {:>9.2f} ms".format(
+        name, percentile(samples, 50), percentile(samples, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app(os.getenv("APP_SETTINGS", "development"))
+    with app.app_context():
+        from application.external import predict
+    predict.get_scheduler()
+
+    cropped_image = predict.preprocess_image(Image.open(args.image))
+
+    graph_def = tf.compat.v1.GraphDef()
+    with open(predict.filename, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    # warm both paths once so the first-call allocation is not measured
+    legacy_run(predict, graph_def, cropped_image)
+    predict.runtime.run([cropped_image])
+
+    report("before", measure(lambda: legacy_run(predict, graph_def, cropped_image), args.runs))
+    report("after", measure(lambda: predict.runtime.run([cropped_image]), args.runs))
+
+
+if __name__ == "__main__":
+    main()
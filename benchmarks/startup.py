@@ -0,0 +1,52 @@
+"""Start-up time of the application factory.
+
+Each run happens in a fresh interpreter so module imports are measured too.
+Reports the time to import ``application`` and to run ``create_app``, and
+whether TensorFlow, pandas or PIL had to be imported along the way.
+
+Run from the repository root:
+
+    python benchmarks/startup.py --runs 5 --config testing
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, os, sys, time
+start = time.perf_counter()
+from application import create_app
+imported = time.perf_counter()
+create_app(os.environ["STARTUP_CONFIG"])
+created = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "modules": {name: name in sys.modules for name in ("tensorflow", "pandas", "PIL", "mscviplib")},
+}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--config", default=os.getenv("APP_SETTINGS", "testing"))
+    args = parser.parse_args()
+
+    env = dict(os.environ, STARTUP_CONFIG=args.config)
+    samples = list()
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", PROBE], cwd=os.getcwd(), env=env)
+        samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    for key in ("import_ms", "create_app_ms"):
+        values = [sample[key] for sample in samples]
+        print("{:<14} median {:>9.1f} ms   max {:>9.1f} ms".format(key, statistics.median(values), max(values)))
+    print("modules loaded:", samples[-1]["modules"])
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,65 @@ class Config(object):
     MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
     MAIL_USE_TLS = False
     MAIL_USE_SSL =True
+    # processes used to decode, resize and thumbnail uploaded images, 0 processes them inline
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", min(os.cpu_count() or 1, 4)))
+    # the external model loads lazily, MODEL_WARMUP starts loading it as soon as a worker starts
+    MODEL_RUNTIME_FACTORY = os.getenv("MODEL_RUNTIME_FACTORY", "application.external.predict:ModelRuntime")
+    MODEL_WARMUP = os.getenv("MODEL_WARMUP", "false").lower() == "true"
+    # cross-request batching of external predictions
+    INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", 8))
+    INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", 5))
+    # downloads of external study pictures
+    FETCH_POOL_SIZE = int(os.getenv("FETCH_POOL_SIZE", 16))
+    FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", 5))
+    FETCH_READ_TIMEOUT = float(os.getenv("FETCH_READ_TIMEOUT", 30))
+    # cache of external predictions, the Redis tier is optional
+    PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", 1024))
+    PREDICTION_CACHE_TTL = int(os.getenv("PREDICTION_CACHE_TTL", 86400))
+    PREDICTION_CACHE_REDIS_URL = os.getenv("PREDICTION_CACHE_REDIS_URL", os.getenv("REDIS_URL"))
+    # /upload?async=1 jobs, set INGESTION_WORKER_THREADS to 0 when only `manage.py ingest_worker` runs them
+    INGESTION_WORKER_THREADS = int(os.getenv("INGESTION_WORKER_THREADS", 1))
+    INGESTION_POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", 1))
+    # a running job not touched for INGESTION_JOB_TIMEOUT seconds is started again,
+    # up to INGESTION_MAX_ATTEMPTS times in all before it is marked failed
+    INGESTION_JOB_TIMEOUT = int(os.getenv("INGESTION_JOB_TIMEOUT", 600))
+    INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", 3))
+    # rows per page of the list endpoints, ?limit= can ask for up to MAX_PAGE_SIZE
+    PAGE_SIZE = int(os.getenv("PAGE_SIZE", 100))
+    MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+    # unlabelled images handed out per request of the labelling queue, ?count= overrides it
+    LABELLING_QUEUE_SIZE = int(os.getenv("LABELLING_QUEUE_SIZE", 20))
+    # how long an image leased from /user/datasets/<id>/leases stays with the annotator unless renewed
+    LABEL_LEASE_SECONDS = int(os.getenv("LABEL_LEASE_SECONDS", 600))
+    # verified tokens kept per worker, and how often each worker reads new logouts from the
+    # blacklist table; with a Redis url logouts also reach the other workers straight away
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+    AUTH_BLACKLIST_POLL_INTERVAL = float(os.getenv("AUTH_BLACKLIST_POLL_INTERVAL", 5))
+    AUTH_BLACKLIST_REDIS_URL = os.getenv("AUTH_BLACKLIST_REDIS_URL", os.getenv("REDIS_URL"))
+    # seconds a worker keeps a user's id, role, project and site before reading them again
+    AUTH_PRINCIPAL_TTL = float(os.getenv("AUTH_PRINCIPAL_TTL", 30))
+    # seconds between deletes of expired blacklisted tokens, 0 leaves it to `manage.py prune_blacklist`
+    BLACKLIST_PRUNE_INTERVAL = int(os.getenv("BLACKLIST_PRUNE_INTERVAL", 3600))
+    # seconds between collections of stored images no row points at, 0 leaves it to
+    # `manage.py collect_blobs`; blobs written within BLOB_GC_GRACE seconds are kept
+    BLOB_GC_INTERVAL = int(os.getenv("BLOB_GC_INTERVAL", 86400))
+    BLOB_GC_GRACE = int(os.getenv("BLOB_GC_GRACE", 86400))
+    # bcrypt runs on up to PASSWORD_HASH_WORKERS request threads per process, up to
+    # PASSWORD_HASH_QUEUE more logins wait at most PASSWORD_HASH_MAX_WAIT seconds for
+    # their turn, further logins get a 503 with Retry-After
+    BCRYPT_LOG_ROUNDS = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 1))
+    PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 1))
+    PASSWORD_HASH_MAX_WAIT = float(os.getenv("PASSWORD_HASH_MAX_WAIT", 0.5))
+    # emails are queued in outbox_emails and sent in batches by OUTBOX_SENDER_THREADS per process,
+    # set it to 0 when only `manage.py email_worker` sends them; failures are retried after
+    # OUTBOX_RETRY_BACKOFF seconds, doubled on each attempt, up to OUTBOX_MAX_ATTEMPTS
+    OUTBOX_SENDER_THREADS = int(os.getenv("OUTBOX_SENDER_THREADS", 1))
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 20))
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+    OUTBOX_RETRY_BACKOFF = int(os.getenv("OUTBOX_RETRY_BACKOFF", 30))
+    OUTBOX_SEND_TIMEOUT = int(os.getenv("OUTBOX_SEND_TIMEOUT", 300))
 
 class DevelopmentConfig(Config):
     """Configurations for Development"""
@@ -26,6 +85,11 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL')
     DEBUG = True
+    IMAGE_WORKERS = 0
+    BLACKLIST_PRUNE_INTERVAL = 0
+    BLOB_GC_INTERVAL = 0
+    BCRYPT_LOG_ROUNDS = 4
+    OUTBOX_SENDER_THREADS = 0
 
 class StagingConfig(Config):
     """Configurations for Staging."""
@@ -35,6 +99,7 @@ class ProductionConfig(Config):
     """Configurations for Production."""
     DEBUG = False
     TESTING = False
+    MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() == "true"
 
 app_config = {
     'development': DevelopmentConfig,
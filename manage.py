@@ -25,5 +25,59 @@ def test():
         return 0
     return 1
 
+@manager.command
+def ingest_worker():
+    """Runs queued /upload?async=1 study ingestions"""
+    from application.external import ingest_study
+    from application.external.jobs import IngestionWorker
+    worker = IngestionWorker(
+        app,
+        ingest_study,
+        poll_interval=app.config["INGESTION_POLL_INTERVAL"],
+        stale_after=app.config["INGESTION_JOB_TIMEOUT"],
+        max_attempts=app.config["INGESTION_MAX_ATTEMPTS"],
+    )
+    worker.run_forever()
+
+@manager.command
+def rebuild_progress():
+    """Recomputes the dataset and user progress counters from the label tables"""
+    from application import progress
+    progress.rebuild(db.session.connection())
+    db.session.commit()
+
+@manager.command
+def email_worker():
+    """Sends the emails queued in the outbox"""
+    from application.utils.email import OutboxSender
+    sender = OutboxSender(
+        app,
+        batch_size=app.config["OUTBOX_BATCH_SIZE"],
+        poll_interval=app.config["OUTBOX_POLL_INTERVAL"],
+        max_attempts=app.config["OUTBOX_MAX_ATTEMPTS"],
+        backoff=app.config["OUTBOX_RETRY_BACKOFF"],
+        stale_after=app.config["OUTBOX_SEND_TIMEOUT"],
+    )
+    sender.run_forever()
+
+@manager.command
+def prune_blacklist():
+    """Deletes the blacklist entries of tokens that have expired"""
+    from application.models import BlackListToken
+    print(f"Pruned {BlackListToken.prune()} expired blacklisted tokens")
+
+@manager.command
+def collect_blobs():
+    """Deletes the stored images no image row points at, see BLOB_GC_GRACE"""
+    from application import maintenance
+    maintenance.collect_blobs(app)
+
+@manager.command
+def sync_label_tasks():
+    """Gives every image one labelling task per annotation it is missing"""
+    from application import labelling
+    labelling.sync_tasks(db.session.connection())
+    db.session.commit()
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,37 @@
+"""add ingestion jobs
+
+Revision ID: 3f1c2a7d9b01
+Revises: 
+Create Date: 2026-10-18 09:12:41.503116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ingestion_jobs',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('base_url', sa.String(length=255), nullable=True),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=True),
+    sa.Column('date_modified', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ingestion_jobs_status_date_created', 'ingestion_jobs', ['status', 'date_created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ingestion_jobs_status_date_created', table_name='ingestion_jobs')
+    op.drop_table('ingestion_jobs')
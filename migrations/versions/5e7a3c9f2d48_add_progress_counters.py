@@ -0,0 +1,66 @@
+"""add dataset and user progress counters
+
+Revision ID: 5e7a3c9f2d48
+Revises: c4d9e2b7a615
+Create Date: 2026-10-18 13:41:52.117630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a3c9f2d48'
+down_revision = 'c4d9e2b7a615'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('dataset_progress',
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('images', sa.Integer(), nullable=False),
+    sa.Column('labelled_images', sa.Integer(), nullable=False),
+    sa.Column('items', sa.Integer(), nullable=False),
+    sa.Column('labelled_items', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('dataset_id')
+    )
+    op.create_table('user_dataset_progress',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('annotations', sa.Integer(), nullable=False),
+    sa.Column('labelled_items', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'dataset_id')
+    )
+    # backfill from the label tables, same as manage.py rebuild_progress
+    op.execute("""
+    INSERT INTO dataset_progress (dataset_id, images, labelled_images, items, labelled_items)
+    SELECT datasets.id, coalesce(images.total, 0), coalesce(images.labelled, 0),
+           coalesce(items.total, 0), coalesce(items.labelled, 0)
+    FROM datasets
+    LEFT JOIN (SELECT dataset_id, count(*) AS total,
+                      count(*) FILTER (WHERE labelled AND has_box AND folder_labelled) AS labelled
+               FROM images GROUP BY dataset_id) images ON images.dataset_id = datasets.id
+    LEFT JOIN (SELECT dataset_id, count(*) AS total, count(*) FILTER (WHERE labelled) AS labelled
+               FROM data_items GROUP BY dataset_id) items ON items.dataset_id = datasets.id
+    """)
+    op.execute("""
+    INSERT INTO user_dataset_progress (user_id, dataset_id, annotations, labelled_items)
+    SELECT user_id, dataset_id, sum(annotations), sum(labelled_items)
+    FROM (SELECT user_id, dataset_id, count(*) AS annotations, 0 AS labelled_items
+          FROM annotation WHERE user_id IS NOT NULL AND dataset_id IS NOT NULL
+          GROUP BY user_id, dataset_id
+          UNION ALL
+          SELECT labelled_by, dataset_id, 0, count(*)
+          FROM data_items WHERE labelled AND labelled_by IS NOT NULL AND dataset_id IS NOT NULL
+          GROUP BY labelled_by, dataset_id) counts
+    GROUP BY user_id, dataset_id
+    """)
+
+
+def downgrade():
+    op.drop_table('user_dataset_progress')
+    op.drop_table('dataset_progress')
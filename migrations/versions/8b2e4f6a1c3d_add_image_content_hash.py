@@ -0,0 +1,28 @@
+"""add image content hash
+
+Revision ID: 8b2e4f6a1c3d
+Revises: 3f1c2a7d9b01
+Create Date: 2026-10-18 11:02:17.264803
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4f6a1c3d'
+down_revision = '3f1c2a7d9b01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('images', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('images', sa.Column('byte_size', sa.BigInteger(), nullable=True))
+    op.create_index(op.f('ix_images_content_hash'), 'images', ['content_hash'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_images_content_hash'), table_name='images')
+    op.drop_column('images', 'byte_size')
+    op.drop_column('images', 'content_hash')
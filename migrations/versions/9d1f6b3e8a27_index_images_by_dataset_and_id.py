@@ -0,0 +1,26 @@
+"""index images by dataset and id
+
+Revision ID: 9d1f6b3e8a27
+Revises: 5e7a3c9f2d48
+Create Date: 2026-10-18 15:06:33.480192
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d1f6b3e8a27'
+down_revision = '5e7a3c9f2d48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_images_dataset_id_id', 'images', ['dataset_id', 'id'], unique=False)
+    op.drop_index('ix_images_dataset_id', table_name='images')
+
+
+def downgrade():
+    op.create_index('ix_images_dataset_id', 'images', ['dataset_id'], unique=False)
+    op.drop_index('ix_images_dataset_id_id', table_name='images')
@@ -0,0 +1,41 @@
+"""add the email outbox
+
+Revision ID: a6d3f8b2c157
+Revises: f4c7a2d8e519
+Create Date: 2026-10-18 19:02:55.317482
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d3f8b2c157'
+down_revision = 'f4c7a2d8e519'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox_emails',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('recipient', sa.String(length=255), nullable=False),
+    sa.Column('subject', sa.String(length=255), nullable=True),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('sender', sa.String(length=255), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=True),
+    sa.Column('date_modified', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_emails_status_next_attempt_at', 'outbox_emails', ['status', 'next_attempt_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_emails_status_next_attempt_at', table_name='outbox_emails')
+    op.drop_table('outbox_emails')
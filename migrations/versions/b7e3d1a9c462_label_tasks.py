@@ -0,0 +1,53 @@
+"""labelling work queue
+
+Revision ID: b7e3d1a9c462
+Revises: 9d1f6b3e8a27
+Create Date: 2026-10-18 16:12:47.201938
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3d1a9c462'
+down_revision = '9d1f6b3e8a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('datasets', sa.Column('target_annotations', sa.Integer(), server_default='1', nullable=False))
+    op.create_table('label_tasks',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('image_id', sa.Integer(), nullable=False),
+    sa.Column('leased_by', sa.Integer(), nullable=True),
+    sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['image_id'], ['images.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['leased_by'], ['users.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_label_tasks_dataset_id_id', 'label_tasks', ['dataset_id', 'id'], unique=False)
+    op.create_index('ix_label_tasks_image_id', 'label_tasks', ['image_id'], unique=False)
+    op.create_index('ix_label_tasks_leased_by', 'label_tasks', ['leased_by'], unique=False,
+                    postgresql_where=sa.text('leased_by IS NOT NULL'))
+    # one task for every annotation the existing images are missing
+    op.execute("""
+        INSERT INTO label_tasks (dataset_id, image_id)
+        SELECT images.dataset_id, images.id
+        FROM images JOIN datasets ON datasets.id = images.dataset_id
+        CROSS JOIN LATERAL generate_series(
+            1, datasets.target_annotations - (SELECT count(DISTINCT annotation.user_id) FROM annotation
+                                              WHERE annotation.image_id = images.id))
+        ORDER BY images.dataset_id, images.id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_label_tasks_leased_by', table_name='label_tasks')
+    op.drop_index('ix_label_tasks_image_id', table_name='label_tasks')
+    op.drop_index('ix_label_tasks_dataset_id_id', table_name='label_tasks')
+    op.drop_table('label_tasks')
+    op.drop_column('datasets', 'target_annotations')
@@ -0,0 +1,59 @@
+"""add indexes for hot filter columns
+
+Revision ID: c4d9e2b7a615
+Revises: 8b2e4f6a1c3d
+Create Date: 2026-10-18 12:20:05.918344
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9e2b7a615'
+down_revision = '8b2e4f6a1c3d'
+branch_labels = None
+depends_on = None
+
+complete = sa.text("labelled AND has_box AND folder_labelled")
+
+
+def upgrade():
+    op.create_index('ix_users_site', 'users', ['site'], unique=False)
+    op.create_index('ix_users_project_id', 'users', ['project_id'], unique=False)
+    op.create_index('ix_data_items_dataset_id_name', 'data_items', ['dataset_id', 'name'], unique=False)
+    op.create_index('ix_data_items_name', 'data_items', ['name'], unique=False)
+    op.create_index('ix_data_items_labelled_by', 'data_items', ['labelled_by'], unique=False)
+    op.create_index('ix_data_items_dataset_id_labelled', 'data_items', ['dataset_id'], unique=False,
+                    postgresql_where=sa.text("labelled"))
+    op.create_index('ix_images_dataset_id', 'images', ['dataset_id'], unique=False)
+    op.create_index('ix_images_item_id', 'images', ['item_id'], unique=False)
+    op.create_index('ix_images_labelled_by_dataset_id', 'images', ['labelled_by', 'dataset_id'], unique=False)
+    op.create_index('ix_images_dataset_id_complete', 'images', ['dataset_id'], unique=False,
+                    postgresql_where=complete)
+    op.create_index('ix_images_item_id_complete', 'images', ['item_id'], unique=False,
+                    postgresql_where=complete)
+    op.create_index('ix_assignments_user_id_dataset_id', 'assignments', ['user_id', 'dataset_id'], unique=False)
+    op.create_index('ix_assignments_dataset_id', 'assignments', ['dataset_id'], unique=False)
+    op.create_index('ix_annotation_user_id_dataset_id', 'annotation', ['user_id', 'dataset_id'], unique=False)
+    op.create_index('ix_annotation_user_id_project_id', 'annotation', ['user_id', 'project_id'], unique=False)
+    op.create_index('ix_annotation_image_id', 'annotation', ['image_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_annotation_image_id', table_name='annotation')
+    op.drop_index('ix_annotation_user_id_project_id', table_name='annotation')
+    op.drop_index('ix_annotation_user_id_dataset_id', table_name='annotation')
+    op.drop_index('ix_assignments_dataset_id', table_name='assignments')
+    op.drop_index('ix_assignments_user_id_dataset_id', table_name='assignments')
+    op.drop_index('ix_images_item_id_complete', table_name='images')
+    op.drop_index('ix_images_dataset_id_complete', table_name='images')
+    op.drop_index('ix_images_labelled_by_dataset_id', table_name='images')
+    op.drop_index('ix_images_item_id', table_name='images')
+    op.drop_index('ix_images_dataset_id', table_name='images')
+    op.drop_index('ix_data_items_dataset_id_labelled', table_name='data_items')
+    op.drop_index('ix_data_items_labelled_by', table_name='data_items')
+    op.drop_index('ix_data_items_name', table_name='data_items')
+    op.drop_index('ix_data_items_dataset_id_name', table_name='data_items')
+    op.drop_index('ix_users_project_id', table_name='users')
+    op.drop_index('ix_users_site', table_name='users')
@@ -0,0 +1,35 @@
+"""one leased task per user and image
+
+Revision ID: d3b8f1a6c924
+Revises: a6d3f8b2c157
+Create Date: 2026-10-18 20:05:12.384117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3b8f1a6c924'
+down_revision = 'a6d3f8b2c157'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # give back all but the latest lease of a user on the same image
+    op.execute("""
+        UPDATE label_tasks SET leased_by = NULL, lease_expires_at = NULL
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY image_id, leased_by
+                                              ORDER BY lease_expires_at DESC, id) AS n
+                FROM label_tasks WHERE leased_by IS NOT NULL
+            ) tasks WHERE n > 1)
+    """)
+    op.create_index('uq_label_tasks_image_id_leased_by', 'label_tasks', ['image_id', 'leased_by'], unique=True,
+                    postgresql_where=sa.text('leased_by IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('uq_label_tasks_image_id_leased_by', table_name='label_tasks')
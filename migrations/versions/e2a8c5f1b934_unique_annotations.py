@@ -0,0 +1,42 @@
+"""one annotation of an image per user
+
+Revision ID: e2a8c5f1b934
+Revises: b7e3d1a9c462
+Create Date: 2026-10-18 17:03:12.558410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a8c5f1b934'
+down_revision = 'b7e3d1a9c462'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the latest of duplicate annotations, it holds the last answers given
+    op.execute("""
+        DELETE FROM annotation
+        USING annotation AS latest
+        WHERE latest.image_id = annotation.image_id
+          AND latest.user_id = annotation.user_id
+          AND latest.dataset_id = annotation.dataset_id
+          AND latest.id > annotation.id
+    """)
+    op.execute("""
+        UPDATE user_dataset_progress SET annotations = (
+            SELECT count(*) FROM annotation
+            WHERE annotation.user_id = user_dataset_progress.user_id
+              AND annotation.dataset_id = user_dataset_progress.dataset_id)
+    """)
+    op.create_index('uq_annotation_image_id_user_id_dataset_id', 'annotation',
+                    ['image_id', 'user_id', 'dataset_id'], unique=True)
+    op.drop_index('ix_annotation_image_id', table_name='annotation')
+
+
+def downgrade():
+    op.create_index('ix_annotation_image_id', 'annotation', ['image_id'], unique=False)
+    op.drop_index('uq_annotation_image_id_user_id_dataset_id', table_name='annotation')
@@ -0,0 +1,44 @@
+"""store blacklisted tokens by hash with their expiry
+
+Revision ID: f4c7a2d8e519
+Revises: e2a8c5f1b934
+Create Date: 2026-10-18 18:21:40.913274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4c7a2d8e519'
+down_revision = 'e2a8c5f1b934'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('blacklist_tokens', sa.Column('token_hash', sa.String(length=64), nullable=True))
+    op.add_column('blacklist_tokens', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    # tokens last 300 minutes, so none outlives the logout by more than that
+    op.execute("""
+        UPDATE blacklist_tokens
+        SET token_hash = encode(sha256(convert_to(token, 'UTF8')), 'hex'),
+            expires_at = blacklisted_on + interval '300 minutes'
+    """)
+    op.execute("DELETE FROM blacklist_tokens WHERE expires_at <= now() AT TIME ZONE 'utc'")
+    op.alter_column('blacklist_tokens', 'token_hash', nullable=False)
+    op.alter_column('blacklist_tokens', 'expires_at', nullable=False)
+    op.create_unique_constraint('blacklist_tokens_token_hash_key', 'blacklist_tokens', ['token_hash'])
+    op.create_index('ix_blacklist_tokens_expires_at', 'blacklist_tokens', ['expires_at'], unique=False)
+    op.drop_column('blacklist_tokens', 'token')
+
+
+def downgrade():
+    # the tokens themselves are gone, their hashes stand in for them
+    op.add_column('blacklist_tokens', sa.Column('token', sa.String(length=500), nullable=True))
+    op.execute("UPDATE blacklist_tokens SET token = token_hash")
+    op.alter_column('blacklist_tokens', 'token', nullable=False)
+    op.create_unique_constraint('blacklist_tokens_token_key', 'blacklist_tokens', ['token'])
+    op.drop_index('ix_blacklist_tokens_expires_at', table_name='blacklist_tokens')
+    op.drop_column('blacklist_tokens', 'expires_at')
+    op.drop_column('blacklist_tokens', 'token_hash')
@@ -0,0 +1,90 @@
+import io
+import json
+import unittest
+
+from application import create_app, db
+
+
+def encode_image(format, size):
+    """Returns the bytes of a plain RGB picture of the given size in format"""
+    from PIL import Image as Img
+
+    buffer = io.BytesIO()
+    Img.new("RGB", size, (200, 80, 80)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def token_headers(user, **extra):
+    """Returns the headers of a request made with a fresh token of user"""
+    token = user.generate_token(user.id)
+    if isinstance(token, bytes):
+        token = token.decode()
+    return dict({"Authorization": f"Bearer {token}", "user_id": str(user.id)}, **extra)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Creates the testing app, its test client and the tables around each test"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.client = self.app.test_client
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class AuthHelpers(object):
+    """Registers and logs in users through the auth endpoints"""
+
+    def register_admin(
+            self,
+            email="admin@test.com",
+            password="test1234",
+            is_admin="admin",
+            username="Admin",
+    ):
+        """Helper method for registering admin"""
+        admin_data = {
+            "email": email,
+            "password": password,
+            "is_admin": is_admin,
+            "username": username,
+        }
+        return self.client().post("/auth/register/", data=admin_data)
+
+    def register_user(
+            self,
+            email="user@test.com",
+            password="test1234",
+            is_admin="",
+            username="User",
+    ):
+        """Helper method for registering user"""
+        return self.register_admin(email, password, is_admin, username)
+
+    def login_admin(self, email="admin@test.com", password="test1234"):
+        """Helper method for admin log in"""
+        admin_data = {"email": email, "password": password}
+        return self.client().post("/auth/login/", data=admin_data)
+
+    def login_user(self, email="user@test.com", password="test1234"):
+        """Helper method for user log in"""
+        return self.login_admin(email, password)
+
+    def login_headers(self, login_res):
+        self.assertEqual(login_res.status_code, 200)
+        body = json.loads(login_res.data.decode())
+        return dict(Authorization="Bearer " + body["access_token"], is_admin=bool(body["is_admin"]),
+                    user_id=body["id"])
+
+    def admin_headers(self):
+        self.register_admin()
+        return self.login_headers(self.login_admin())
+
+    def user_headers(self):
+        self.register_user()
+        return self.login_headers(self.login_user())
@@ -2,9 +2,10 @@ import json
 import unittest
 
 from application import create_app, db
+from helpers import AuthHelpers
 
 
-class AuthTestCase(unittest.TestCase):
+class AuthTestCase(AuthHelpers, unittest.TestCase):
     """Test case for the admin blueprint"""
 
     def setUp(self):
@@ -29,36 +30,6 @@ class AuthTestCase(unittest.TestCase):
             # create all tables
             db.create_all()
 
-    def register_admin(
-            self,
-            email="admin@test.com",
-            password="test1234",
-            is_admin="admin",
-            username="Admin",
-    ):
-        """Helper method for registering admin"""
-        admin_data = {
-            "email": email,
-            "password": password,
-            "is_admin": is_admin,
-            "username": username,
-        }
-        return self.client().post("/auth/register/", data=admin_data)
-
-    def login_admin(self, email="admin@test.com", password="test1234"):
-        """Helper method for admin log in"""
-        admin_data = {"email": email, "password": password}
-        return self.client().post("/auth/login/", data=admin_data)
-
-    def admin_headers(self):
-        self.register_admin()
-        login_res = self.login_admin()
-        self.assertEqual(login_res.status_code, 200)
-        access_token = json.loads(login_res.data.decode())["access_token"]
-        is_admin = bool(json.loads(login_res.data.decode())["is_admin"])
-        user_id = json.loads(login_res.data.decode())["id"]
-        return dict(Authorization="Bearer " + access_token, is_admin=is_admin, user_id=user_id)
-
     def test_dataset_creation(self):
         """Test if API can create a dataset. (POST request)"""
 
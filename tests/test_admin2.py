@@ -1,11 +1,13 @@
 import io
 import json
+import os
 import unittest
 
 from application import create_app, db
+from helpers import AuthHelpers, encode_image
 
 
-class AuthTestCase(unittest.TestCase):
+class AuthTestCase(AuthHelpers, unittest.TestCase):
     """Test case for the admin blueprint"""
 
     def setUp(self):
@@ -50,36 +52,6 @@ class AuthTestCase(unittest.TestCase):
             # create all tables
             db.create_all()
 
-    def register_admin(
-            self,
-            email="admin@test.com",
-            password="test1234",
-            is_admin="admin",
-            username="Admin",
-    ):
-        """Helper method for registering admin"""
-        admin_data = {
-            "email": email,
-            "password": password,
-            "is_admin": is_admin,
-            "username": username,
-        }
-        return self.client().post("/auth/register/", data=admin_data)
-
-    def login_admin(self, email="admin@test.com", password="test1234"):
-        """Helper method for admin log in"""
-        admin_data = {"email": email, "password": password}
-        return self.client().post("/auth/login/", data=admin_data)
-
-    def admin_headers(self):
-        self.register_admin()
-        login_res = self.login_admin()
-        self.assertEqual(login_res.status_code, 200)
-        access_token = json.loads(login_res.data.decode())["access_token"]
-        is_admin = bool(json.loads(login_res.data.decode())["is_admin"])
-        user_id = json.loads(login_res.data.decode())["id"]
-        return dict(Authorization="Bearer " + access_token, is_admin=is_admin, user_id=user_id)
-
     def test_item_upload(self):
         """Test if API can add item to dataset"""
 
@@ -280,6 +252,51 @@ class AuthTestCase(unittest.TestCase):
         self.assertIn("users", str(rv.data))
         self.assertIn("datasets", str(rv.data))
 
+    def test_bulk_upload_streams_images_into_folders(self):
+        """Test if API can bulk upload images into folders, storing identical content once"""
+        with self.app.app_context():
+            from application.models import Dataset
+            dataset = Dataset(name=self.dataset["name"], project_id=None)
+            dataset.save()
+            dataset_json = {"id": dataset.id}
+
+        jpeg = encode_image("JPEG", (1024, 768))
+        png = encode_image("PNG", (640, 480))
+        rv = self.client().post(
+            f"/api/v1/admin/{dataset_json['id']}/bulk_upload/",
+            data={
+                "images": [(io.BytesIO(jpeg), "a.jpg"), (io.BytesIO(png), "b.png"), (io.BytesIO(b"abcdef"), "c.jpg"),
+                           (io.BytesIO(jpeg), "d.jpg"), (io.BytesIO(jpeg), "d.jpg"), (io.BytesIO(jpeg), "e.jpg")],
+                "details": ["upload/case1/a.jpg", "upload/case1/b.png", "upload/case2/c.jpg",
+                            "upload/case2/d.jpg", "upload/case2/d.jpg", "upload/case2/e.jpg"],
+            },
+            content_type="multipart/form-data"
+        )
+        self.assertEqual(rv.status_code, 200)
+        images = json.loads(rv.data.decode())["images"]
+        # the file that is not a JPEG or PNG is skipped, the repeat of d.jpg reuses its row
+        # and e.jpg gets its own row for the same content
+        self.assertEqual(len(images), 5)
+        self.assertEqual(images[2]["id"], images[3]["id"])
+        self.assertNotEqual(images[3]["id"], images[4]["id"])
+
+        with self.app.app_context():
+            from application.admin import content_store
+            from application.models import Image, Item
+            self.assertEqual(Item.query.filter_by(dataset_id=dataset_json["id"]).count(), 2)
+            rows = Image.query.all()
+            self.assertEqual(len(rows), 4)
+            digests = set((image.content_hash, image.byte_size) for image in rows)
+            # the jpeg is referenced by both folders but stored once
+            self.assertEqual(len(digests), 2)
+            for digest, size in digests:
+                ext = ".jpg" if size == len(jpeg) else ".png"
+                self.assertEqual(os.path.getsize(content_store.path(digest, ext=ext)), size)
+                # resized copies and thumbnails are made for every stored image
+                self.assertTrue(content_store.exists(digest, "resized"))
+                self.assertTrue(content_store.exists(digest, "thumbnails"))
+                content_store.remove(digest)
+
         # Test images upload to folder
 
     # def test_admin_can_upload_images_to_item(self):
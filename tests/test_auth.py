@@ -1,9 +1,10 @@
 import unittest
 import json
 from application import create_app, db
+from helpers import AuthHelpers
 
 
-class AuthTestCase(unittest.TestCase):
+class AuthTestCase(AuthHelpers, unittest.TestCase):
     """Test case for the authentication blueprint."""
 
     def setUp(self):
@@ -25,36 +26,6 @@ class AuthTestCase(unittest.TestCase):
             db.drop_all()
             db.create_all()
 
-    def register_user(
-            self,
-            email="user@test.com",
-            password="test1234",
-            is_admin="",
-            username="User",
-    ):
-        """Helper method for registering admin"""
-        user_data = {
-            "email": email,
-            "password": password,
-            "is_admin": is_admin,
-            "username": username,
-        }
-        return self.client().post("/auth/register/", data=user_data)
-
-    def login_user(self, email="user@test.com", password="test1234"):
-        """Helper method for admin log in"""
-        user_data = {"email": email, "password": password}
-        return self.client().post("/auth/login/", data=user_data)
-
-    def user_headers(self):
-        self.register_user()
-        login_res = self.login_user()
-        self.assertEqual(login_res.status_code, 200)
-        access_token = json.loads(login_res.data.decode())["access_token"]
-        is_admin = bool(json.loads(login_res.data.decode())["is_admin"])
-        user_id = json.loads(login_res.data.decode())["id"]
-        return dict(Authorization="Bearer " + access_token, is_admin=is_admin, user_id=user_id)
-
     def test_registration(self):
         """Test user registration works correcty."""
         res = self.client().post('/auth/register/', data=self.user_data)
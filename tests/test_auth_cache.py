@@ -0,0 +1,166 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from application import db
+from helpers import DatabaseTestCase, token_headers
+
+
+class AuthCacheTestCase(DatabaseTestCase):
+    """Test case for the in-memory token verification caches"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            from application.models import User
+
+            user = User(email="labeller@test.com", password="test1234", is_admin="")
+            user.save()
+            token = user.generate_token(user.id)
+            if isinstance(token, bytes):
+                token = token.decode()
+            self.token = token
+            self.headers = {"Authorization": f"Bearer {token}", "user_id": str(user.id)}
+            self.user_id = user.id
+
+    def test_verified_tokens_expire(self):
+        from application.utils.auth_cache import VerifiedTokens
+
+        tokens = VerifiedTokens(max_entries=2)
+        tokens.add("a", 1, time.time() + 60)
+        tokens.add("b", 2, time.time() - 1)
+        self.assertEqual(tokens.get("a"), 1)
+        self.assertIsNone(tokens.get("b"))
+        tokens.add("c", 3, time.time() + 60)
+        tokens.add("d", 4, time.time() + 60)
+        # the least recently used entry makes room
+        self.assertIsNone(tokens.get("a"))
+        self.assertEqual(tokens.get("d"), 4)
+
+    def test_tokens_are_verified_once(self):
+        from application.utils import auth_cache
+
+        path = f"/api/v1/user/{self.user_id}/datasets/"
+        with mock.patch.object(auth_cache.jwt, "decode", wraps=auth_cache.jwt.decode) as decode:
+            for _ in range(5):
+                res = self.client().get(path, headers=self.headers)
+                self.assertEqual(res.status_code, 200)
+        self.assertEqual(decode.call_count, 1)
+
+        res = self.client().get(path, headers=dict(self.headers, Authorization="Bearer not-a-token"))
+        self.assertEqual(res.status_code, 401)
+        # the error message of a bad token is not taken for its subject
+        res = self.client().get(path, headers={"Authorization": "Bearer not-a-token",
+                                               "user_id": "Invalid token. Please register or login"})
+        self.assertEqual(res.status_code, 401)
+
+    def test_logout_reaches_every_worker(self):
+        from application.utils import auth_cache
+
+        path = f"/api/v1/user/{self.user_id}/datasets/"
+        # another worker's blacklist, which polls the table
+        with self.app.app_context():
+            other = auth_cache.TokenBlacklist(poll_interval=3600)
+            self.assertNotIn(auth_cache.token_hash(self.token), other)
+        self.assertEqual(self.client().get(path, headers=self.headers).status_code, 200)
+
+        res = self.client().post("/api/v1/auth/logout/", headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.client().get(path, headers=self.headers).status_code, 401)
+        with self.app.app_context():
+            self.assertNotIn(auth_cache.token_hash(self.token), other)
+            other.refresh(force=True)
+            self.assertIn(auth_cache.token_hash(self.token), other)
+
+    def test_logouts_committed_out_of_id_order_are_seen(self):
+        from application.models import BlackListToken
+        from application.utils import auth_cache
+
+        with self.app.app_context():
+            other = auth_cache.TokenBlacklist(poll_interval=3600)
+            later = BlackListToken(token="a later logout")
+            later.id = 10
+            later.save()
+            other.refresh(force=True)
+            # a lower id committed after the poll read the higher one
+            earlier = BlackListToken(token=self.token)
+            earlier.id = 5
+            earlier.save()
+            other.refresh(force=True)
+            self.assertIn(auth_cache.token_hash(self.token), other)
+            self.assertIn(auth_cache.token_hash("a later logout"), other)
+
+    def test_expired_tokens_are_pruned(self):
+        from datetime import datetime, timedelta
+        from application.models import BlackListToken
+        from application.utils import auth_cache
+
+        with self.app.app_context():
+            BlackListToken(token=self.token).save()
+            expired = BlackListToken(token="an old token")
+            expired.expires_at = datetime.utcnow() - timedelta(minutes=1)
+            expired.save()
+            self.assertEqual(len(BlackListToken.query.first().token_hash), 64)
+            self.assertEqual(BlackListToken.prune(), 1)
+            self.assertTrue(BlackListToken.check_blacklist(self.token))
+            self.assertFalse(BlackListToken.check_blacklist("an old token"))
+            # the expiry comes from the token itself
+            entry = BlackListToken.query.one()
+            self.assertGreater(entry.expires_at, datetime.utcnow() + timedelta(minutes=290))
+            self.assertIn(auth_cache.token_hash(self.token), auth_cache.TokenBlacklist())
+
+    def test_principal_cache_expires(self):
+        from application.utils.auth_cache import Principal, PrincipalCache
+
+        principals = PrincipalCache(max_entries=1, ttl=60)
+        principals.add(Principal(1, "user", 1, "Kampala", "labeller"))
+        self.assertEqual(principals.get(1).site, "Kampala")
+        principals.add(Principal(2, "user", 1, "Kampala", "other"))
+        self.assertIsNone(principals.get(1))
+        principals.ttl = 0
+        principals.add(Principal(3, "user", 1, "Kampala", "stale"))
+        self.assertIsNone(principals.get(3))
+
+    def test_principal_is_invalidated_by_admin_edits(self):
+        from application.models import User
+        from application.utils import auth_cache
+
+        with self.app.app_context():
+            admin = User(email="admin@test.com", password="test1234", is_admin="admin")
+            admin.save()
+            admin_headers = token_headers(admin, is_admin="admin")
+        path = f"/api/v1/user/{self.user_id}/home/"
+        self.assertEqual(self.client().get(path, headers=self.headers).status_code, 200)
+        self.assertEqual(auth_cache.principals.get(self.user_id).role, "user")
+
+        # changed behind the cache's back, the principal stays until its ttl is up
+        with self.app.app_context():
+            User.query.filter_by(id=self.user_id).update({User.username: "renamed"})
+            db.session.commit()
+        res = self.client().get(path, headers=self.headers)
+        self.assertNotEqual(json.loads(res.data)["name"], "renamed")
+
+        res = self.client().put(f"/api/v1/admin/users/{self.user_id}/", data=json.dumps({"site": "Mbarara"}),
+                                headers=admin_headers, content_type="application/json")
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(auth_cache.principals.get(self.user_id))
+        res = self.client().get(path, headers=self.headers)
+        self.assertEqual(json.loads(res.data)["name"], "renamed")
+        self.assertEqual(auth_cache.principals.get(self.user_id).site, "Mbarara")
+
+    def test_missing_token_and_role_headers_are_refused(self):
+        path = f"/api/v1/user/{self.user_id}/home/"
+        for authorization in (None, "", "Bearer", "Bearer "):
+            headers = {"user_id": str(self.user_id)}
+            if authorization is not None:
+                headers["Authorization"] = authorization
+            self.assertEqual(self.client().get(path, headers=headers).status_code, 401)
+
+        # the role is the one stored for the user, whatever the headers claim
+        headers = dict(self.headers, is_admin="admin", project_admin="true")
+        self.assertEqual(self.client().get("/api/v1/admin/users/", headers=headers).status_code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import time
+import unittest
+
+from application import db
+from helpers import DatabaseTestCase
+
+
+class ExternalTestCase(DatabaseTestCase):
+    """Test case for the external ingestion blueprint"""
+
+    def setUp(self):
+        super().setUp()
+        # jobs are run explicitly by the tests
+        self.app.config["INGESTION_WORKER_THREADS"] = 0
+
+        self.study = {
+            "study_id": "U0001",
+            "positive_threshold": 0.5,
+        }
+        for key in ["picture1_before", "picture2_before", "picture3_after", "picture4_after"]:
+            self.study[key] = {"request_image_url": f"http://127.0.0.1:1/{key}.jpg", "acetic_acid": "1"}
+
+        # a worker made for an earlier test's app would be reused
+        from application.external.jobs import get_worker
+        get_worker.reset()
+        self.addCleanup(get_worker.reset)
+
+    def post_async(self, payload):
+        return self.client().post("/api/v1/upload?async=1", data=json.dumps(payload),
+                                  content_type="application/json")
+
+    def test_async_upload_rejects_invalid_payload(self):
+        payload = dict(self.study)
+        del payload["picture3_after"]
+        res = self.post_async(payload)
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("picture3_after", str(res.data))
+
+    def test_async_upload_returns_job_id(self):
+        res = self.post_async(self.study)
+        self.assertEqual(res.status_code, 202)
+        body = json.loads(res.data.decode())
+        self.assertEqual(body["status"], "queued")
+
+        status = self.client().get(f"/api/v1/upload/jobs/{body['job_id']}")
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual(json.loads(status.data.decode())["status"], "queued")
+
+    def test_worker_runs_queued_job(self):
+        from application.external.jobs import IngestionWorker
+
+        job_id = json.loads(self.post_async(self.study).data.decode())["job_id"]
+        seen = list()
+
+        def ingest(payload, base_url):
+            seen.append(payload["study_id"])
+            self.assertEqual(base_url, "http://localhost/")
+            return {"study_id": payload["study_id"], "via_result": "Negative"}, 200
+
+        worker = IngestionWorker(self.app, ingest, threads=0)
+        self.assertTrue(worker.run_once())
+        self.assertFalse(worker.run_once())
+        self.assertEqual(seen, ["U0001"])
+
+        status = json.loads(self.client().get(f"/api/v1/upload/jobs/{job_id}").data.decode())
+        self.assertEqual(status["status"], "done")
+        self.assertEqual(status["result"]["via_result"], "Negative")
+
+    def test_abandoned_job_is_failed_after_max_attempts(self):
+        from datetime import datetime, timedelta
+        from application.external.jobs import IngestionWorker
+        from application.models import IngestionJob
+
+        job_id = json.loads(self.post_async(self.study).data.decode())["job_id"]
+        # started max_attempts times, each time by a worker that stopped
+        with self.app.app_context():
+            IngestionJob.query.filter_by(id=job_id).update(
+                {IngestionJob.status: "running", IngestionJob.attempts: 3,
+                 IngestionJob.date_modified: datetime.utcnow() - timedelta(hours=1)})
+            db.session.commit()
+
+        worker = IngestionWorker(self.app, lambda payload, base_url: self.fail("ran again"), threads=0)
+        self.assertFalse(worker.run_once())
+        status = json.loads(self.client().get(f"/api/v1/upload/jobs/{job_id}").data.decode())
+        self.assertEqual(status["status"], "failed")
+
+    def test_running_job_is_kept_from_other_workers(self):
+        import threading
+        from application.external.jobs import IngestionWorker
+
+        self.post_async(self.study)
+        started, finish = threading.Event(), threading.Event()
+
+        def ingest(payload, base_url):
+            started.set()
+            finish.wait(5)
+            return {"study_id": payload["study_id"]}, 200
+
+        # the study takes longer than stale_after, the heartbeat keeps it claimed
+        worker = IngestionWorker(self.app, ingest, threads=0, stale_after=2)
+        thread = threading.Thread(target=worker.run_once)
+        thread.start()
+        started.wait(5)
+        time.sleep(3)
+        other = IngestionWorker(self.app, lambda payload, base_url: self.fail("ran twice"), threads=0,
+                                stale_after=2)
+        self.assertFalse(other.run_once())
+        finish.set()
+        thread.join()
+
+    def test_unknown_job_is_404(self):
+        res = self.client().get("/api/v1/upload/jobs/does-not-exist")
+        self.assertEqual(res.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
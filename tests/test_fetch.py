@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from application import create_app
+
+
+class PictureHandler(BaseHTTPRequestHandler):
+    """Serves /<name> after a short delay, standing in for a clinic image server"""
+
+    delay = 0.3
+    requests_seen = list()
+
+    def do_GET(self):
+        PictureHandler.requests_seen.append(self.path)
+        time.sleep(self.delay)
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.path.encode() * 10
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FetchTestCase(unittest.TestCase):
+    """Test case for the external picture fetch stage"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        with self.app.app_context():
+            from application.external.fetch import Fetcher, FetchError
+        self.FetchError = FetchError
+        self.fetcher = Fetcher(pool_size=4, timeout=(2, 5))
+
+        PictureHandler.requests_seen = list()
+        self.server = ThreadingServer(("127.0.0.1", 0), PictureHandler)
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def test_fetch_all_downloads_in_parallel(self):
+        """Four pictures take about as long as the slowest single download"""
+        urls = [f"{self.base_url}/picture{i}" for i in range(1, 5)]
+        start = time.perf_counter()
+        bodies = self.fetcher.fetch_all(urls)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(bodies, [f"/picture{i}".encode() * 10 for i in range(1, 5)])
+        self.assertLess(elapsed, PictureHandler.delay * 3)
+        # each picture is requested exactly once
+        self.assertEqual(sorted(PictureHandler.requests_seen), [f"/picture{i}" for i in range(1, 5)])
+
+    def test_fetch_all_reports_failing_picture(self):
+        urls = [f"{self.base_url}/picture1", f"{self.base_url}/missing"]
+        with self.assertRaises(self.FetchError) as context:
+            self.fetcher.fetch_all(urls)
+        self.assertEqual(context.exception.index, 1)
+        self.assertEqual(context.exception.url, urls[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import io
+import unittest
+
+from PIL import Image as Img
+
+from application import create_app
+from helpers import encode_image
+
+
+class ImageProcessorTestCase(unittest.TestCase):
+    """Test case for the shared image processing service"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        with self.app.app_context():
+            from application.utils.imaging import ImageProcessor
+        self.ImageProcessor = ImageProcessor
+
+    def check_processed(self, processed, data, mimetype):
+        self.assertEqual(processed.mimetype, mimetype)
+        self.assertEqual(processed.original, data)
+        self.assertEqual(Img.open(io.BytesIO(processed.resized)).size, (512, 512))
+        self.assertLessEqual(max(Img.open(io.BytesIO(processed.thumbnail)).size), 128)
+
+    def test_inline_processing(self):
+        data = encode_image("PNG", (800, 600))
+        processor = self.ImageProcessor(workers=0)
+        self.check_processed(processor.process(data), data, "image/png")
+
+    def test_pool_processing_keeps_order(self):
+        datas = [encode_image("JPEG", (300 + i * 10, 200)) for i in range(6)]
+        processor = self.ImageProcessor(workers=2)
+        try:
+            results = processor.process_many(datas)
+        finally:
+            processor.close()
+        self.assertEqual(len(results), 6)
+        for data, processed in zip(datas, results):
+            self.check_processed(processed, data, "image/jpeg")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,215 @@
+import json
+import threading
+import unittest
+
+from application import db
+from helpers import DatabaseTestCase, token_headers
+
+
+class LabelQueueTestCase(DatabaseTestCase):
+    """Test case for leasing images to annotators from the labelling work queue"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            from application.models import Dataset, Image, User
+
+            users = [User(email=f"labeller{i}@test.com", password="test1234", is_admin="") for i in range(8)]
+            db.session.add_all(users)
+            dataset = Dataset(name="dataset", project_id=None)
+            dataset.target_annotations = 2
+            dataset.save()
+            images = list()
+            for i in range(60):
+                image = Image(name=f"{i}.jpg", image_URL=f"{i}.jpg")
+                image.dataset_id = dataset.id
+                images.append(image)
+            db.session.add_all(images)
+            db.session.commit()
+            self.user_ids = [user.id for user in users]
+            self.image_ids = [image.id for image in images]
+            self.dataset_id = dataset.id
+            self.headers = token_headers(users[0])
+
+    def remaining_tasks(self):
+        from application.models import LabelTask
+
+        return LabelTask.query.filter_by(dataset_id=self.dataset_id).count()
+
+    def test_new_images_get_a_task_per_target_annotation(self):
+        from application.models import Dataset
+
+        with self.app.app_context():
+            self.assertEqual(self.remaining_tasks(), 120)
+            dataset = Dataset.query.get(self.dataset_id)
+            dataset.target_annotations = 3
+            dataset.save()
+            self.assertEqual(self.remaining_tasks(), 180)
+            dataset.target_annotations = 1
+            dataset.save()
+            self.assertEqual(self.remaining_tasks(), 60)
+
+    def test_leases_expire_and_are_released(self):
+        from application.labelling import claim_tasks, release_tasks, renew_tasks
+        from application.models import LabelTask
+
+        first, second = self.user_ids[:2]
+        with self.app.app_context():
+            leased = claim_tasks(self.dataset_id, first, 50)
+            self.assertEqual(len(leased), 50)
+            # one task of an image at a time
+            self.assertEqual(len(set(image_id for image_id, expires_at in leased)), 50)
+            self.assertEqual(len(claim_tasks(self.dataset_id, first, 50)), 10)
+            self.assertEqual(len(claim_tasks(self.dataset_id, first, 50)), 0)
+            self.assertEqual(len(claim_tasks(self.dataset_id, second, 100)), 60)
+            self.assertEqual(len(claim_tasks(self.dataset_id, second, 100)), 0)
+
+            self.assertEqual(release_tasks(self.dataset_id, first, self.image_ids[:5]), 5)
+            self.assertEqual(renew_tasks(self.dataset_id, first), 55)
+            # an expired lease is up for grabs, and can no longer be renewed
+            LabelTask.query.filter_by(leased_by=first, image_id=self.image_ids[5]).update(
+                {LabelTask.lease_expires_at: db.func.current_timestamp() - db.text("interval '1 minute'")},
+                synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(renew_tasks(self.dataset_id, first), 54)
+            third = self.user_ids[2]
+            leased = claim_tasks(self.dataset_id, third, 100)
+            self.assertEqual(sorted(image_id for image_id, expires_at in leased), self.image_ids[:6])
+
+    def test_a_user_leases_one_task_of_an_image(self):
+        from sqlalchemy.exc import IntegrityError
+        from application.labelling import claim_tasks
+        from application.models import LabelTask
+
+        user_id = self.user_ids[0]
+        with self.app.app_context():
+            task_ids = [task.id for task in LabelTask.query.filter_by(image_id=self.image_ids[0])]
+            # what two racing claims of the same user would otherwise do
+            with self.assertRaises(IntegrityError):
+                LabelTask.query.filter(LabelTask.id.in_(task_ids)).update(
+                    {LabelTask.leased_by: user_id}, synchronize_session=False)
+                db.session.commit()
+            db.session.rollback()
+
+            self.assertEqual(len(claim_tasks(self.dataset_id, user_id, 60)), 60)
+            # once the leases expire the user can lease any task of those images again
+            LabelTask.query.filter_by(leased_by=user_id).update(
+                {LabelTask.lease_expires_at: db.func.current_timestamp() - db.text("interval '1 minute'")},
+                synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(len(claim_tasks(self.dataset_id, user_id, 60)), 60)
+            self.assertEqual(LabelTask.query.filter_by(leased_by=user_id).count(), 60)
+
+    def test_leases_endpoint(self):
+        from application.models import Annotation
+
+        path = f"/api/v1/user/datasets/{self.dataset_id}/leases"
+        res = self.client().post(path + "?count=5", headers=self.headers)
+        self.assertEqual(res.status_code, 201)
+        images = json.loads(res.data.decode())["images"]
+        self.assertEqual(len(images), 5)
+        self.assertTrue(all(image["image"] and image["lease_expires_at"] for image in images))
+
+        with self.app.app_context():
+            # labelling an image completes its task
+            Annotation(annotations="{}", project_id=None, dataset_id=self.dataset_id, image_id=images[0]["id"],
+                       user_id=self.user_ids[0]).save()
+            self.assertEqual(self.remaining_tasks(), 119)
+        res = self.client().put(path, headers=self.headers)
+        self.assertEqual(json.loads(res.data.decode())["renewed"], 4)
+        res = self.client().delete(path, data=json.dumps({"image_ids": [images[1]["id"]]}),
+                                   headers=self.headers, content_type="application/json")
+        self.assertEqual(json.loads(res.data.decode())["released"], 1)
+        res = self.client().delete(path, headers=self.headers)
+        self.assertEqual(json.loads(res.data.decode())["released"], 3)
+
+    def test_next_bundle(self):
+        from application.admin import content_store
+        from application.models import Attributes, Dataset, Image, Project
+
+        with self.app.app_context():
+            project = Project(name="project", type="label")
+            project.save()
+            Attributes(name="quality", project_id=project.id, values="good,bad", type="select").save()
+            dataset = Dataset.query.get(self.dataset_id)
+            dataset.project_id = project.id
+            dataset.classes = ["normal", "lesion"]
+            dataset.save()
+            # a single image left to label, stored by content with its resized copy
+            Image.query.filter(Image.id != self.image_ids[0]).delete(synchronize_session=False)
+            db.session.commit()
+            digest = "ab" * 32
+            content_store.put_variant(digest, "resized", b"resized bytes")
+            image = Image.query.get(self.image_ids[0])
+            image.content_hash = digest
+            image.byte_size = 1000
+            image.save()
+
+        try:
+            res = self.client().get(f"/api/v1/user/datasets/{self.dataset_id}/next?count=5", headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            body = json.loads(res.data.decode())
+            self.assertEqual(len(body["images"]), 1)
+            image = body["images"][0]
+            # the ETag is the one the file is served with, so the client can revalidate it
+            served = self.client().get(image["image"])
+            self.assertEqual(served.headers["ETag"], image["etag"])
+            self.assertEqual(self.client().get(image["image"], headers={"If-None-Match": image["etag"]}).status_code,
+                             304)
+        finally:
+            content_store.remove(digest)
+        self.assertEqual(body["classes"], ["normal", "lesion"])
+        self.assertEqual(body["attributes"][0]["values"], "good,bad")
+        self.assertIn("option1", body["template"])
+        self.assertIn(f"/resized/ab/ab/{digest}.jpg", image["image"])
+        self.assertEqual(image["byte_size"], len(b"resized bytes"))
+        self.assertTrue(image["lease_expires_at"])
+        # the image is leased, asking again does not hand it out twice
+        res = self.client().get(f"/api/v1/user/datasets/{self.dataset_id}/next?count=5", headers=self.headers)
+        self.assertEqual(json.loads(res.data.decode())["images"], [])
+
+    def test_concurrent_labellers_share_the_work(self):
+        """Labellers lease and label batches at the same time until every image has its annotations"""
+        from application.labelling import claim_tasks
+        from application.models import Annotation
+
+        errors = list()
+        labelled = {user_id: list() for user_id in self.user_ids}
+
+        def labeller(user_id):
+            try:
+                with self.app.app_context():
+                    for _ in range(200):
+                        leased = claim_tasks(self.dataset_id, user_id, 3)
+                        for image_id, expires_at in leased:
+                            Annotation(annotations="{}", project_id=None, dataset_id=self.dataset_id,
+                                       image_id=image_id, user_id=user_id).save()
+                            labelled[user_id].append(image_id)
+                        # the others may still be labelling the last tasks
+                        if not leased and not self.remaining_tasks():
+                            break
+                    db.session.remove()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=labeller, args=(user_id,)) for user_id in self.user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        with self.app.app_context():
+            self.assertEqual(self.remaining_tasks(), 0)
+            annotations = db.session.query(Annotation.image_id, db.func.count(db.distinct(Annotation.user_id)),
+                                           db.func.count()).group_by(Annotation.image_id).all()
+        # every image labelled by exactly two different users, and the work spread over them
+        self.assertEqual(sorted(image_id for image_id, users, total in annotations), self.image_ids)
+        self.assertEqual(set((users, total) for image_id, users, total in annotations), {(2, 2)})
+        for user_id, image_ids in labelled.items():
+            self.assertEqual(len(image_ids), len(set(image_ids)))
+        self.assertGreater(sum(1 for image_ids in labelled.values() if image_ids), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
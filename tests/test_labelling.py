@@ -0,0 +1,168 @@
+import json
+import threading
+import unittest
+
+from application import db
+from helpers import DatabaseTestCase, token_headers
+
+
+class LabellingQueueTestCase(DatabaseTestCase):
+    """Test case for picking the next images a user labels"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            from application.models import Annotation, Dataset, Image, User
+
+            user = User(email="labeller@test.com", password="test1234", is_admin="")
+            user.save()
+            dataset = Dataset(name="dataset", project_id=None)
+            dataset.save()
+            images = list()
+            for i in range(50):
+                image = Image(name=f"{i}.jpg", image_URL=f"{i}.jpg")
+                image.dataset_id = dataset.id
+                images.append(image)
+            db.session.add_all(images)
+            db.session.commit()
+            # the user labelled all but five images
+            self.unlabelled = set(image.id for image in images[10:15])
+            db.session.add_all([
+                Annotation(annotations=json.dumps({"option1": i}), project_id=None, dataset_id=dataset.id,
+                           image_id=image.id, user_id=user.id)
+                for i, image in enumerate(images) if image.id not in self.unlabelled
+            ])
+            db.session.commit()
+            self.headers = token_headers(user)
+            self.user_id = user.id
+            self.dataset_id = dataset.id
+
+    def test_next_unlabelled_images(self):
+        from application.labelling import next_unlabelled_images
+
+        with self.app.app_context():
+            for _ in range(10):
+                images = next_unlabelled_images(self.dataset_id, self.user_id, 3)
+                self.assertEqual(len(images), 3)
+                self.assertTrue(set(image.id for image in images) <= self.unlabelled)
+            # wraps around to pick up every remaining image wherever it starts
+            images = next_unlabelled_images(self.dataset_id, self.user_id, 10)
+            self.assertEqual(set(image.id for image in images), self.unlabelled)
+
+    def test_next_unlabelled_images_are_picked_evenly(self):
+        from collections import Counter
+        from application.labelling import next_unlabelled_images
+
+        # the unlabelled images follow a run of ten labelled ones, which must not favour the first of them
+        with self.app.app_context():
+            picks = Counter(next_unlabelled_images(self.dataset_id, self.user_id, 1)[0].id for _ in range(200))
+        self.assertEqual(set(picks), self.unlabelled)
+        self.assertGreater(min(picks.values()), 15)
+
+    def test_random_endpoint_returns_queue_and_labelled_page(self):
+        res = self.client().get(f"/api/v1/user/images/{self.dataset_id}/random?count=2&limit=20",
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        body = json.loads(res.data.decode())
+        self.assertEqual(len(body["images"]), 22)
+        self.assertTrue(set(image["id"] for image in body["images"][:2]) <= self.unlabelled)
+        self.assertEqual(body["labels"][0]["annotations"]["option1"]["answer"], "")
+        self.assertIn("option1", body["labels"][2]["annotations"])
+        self.assertEqual(body["labelled"], 45)
+        self.assertEqual(body["all_images"], 50)
+        self.assertTrue(body["next_cursor"])
+
+    def test_label_batch(self):
+        from application.models import Annotation, Image
+
+        unlabelled = sorted(self.unlabelled)
+        with self.app.app_context():
+            labelled = Annotation.query.filter_by(user_id=self.user_id).order_by(Annotation.id).first().image_id
+        batch = {
+            "annotations": [{"image_id": image_id, "dataset_id": self.dataset_id, "annotations": '{"option1": 1}'}
+                            for image_id in unlabelled[:3] + [labelled]],
+            "labels": [{"image_id": unlabelled[0], "label": "Positive"}],
+            "bounding_boxes": [{"image_id": unlabelled[0], "bounding_box": "[1, 2, 3, 4]"}],
+        }
+        res = self.client().post("/api/v1/user/label/batch", data=json.dumps(batch), headers=self.headers,
+                                 content_type="application/json")
+        self.assertEqual(res.status_code, 201)
+        body = json.loads(res.data.decode())
+        self.assertEqual(body["datasets"], [
+            {"dataset_id": self.dataset_id, "labelled": 48, "labelled_images": 0, "all_images": 50}])
+
+        with self.app.app_context():
+            self.assertEqual(Annotation.query.filter_by(user_id=self.user_id).count(), 48)
+            self.assertEqual(Annotation.query.filter_by(image_id=labelled).one().annotations, '{"option1": 1}')
+            image = Image.query.get(unlabelled[0])
+            self.assertEqual((image.label, image.labelled, image.has_box), ("Positive", True, True))
+            self.assertEqual(image.labelled_by, self.user_id)
+
+        # nothing is saved when an image does not exist
+        batch = {"annotations": [{"image_id": unlabelled[3], "annotations": "{}"}, {"image_id": 10 ** 6}]}
+        res = self.client().post("/api/v1/user/label/batch", data=json.dumps(batch), headers=self.headers,
+                                 content_type="application/json")
+        self.assertEqual(res.status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(Annotation.query.filter_by(user_id=self.user_id).count(), 48)
+            orphan = Image(name="orphan.jpg", image_URL="orphan.jpg")
+            orphan.save()
+            orphan_id = orphan.id
+
+        # invalid entries are reported by their list and index
+        for batch, message in [
+            ({"annotations": [{"image_id": unlabelled[3]}, {"image_id": orphan_id}]}, "annotations[1]"),
+            ({"annotations": [{"image_id": unlabelled[3], "project_id": 10 ** 6}]}, "annotations[0]"),
+            ({"annotations": [{"image_id": unlabelled[3], "project_id": "first"}]}, "annotations[0]"),
+            ({"labels": [{"image_id": unlabelled[3]}, {"label": "Positive"}]}, "labels[1]"),
+        ]:
+            with self.subTest(message=message):
+                res = self.client().post("/api/v1/user/label/batch", data=json.dumps(batch), headers=self.headers,
+                                         content_type="application/json")
+                self.assertEqual(res.status_code, 400)
+                self.assertIn(message, res.data.decode())
+        with self.app.app_context():
+            self.assertEqual(Annotation.query.filter_by(user_id=self.user_id).count(), 48)
+
+    def test_double_submits_upsert_one_annotation(self):
+        from application.models import Annotation, Project
+        from application.stats import user_annotation_counts
+
+        with self.app.app_context():
+            project = Project(name="project", type="label")
+            project.save()
+            project_id = project.id
+        image_id = min(self.unlabelled)
+        errors = list()
+
+        def submit(answer):
+            try:
+                data = {"dataset_id": self.dataset_id, "project_id": project_id,
+                        "annotations": json.dumps({"option1": answer})}
+                res = self.client().post(f"/api/v1/user/label/{image_id}", data=json.dumps(data),
+                                         headers=self.headers, content_type="application/json")
+                self.assertEqual(res.status_code, 201)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        with self.app.app_context():
+            self.assertEqual(Annotation.query.filter_by(image_id=image_id).count(), 1)
+            self.assertEqual(user_annotation_counts(self.user_id, [self.dataset_id]), {self.dataset_id: 46})
+            (annotation_id, _, inserted), = Annotation.upsert([{
+                "dataset_id": self.dataset_id, "project_id": None, "user_id": self.user_id,
+                "image_id": image_id, "annotations": "{}",
+            }])
+            db.session.commit()
+            self.assertFalse(inserted)
+            self.assertEqual(Annotation.query.get(annotation_id).annotations, "{}")
+
+
+if __name__ == "__main__":
+    unittest.main()
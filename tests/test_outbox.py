@@ -0,0 +1,132 @@
+import asyncore
+import smtpd
+import socket
+import threading
+import unittest
+
+from application import db
+from helpers import DatabaseTestCase
+from application.utils.email import mail
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """Local stand-in for the mail server that keeps what it receives"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = list()
+        self.connections = 0
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        super().handle_accepted(conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((rcpttos, data))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class OutboxTestCase(DatabaseTestCase):
+    """Test case for queueing emails and sending them in the background"""
+
+    def setUp(self):
+        super().setUp()
+        self.port = free_port()
+        self.app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=self.port, MAIL_USE_SSL=False,
+                               MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False, MAIL_DEBUG=False,
+                               MAIL_DEFAULT_SENDER="annotator@test.com")
+        mail.init_app(self.app)
+        # a sender made for an earlier test's app would be reused
+        from application.utils.email import get_sender
+        get_sender.reset()
+        self.addCleanup(get_sender.reset)
+
+    def start_server(self):
+        server = RecordingSMTPServer(("127.0.0.1", self.port), None)
+        thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05}, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.close)
+        return server
+
+    def sender(self, **kwargs):
+        from application.utils.email import OutboxSender
+
+        return OutboxSender(self.app, threads=0, batch_size=kwargs.pop("batch_size", 20), **kwargs)
+
+    def test_emails_are_queued_and_sent_in_one_connection(self):
+        from application.models import OutboxEmail
+        from application.utils.email import send_email
+
+        with self.app.app_context():
+            for i in range(3):
+                send_email(f"user{i}@test.com", "Verify your email", f"<p>{i}</p>")
+            self.assertEqual([email.status for email in OutboxEmail.query.all()], ["pending"] * 3)
+
+        server = self.start_server()
+        sender = self.sender()
+        self.assertTrue(sender.run_once())
+        self.assertFalse(sender.run_once())
+        sender.close()
+
+        self.assertEqual(sorted(rcpttos[0] for rcpttos, data in server.messages),
+                         ["user0@test.com", "user1@test.com", "user2@test.com"])
+        self.assertEqual(server.connections, 1)
+        with self.app.app_context():
+            self.assertEqual(set((email.status, email.attempts) for email in OutboxEmail.query), {("sent", 1)})
+
+    def test_failed_emails_are_retried_with_backoff(self):
+        from application.models import OutboxEmail
+        from application.utils.email import send_email
+
+        with self.app.app_context():
+            send_email("user@test.com", "Verify your email", "<p>hi</p>")
+
+        # nothing listens on the port yet
+        sender = self.sender(backoff=60, max_attempts=2)
+        self.assertTrue(sender.run_once())
+        with self.app.app_context():
+            email = OutboxEmail.query.one()
+            self.assertEqual((email.status, email.attempts), ("pending", 1))
+            self.assertTrue(email.last_error)
+        # not due again before the backoff
+        self.assertFalse(sender.run_once())
+
+        with self.app.app_context():
+            OutboxEmail.query.update({OutboxEmail.next_attempt_at: db.func.current_timestamp()})
+            db.session.commit()
+        self.assertTrue(sender.run_once())
+        with self.app.app_context():
+            self.assertEqual(OutboxEmail.query.one().status, "failed")
+
+    def test_queued_email_commits_with_its_transaction(self):
+        from application.models import OutboxEmail, User
+        from application.utils import email
+
+        notified = list()
+        sender = self.sender()
+        sender.notify = lambda: notified.append(True)
+        self.addCleanup(setattr, email, "get_sender", email.get_sender)
+        email.get_sender = lambda app: sender
+
+        with self.app.app_context():
+            db.session.add(User(email="user@test.com", password="test1234", is_admin=""))
+            email.queue_email("user@test.com", "Verify your email", "<p>hi</p>")
+            db.session.rollback()
+            self.assertEqual((User.query.count(), OutboxEmail.query.count()), (0, 0))
+            self.assertEqual(notified, [])
+
+            db.session.add(User(email="user@test.com", password="test1234", is_admin=""))
+            email.queue_email("user@test.com", "Verify your email", "<p>hi</p>")
+            db.session.commit()
+            self.assertEqual((User.query.count(), OutboxEmail.query.count()), (1, 1))
+            self.assertEqual(notified, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import unittest
+
+from werkzeug.exceptions import BadRequest
+
+from application import create_app
+from helpers import DatabaseTestCase, token_headers
+
+
+class PaginationTestCase(unittest.TestCase):
+    """Test case for keyset pagination and field selection"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        self.client = self.app.test_client
+
+    def test_cursor_round_trip(self):
+        from application.pagination import decode_cursor, encode_cursor
+
+        with self.app.test_request_context():
+            cursor = encode_cursor(["case 1/é", 42])
+            self.assertNotIn("=", cursor)
+            self.assertEqual(decode_cursor(cursor), ["case 1/é", 42])
+            with self.assertRaises(BadRequest):
+                decode_cursor("not a cursor")
+
+    def test_requested_fields(self):
+        from application.pagination import page_size, requested_fields
+
+        available = {"id": None, "name": None, "progress": None}
+        with self.app.test_request_context("/?fields=name,id&limit=100000"):
+            self.assertEqual(requested_fields(available), ["name", "id"])
+            self.assertEqual(page_size(), self.app.config["MAX_PAGE_SIZE"])
+        with self.app.test_request_context("/"):
+            self.assertEqual(requested_fields(available), ["id", "name", "progress"])
+            self.assertEqual(page_size(), self.app.config["PAGE_SIZE"])
+        with self.app.test_request_context("/?fields=id,password"):
+            with self.assertRaises(BadRequest):
+                requested_fields(available)
+
+
+class PaginatedListTestCase(DatabaseTestCase):
+    """Test case for the paginated list endpoints"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            from application.models import Dataset, User
+
+            user = User(email="admin@test.com", password="test1234", is_admin="admin")
+            user.save()
+            self.headers = token_headers(user, is_admin="admin")
+            # two datasets share a name, the id breaks the tie, and one has none
+            for name in ["b", "a", "c", "b", "d", None]:
+                Dataset(name=name, project_id=None).save()
+
+    def test_datasets_are_paged_by_name(self):
+        path = "/api/v1/admin/datasets/?limit=2&fields=id,name"
+        pages = list()
+        while path:
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+            pages.append(json.loads(res.data.decode()))
+            link = res.headers.get("Link")
+            path = link[1:link.index(">")] if link else None
+            self.assertEqual(bool(link), bool(res.headers.get("X-Next-Cursor")))
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        datasets = [dataset for page in pages for dataset in page]
+        self.assertEqual([dataset["name"] for dataset in datasets], [None, "a", "b", "b", "c", "d"])
+        self.assertLess(datasets[2]["id"], datasets[3]["id"])
+        # only the requested fields are returned
+        self.assertEqual(set(datasets[0]), {"id", "name"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import time
+import unittest
+
+from application import create_app
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    """Test case for hashing passwords with a bounded number of bcrypt threads"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+
+    def test_hash_and_check(self):
+        from application.utils.passwords import PasswordHasher
+
+        hasher = PasswordHasher(workers=2, max_pending=2, rounds=4)
+        pw_hash = hasher.hash("test1234")
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(hasher.check(pw_hash, "test1234"))
+        self.assertFalse(hasher.check(pw_hash, "wrong"))
+
+    def test_saturated_hasher_turns_callers_away(self):
+        from application import password_hasher_busy
+        from application.utils.passwords import PasswordHasher, PasswordHasherBusy
+
+        hasher = PasswordHasher(workers=1, max_pending=1, rounds=4, max_wait=5)
+        release = threading.Event()
+        # one hash running and one waiting fill the hasher
+        blockers = [threading.Thread(target=hasher._run, args=(release.wait,)) for _ in range(2)]
+        for thread in blockers:
+            thread.start()
+        while hasher._in_flight < 2:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        with self.assertRaises(PasswordHasherBusy) as busy:
+            hasher.hash("test1234")
+        # rejected without waiting for the running hashes
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertGreaterEqual(busy.exception.retry_after, 1)
+        with self.app.test_request_context():
+            response = password_hasher_busy(busy.exception)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], str(busy.exception.retry_after))
+
+        release.set()
+        for thread in blockers:
+            thread.join()
+        self.assertTrue(hasher.check(hasher.hash("test1234"), "test1234"))
+
+    def test_waiting_caller_gives_up_after_max_wait(self):
+        from application.utils.passwords import PasswordHasher, PasswordHasherBusy
+
+        hasher = PasswordHasher(workers=1, max_pending=1, rounds=4, max_wait=0.2)
+        release = threading.Event()
+        blocker = threading.Thread(target=hasher._run, args=(release.wait,))
+        blocker.start()
+        while hasher._in_flight < 1:
+            time.sleep(0.01)
+
+        # queued behind the running hash, then turned away
+        start = time.perf_counter()
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("test1234")
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        release.set()
+        blocker.join()
+        self.assertEqual(hasher._in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import time
+import unittest
+
+from application import create_app
+
+
+class PredictionCacheTestCase(unittest.TestCase):
+    """Test case for the external prediction cache"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        with self.app.app_context():
+            from application.external.cache import PredictionCache
+        self.PredictionCache = PredictionCache
+        self.prediction = {"class": "Negative", "negative_confidence": 0.9, "positive_confidence": 0.1}
+
+    def test_key_depends_on_bytes_version_and_threshold(self):
+        key = self.PredictionCache.key(b"image", "2.0.0", 0.5)
+        self.assertEqual(key, self.PredictionCache.key(b"image", "2.0.0", 0.5))
+        self.assertNotEqual(key, self.PredictionCache.key(b"image2", "2.0.0", 0.5))
+        self.assertNotEqual(key, self.PredictionCache.key(b"image", "2.0.1", 0.5))
+        self.assertNotEqual(key, self.PredictionCache.key(b"image", "2.0.0", 0.6))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self.PredictionCache(max_entries=2)
+        cache.set("a", self.prediction)
+        cache.set("b", self.prediction)
+        cache.get("a")
+        cache.set("c", self.prediction)
+        self.assertEqual(cache.get("a"), self.prediction)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), self.prediction)
+
+    def test_entries_expire(self):
+        cache = self.PredictionCache(ttl=0.05)
+        cache.set("a", self.prediction)
+        self.assertEqual(cache.get("a"), self.prediction)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    @unittest.skipUnless(os.getenv("REDIS_URL"), "REDIS_URL is not set")
+    def test_redis_tier_is_shared(self):
+        writer = self.PredictionCache(redis_url=os.getenv("REDIS_URL"), prefix="test-prediction:")
+        reader = self.PredictionCache(redis_url=os.getenv("REDIS_URL"), prefix="test-prediction:")
+        writer.set("shared", self.prediction)
+        self.assertEqual(reader.get("shared"), self.prediction)
+        writer.redis.delete("test-prediction:shared")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from sqlalchemy.dialects import postgresql
+
+from application import db
+from helpers import DatabaseTestCase
+
+
+class QueryPlanTestCase(DatabaseTestCase):
+    """Checks that the hot view queries are served by an index"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            # a few datasets worth of rows, enough for the statistics to be meaningful
+            db.session.execute("INSERT INTO project (id, name, type) VALUES (1, 'project', 'label')")
+            db.session.execute(
+                "INSERT INTO users (id, email, password, site, project_id) "
+                "SELECT n, 'user' || n || '@test.com', 'x', 'site' || (n % 10), 1 FROM generate_series(1, 200) n")
+            db.session.execute(
+                "INSERT INTO datasets (id, name, project_id) "
+                "SELECT n, 'dataset' || n, 1 FROM generate_series(1, 20) n")
+            db.session.execute(
+                "INSERT INTO data_items (id, dataset_id, name, labelled, labelled_by) "
+                "SELECT n, n % 20 + 1, 'case' || n, n % 3 = 0, n % 200 + 1 FROM generate_series(1, 4000) n")
+            db.session.execute(
+                "INSERT INTO images (id, item_id, dataset_id, name, labelled, has_box, folder_labelled, labelled_by) "
+                "SELECT n, n % 4000 + 1, (n % 4000) % 20 + 1, 'image' || n, n % 5 = 0, n % 5 = 0, n % 5 = 0, "
+                "n % 200 + 1 FROM generate_series(1, 20000) n")
+            db.session.execute(
+                "INSERT INTO assignments (id, user_id, dataset_id) "
+                "SELECT n, n % 200 + 1, n % 20 + 1 FROM generate_series(1, 1000) n")
+            db.session.execute(
+                "INSERT INTO annotation (id, annotations, project_id, dataset_id, image_id, user_id) "
+                "SELECT n, '[]', 1, n % 20 + 1, n, n % 200 + 1 FROM generate_series(1, 10000) n")
+            db.session.commit()
+            for table in ["users", "datasets", "data_items", "images", "assignments", "annotation"]:
+                db.session.execute(f"ANALYZE {table}")
+
+    def scanned_tables(self, query):
+        """Returns the tables a query reads sequentially with sequential scans disabled,
+        which the planner only does when no index can answer it"""
+        sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+        db.session.execute("SET enable_seqscan = off")
+        try:
+            plan = db.session.execute("EXPLAIN (FORMAT JSON) " + sql).scalar()
+        finally:
+            db.session.execute("SET enable_seqscan = on")
+
+        def walk(node):
+            if node["Node Type"] == "Seq Scan":
+                yield node["Relation Name"]
+            for child in node.get("Plans", []):
+                yield from walk(child)
+
+        return list(walk(plan[0]["Plan"]))
+
+    def test_hot_queries_use_indexes(self):
+        from application.labelling import unlabelled_images
+        from application.models import Annotation, Assignment, Image, Item, User
+
+        with self.app.app_context():
+            queries = {
+                "images by dataset": Image.query.filter_by(dataset_id=3),
+                "images by item": Image.query.filter_by(item_id=42),
+                "images by labeller": Image.query.filter_by(labelled_by=7),
+                "labelled images of a dataset": Image.query.filter_by(
+                    dataset_id=3, labelled=True, has_box=True, folder_labelled=True),
+                "labelled images of an item": Image.query.filter_by(
+                    item_id=42, labelled=True, folder_labelled=True, has_box=True),
+                "items by dataset": Item.query.filter_by(dataset_id=3),
+                "items by name": Item.query.filter_by(name="case42", dataset_id=3),
+                "items by name only": Item.query.filter(Item.name.in_(["case1", "case2"])),
+                "items by labeller": Item.query.filter_by(labelled_by=7, labelled=True),
+                "labelled items of a dataset": Item.query.filter_by(labelled=True, dataset_id=3),
+                "annotations of a user": Annotation.query.filter_by(user_id=7, dataset_id=3),
+                "annotations of an image": Annotation.query.filter_by(image_id=42),
+                "assignments of a user": Assignment.query.filter_by(user_id=7),
+                "assignment of a user to a dataset": Assignment.query.filter_by(dataset_id=3, user_id=7),
+                "users by site": User.query.filter_by(site="site3"),
+                "users by project": User.query.filter_by(project_id=1),
+                "unlabelled images of a user": unlabelled_images(3, 7).filter(Image.id >= 500).order_by(Image.id),
+            }
+            for name, query in queries.items():
+                with self.subTest(query=name):
+                    self.assertEqual(self.scanned_tables(query), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
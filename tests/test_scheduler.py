@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from application import create_app
+
+
+class InferenceSchedulerTestCase(unittest.TestCase):
+    """Test case for the cross-request inference scheduler"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        with self.app.app_context():
+            from application.external.scheduler import InferenceScheduler
+        self.calls = list()
+
+        def run_batch(batch):
+            self.calls.append(len(batch))
+            # echo each image's first value back as its output
+            return [image.ravel()[:1] for image in batch]
+
+        self.scheduler = InferenceScheduler(run_batch, max_batch_size=4, max_wait_ms=50)
+
+    def test_concurrent_requests_are_batched(self):
+        """Images submitted from several threads share forward passes"""
+        results = dict()
+
+        def caller(i):
+            results[i] = self.scheduler.submit(np.full((2, 2, 3), i, dtype=np.float32)).result()
+
+        threads = [threading.Thread(target=caller, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), list(range(8)))
+        for i, output in results.items():
+            self.assertEqual(float(output[0]), i)
+        self.assertLess(len(self.calls), 8)
+        self.assertTrue(all(size <= 4 for size in self.calls))
+
+    def test_submit_many_runs_one_batch(self):
+        futures = self.scheduler.submit_many([np.full((2, 2, 3), i, dtype=np.float32) for i in range(4)])
+        self.assertEqual([float(f.result()[0]) for f in futures], [0, 1, 2, 3])
+        self.assertEqual(self.calls, [4])
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics["batch_size_histogram"], {"4": 1})
+        self.assertEqual(metrics["images"], 4)
+        self.assertEqual(metrics["queue_depth"], 0)
+
+    def test_errors_reach_every_caller(self):
+        def failing(batch):
+            raise RuntimeError("model failed")
+
+        self.scheduler.run_batch = failing
+        future = self.scheduler.submit(np.zeros((2, 2, 3), dtype=np.float32))
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+    def test_max_wait_bounds_latency(self):
+        start = time.perf_counter()
+        self.scheduler.submit(np.zeros((2, 2, 3), dtype=np.float32)).result(timeout=5)
+        self.assertLess(time.perf_counter() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import json
+import unittest
+
+from sqlalchemy import event
+
+from application import db
+from helpers import DatabaseTestCase, token_headers
+
+
+class DatasetStatsTestCase(DatabaseTestCase):
+    """Test case for the grouped labelling progress queries"""
+
+    def seed(self, datasets):
+        """Creates datasets with four images each, the first n_labelled of them fully labelled"""
+        from application.models import Dataset, Image, Item
+
+        ids = list()
+        for name, n_labelled in datasets:
+            dataset = Dataset(name=name, project_id=None)
+            dataset.save()
+            item = Item(dataset_id=dataset.id, name=f"{name}-case")
+            item.save()
+            for i in range(4):
+                image = Image(name=f"{name}-{i}.jpg", image_URL=f"{name}-{i}.jpg")
+                image.item_id = item.id
+                image.dataset_id = dataset.id
+                image.labelled = image.has_box = image.folder_labelled = i < n_labelled
+                db.session.add(image)
+            db.session.commit()
+            ids.append(dataset.id)
+        return ids
+
+    def admin_headers(self):
+        from application.models import User
+
+        user = User(email="admin@test.com", password="test1234", is_admin="admin")
+        user.save()
+        return token_headers(user, is_admin="admin")
+
+    def test_dataset_image_counts(self):
+        from application.stats import dataset_image_counts, dataset_progress
+
+        with self.app.app_context():
+            first, second, empty = self.seed([("first", 1), ("second", 4), ("empty", 0)])
+            self.assertEqual(dataset_image_counts(), {first: (1, 4), second: (4, 4), empty: (0, 4)})
+            self.assertEqual(dataset_image_counts([second]), {second: (4, 4)})
+            self.assertEqual(dataset_progress([first, empty]), {first: 25.0, empty: 0})
+            self.assertEqual(dataset_image_counts([]), {})
+
+    def test_counters_follow_label_writes(self):
+        from application import progress
+        from application.models import Annotation, Image, Item, User
+        from application.stats import dataset_image_counts, dataset_item_counts, user_annotation_counts
+
+        with self.app.app_context():
+            dataset_id, = self.seed([("dataset", 0)])
+            user = User(email="labeller@test.com", password="test1234", is_admin="")
+            user.save()
+            images = Image.query.filter_by(dataset_id=dataset_id).order_by(Image.id).all()
+
+            # objects are expired by each commit, like in the views
+            for image in images[:2]:
+                image.labelled = True
+                image.has_box = True
+                image.folder_labelled = True
+                image.save()
+            item = Item.query.filter_by(dataset_id=dataset_id).first()
+            item.labelled = True
+            item.labelled_by = str(user.id)
+            item.save()
+            for image in images[:3]:
+                Annotation(annotations="[]", project_id=None, dataset_id=str(dataset_id), image_id=image.id,
+                           user_id=user.id).save()
+            self.assertEqual(dataset_image_counts([dataset_id]), {dataset_id: (2, 4)})
+            self.assertEqual(dataset_item_counts([dataset_id]), {dataset_id: (1, 1)})
+            self.assertEqual(user_annotation_counts(user.id, [dataset_id]), {dataset_id: 3})
+
+            Annotation.query.filter_by(image_id=images[2].id).first().delete()
+            images[1].has_box = False
+            images[1].save()
+            # the database also deletes the annotation of the image
+            images[0].delete()
+            self.assertEqual(dataset_image_counts([dataset_id]), {dataset_id: (0, 3)})
+            self.assertEqual(user_annotation_counts(user.id, [dataset_id]), {dataset_id: 1})
+
+            # a rebuild from the label tables agrees with the maintained counters
+            db.session.execute("UPDATE dataset_progress SET images = 100")
+            progress.rebuild(db.session.connection())
+            db.session.commit()
+            self.assertEqual(dataset_image_counts([dataset_id]), {dataset_id: (0, 3)})
+            self.assertEqual(user_annotation_counts(user.id, [dataset_id]), {dataset_id: 1})
+
+            # deleting the folder also deletes its images and their annotations in the database,
+            # the counters are decremented without recounting the dataset
+            statements = list()
+
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                item.delete()
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertFalse([statement for statement in statements if "DELETE FROM dataset_progress" in statement])
+            self.assertEqual(dataset_image_counts([dataset_id]), {dataset_id: (0, 0)})
+            self.assertEqual(dataset_item_counts([dataset_id]), {dataset_id: (0, 0)})
+            self.assertEqual(user_annotation_counts(user.id, [dataset_id]), {dataset_id: 0})
+
+    def get_counting_statements(self, path, headers):
+        """Returns the json body of a GET request and the number of SQL statements it ran"""
+        with self.app.app_context():
+            engine = db.engine
+        statements = list()
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            res = self.client().get(path, headers=headers)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data.decode()), len(statements)
+
+    def test_dataset_listing_query_count_is_flat(self):
+        with self.app.app_context():
+            headers = self.admin_headers()
+            self.seed([("first", 2)])
+        body, few = self.get_counting_statements("/api/v1/admin/datasets/", headers)
+        self.assertEqual(body[0]["progress"], 50.0)
+
+        with self.app.app_context():
+            self.seed([(f"dataset{i}", i % 5) for i in range(20)])
+        body, many = self.get_counting_statements("/api/v1/admin/datasets/", headers)
+        self.assertEqual(len(body), 21)
+        self.assertEqual(few, many)
+
+    def test_item_listings_query_count_is_flat(self):
+        from application.models import Image, Item
+
+        with self.app.app_context():
+            headers = self.admin_headers()
+            dataset_id, = self.seed([("dataset", 4)])
+            Item.query.filter_by(dataset_id=dataset_id).first().labelled = True
+            db.session.commit()
+        admin_items, admin_few = self.get_counting_statements(f"/api/v1/admin/{dataset_id}/item/", headers)
+        user_items, user_few = self.get_counting_statements(f"/api/v1/user/datasets/{dataset_id}/", headers)
+        self.assertEqual(len(admin_items[0]["images_URLs"]), 4)
+        self.assertTrue(admin_items[0]["labelled"])
+        self.assertTrue(user_items["items"][0]["labelled"])
+
+        with self.app.app_context():
+            for i in range(30):
+                item = Item(dataset_id=dataset_id, name=f"case{i:02}")
+                item.labelled = True
+                item.save()
+                # every third folder has an image that is not labelled yet
+                if i % 3 == 0:
+                    image = Image(name=f"case{i}.jpg", image_URL=f"case{i}.jpg")
+                    image.item_id = item.id
+                    image.dataset_id = dataset_id
+                    image.save()
+        admin_items, admin_many = self.get_counting_statements(f"/api/v1/admin/{dataset_id}/item/", headers)
+        user_items, user_many = self.get_counting_statements(f"/api/v1/user/datasets/{dataset_id}/", headers)
+        self.assertEqual(len(admin_items), 31)
+        self.assertEqual([item["labelled"] for item in user_items["items"][:3]], [False, True, True])
+        self.assertEqual(admin_items[1]["images_URLs"], [])
+        self.assertEqual(admin_few, admin_many)
+        self.assertEqual(user_few, user_many)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from application import create_app
+from helpers import encode_image
+
+
+class ContentStoreTestCase(unittest.TestCase):
+    """Test case for the content addressed image store"""
+
+    def setUp(self):
+        self.app = create_app(config_name="testing")
+        with self.app.app_context():
+            from application.utils.imaging import ImageProcessor
+            from application.utils.storage import ContentStore
+        self.root = tempfile.mkdtemp()
+        self.store = ContentStore(self.root, "objects")
+        self.processor = ImageProcessor(workers=0)
+
+    def test_identical_content_is_stored_once(self):
+        data = encode_image("JPEG", (300, 200))
+        first = self.store.put_bytes(data)
+        second = self.store.put_stream(io.BytesIO(data))
+        self.assertTrue(first.created)
+        self.assertFalse(second.created)
+        self.assertEqual(first.digest, second.digest)
+        self.assertEqual(second.size, len(data))
+        self.assertEqual(list(self.store.digests()), [(first.digest, ".jpg")])
+        # only the committed blob is left behind
+        self.assertEqual(os.listdir(os.path.join(self.root, "tmp")), [])
+        path = self.store.relative_path(first.digest, ext=".jpg")
+        self.assertEqual(path, f"objects/original/{first.digest[:2]}/{first.digest[2:4]}/{first.digest}.jpg")
+
+    def test_derivatives_are_made_once(self):
+        stored = self.store.put_bytes(encode_image("PNG", (640, 480)))
+        calls = list()
+        process_files = self.processor.process_files
+
+        def counting(paths):
+            calls.append(len(paths))
+            return process_files(paths)
+
+        self.processor.process_files = counting
+        self.store.add_derivatives([stored, stored], self.processor)
+        self.store.add_derivatives([stored], self.processor)
+        self.assertEqual(calls, [1, 0])
+        self.assertTrue(self.store.exists(stored.digest, "thumbnails"))
+
+        self.store.remove(stored.digest)
+        self.assertEqual(list(self.store.digests()), [])
+        self.assertFalse(self.store.exists(stored.digest, "resized"))
+
+    def test_storing_again_keeps_a_blob_from_collection(self):
+        data = encode_image("JPEG", (300, 200))
+        stored = self.store.put_bytes(data)
+        path = self.store.path(stored.digest, ext=stored.ext)
+        os.utime(path, (0, 0))
+        self.assertEqual(list(self.store.digests(older_than=60)), [(stored.digest, ".jpg")])
+        # an upload of the same content makes the blob recent again
+        self.store.put_stream(io.BytesIO(data))
+        self.assertEqual(list(self.store.digests(older_than=60)), [])
+
+    def test_urls_outside_a_request(self):
+        from application.admin import image_url_for
+        from application.utils.storage import StoredImage
+
+        stored = StoredImage("ab" * 32, 10, ".png", False)
+        with self.app.test_request_context(base_url="http://annotator.test/"):
+            in_request = image_url_for(stored, "resized")
+        # the ingestion worker has no request, only the host the study was sent to
+        with self.app.app_context():
+            self.assertEqual(image_url_for(stored, "resized", "http://annotator.test/"), in_request)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,22 @@ from application import create_app
 config_name = os.getenv("APP_SETTINGS")
 app = create_app(config_name)
 
+if app.config.get("MODEL_WARMUP"):
+    # uWSGI runs with lazy-apps, so this module is imported by each worker after fork
+    from application.external.predict import warmup
+    warmup()
+
+if app.config.get("INGESTION_WORKER_THREADS"):
+    # runs the jobs queued or left stale before a restart without waiting for the next upload
+    from application.external import ingest_study
+    from application.external.jobs import get_worker
+    get_worker(app, ingest_study).start()
+
+if app.config.get("OUTBOX_SENDER_THREADS"):
+    # sends the emails left pending before a restart
+    from application.utils.email import get_sender
+    get_sender(app).start()
+
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers = gunicorn_logger.handlers